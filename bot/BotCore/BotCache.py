@@ -0,0 +1,162 @@
+import time
+from collections import OrderedDict
+from threading import Lock, Event
+
+
+class _Flight(object):
+    """
+    A load in progress, shared by all the callers missing the same key
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+
+
+class TTLCache(object):
+    """
+    Thread-safe LRU cache with a time-to-live per entry.
+    Concurrent misses on the same key share one load ("single flight"). Failed loads (None) are not cached.
+    """
+
+    def __init__(self, max_size=256, ttl=300, clock=None):
+        """
+        :param max_size: maximum number of entries, least recently used entries are evicted first
+        :param ttl: default time-to-live of an entry (in seconds)
+        :param clock: VirtualClock object, None for the system clock
+        """
+        self._max_size = max_size if max_size > 0 else 1
+        self._ttl = ttl
+        self._time = clock.time if clock is not None else time.time
+        self._entries = OrderedDict()  # key -> (expiration time, value)
+        self._flights = {}
+        self._lock = Lock()
+        self._hits = 0
+        self._misses = 0
+        self._loads = 0
+        self._shared_loads = 0
+        self._evictions = 0
+
+    def __get_fresh(self, key, now):
+        # Must be called with the lock held
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        # Move the entry to the most recently used end
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry
+
+    def __put(self, key, value, ttl):
+        # Must be called with the lock held
+        if key in self._entries:
+            del self._entries[key]
+        self._entries[key] = (self._time() + (self._ttl if ttl is None else ttl), value)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def get(self, key):
+        """
+        Get a cached value
+        :param key: the key
+        :return: the value, None if not cached or expired
+        """
+        with self._lock:
+            entry = self.__get_fresh(key, self._time())
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl=None):
+        if value is None:
+            return
+        with self._lock:
+            self.__put(key, value, ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_or_load(self, key, loader, force=False, ttl=None):
+        """
+        Get a cached value, loading it on a miss
+        :param key: the key
+        :param loader: function called with the key, returns the value or None on failure
+        :param force: True to ignore the cached value
+        :param ttl: time-to-live of the loaded value, None for the cache default
+        :return: the value, None if it could not be loaded
+        """
+        with self._lock:
+            if not force:
+                entry = self.__get_fresh(key, self._time())
+                if entry is not None:
+                    self._hits += 1
+                    return entry[1]
+            self._misses += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+            else:
+                self._shared_loads += 1
+        if not leader:
+            flight.done.wait()
+            return flight.result
+
+        value = None
+        try:
+            value = loader(key)
+        finally:
+            with self._lock:
+                self._loads += 1
+                if value is not None:
+                    self.__put(key, value, ttl)
+                del self._flights[key]
+            flight.result = value
+            flight.done.set()
+        return value
+
+    def export(self):
+        """
+        Get the entries which have not expired
+        :return: list of (key, remaining time-to-live, value) tuples, least recently used first
+        """
+        now = self._time()
+        with self._lock:
+            return [(key, entry[0] - now, entry[1]) for key, entry in self._entries.iteritems() if entry[0] > now]
+
+    def restore(self, entries):
+        """
+        Put exported entries back
+        :param entries: list of (key, remaining time-to-live, value) tuples
+        :return: number of restored entries
+        """
+        restored = 0
+        with self._lock:
+            for key, ttl, value in entries:
+                if ttl > 0 and value is not None:
+                    self.__put(key, value, ttl)
+                    restored += 1
+        return restored
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'loads': self._loads,
+                'shared_loads': self._shared_loads,
+                'evictions': self._evictions
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -1,33 +1,176 @@
 import binascii
 import ConfigParser
+import cPickle
+import hashlib
 import os
 import json
+import time
+from abc import ABCMeta
+
+
+class ConfigCache(object):
+    """
+    Binary cache of compiled config files.
+    An entry is keyed by the config file path and is only used while the file mtime and size are unchanged.
+    """
+    VERSION = 1
+    EXTENSION = '.cache'
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        self._hits = 0
+        self._misses = 0
+
+    def __make_path(self, kind, file_path):
+        name = hashlib.sha1(kind + ':' + file_path).hexdigest()
+        return os.path.join(self._cache_dir, name + ConfigCache.EXTENSION)
+
+    def load(self, file_path, compiler, kind='json'):
+        """
+        Load a compiled config file
+        :param file_path: path of the config file
+        :param compiler: function compiling the config file, called with the path on cache miss
+        :param kind: kind of compilation, part of the cache key
+        :return: the compiled config, None if the file could not be compiled
+        """
+        file_path = os.path.abspath(file_path)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return compiler(file_path)
+        key = (ConfigCache.VERSION, kind, file_path, st.st_mtime, st.st_size)
+        cache_path = self.__make_path(kind, file_path)
+        try:
+            with open(cache_path, 'rb') as f:
+                entry_key, data = cPickle.load(f)
+            if entry_key == key:
+                self._hits += 1
+                return data
+        except (IOError, EOFError, ValueError, TypeError, AttributeError, ImportError, cPickle.UnpicklingError):
+            pass
+        self._misses += 1
+        data = compiler(file_path)
+        if data is not None:
+            self.__store(cache_path, key, data)
+        return data
+
+    def __store(self, cache_path, key, data):
+        tmp_path = cache_path + '.tmp'
+        try:
+            if not os.path.exists(self._cache_dir):
+                os.mkdir(self._cache_dir)
+            with open(tmp_path, 'wb') as f:
+                cPickle.dump((key, data), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError, cPickle.PicklingError, TypeError):
+            # Not cacheable, compiled again on next start
+            pass
+
+    def get_stats(self):
+        return {'hits': self._hits, 'misses': self._misses}
+
+
+class ConfigWatcher(object):
+    """
+    Detect config file changes by polling the modification time and size of the files
+    """
+
+    def __init__(self):
+        self._files = {}  # path -> (mtime, size), None if the file does not exist
+
+    @staticmethod
+    def __stat(path):
+        try:
+            st = os.stat(path)
+            return st.st_mtime, st.st_size
+        except OSError:
+            return None
+
+    def watch(self, path):
+        if path is not None and path not in self._files:
+            self._files[path] = ConfigWatcher.__stat(path)
+
+    def unwatch(self, path):
+        self._files.pop(path, None)
+
+    def poll(self):
+        """
+        Check the watched files
+        :return: list of the paths changed since the previous poll
+        """
+        changed = []
+        for path, signature in self._files.items():
+            current = ConfigWatcher.__stat(path)
+            if current != signature:
+                self._files[path] = current
+                changed.append(path)
+        return changed
 
 
 class JsonLoader:
+    _cache = None
+
     def __init__(self):
         pass
 
+    @staticmethod
+    def __byteify_value(data):
+        if isinstance(data, unicode):
+            return data.encode('utf-8')
+        if isinstance(data, list):
+            return [JsonLoader.__byteify_value(item) for item in data]
+        # Dictionaries have already been converted by the decoder hook
+        return data
+
+    @staticmethod
+    def __byteify_pairs(pairs):
+        # Called by the decoder for every object, innermost first: each value is converted exactly once
+        return {JsonLoader.__byteify_value(k): JsonLoader.__byteify_value(v) for k, v in pairs}
+
     @staticmethod
     def json_load_byteified(file_handle):
         try:
-            return JsonLoader.byteify(
-                json.load(file_handle, object_hook=JsonLoader.byteify),
-                ignore_dicts=True
-            )
+            return JsonLoader.__byteify_value(json.load(file_handle, object_pairs_hook=JsonLoader.__byteify_pairs))
         except (ValueError, IOError):
             return None
 
     @staticmethod
     def json_loads_byteified(json_text):
         try:
-            return JsonLoader.byteify(
-                json.loads(json_text, object_hook=JsonLoader.byteify),
-                ignore_dicts=True
-            )
+            return JsonLoader.__byteify_value(json.loads(json_text, object_pairs_hook=JsonLoader.__byteify_pairs))
         except (ValueError, IOError):
             return None
 
+    @staticmethod
+    def set_cache(cache):
+        """
+        Set the ConfigCache used by load_file
+        :param cache: the cache, None to always parse the files
+        :return: None
+        """
+        JsonLoader._cache = cache
+
+    @staticmethod
+    def __read_file(file_path):
+        try:
+            with open(file_path, 'rt') as f:
+                return JsonLoader.json_load_byteified(f)
+        except IOError:
+            return None
+
+    @staticmethod
+    def load_file(file_path):
+        """
+        Load a JSON config file, from the compiled config cache if up to date
+        :param file_path: path of the file
+        :return: the byteified data, None if errors occurred
+        """
+        if file_path is None:
+            return None
+        if JsonLoader._cache is not None:
+            return JsonLoader._cache.load(file_path, JsonLoader.__read_file)
+        return JsonLoader.__read_file(file_path)
+
     @staticmethod
     def byteify(data, ignore_dicts=False):
         # if this is a unicode string, return its string representation
@@ -47,20 +190,196 @@ class JsonLoader:
         return data
 
 
+class ConfigError(Exception):
+    """
+    Raised when a config file does not match what its module expects
+    """
+    pass
+
+
+class ConfigReader(object):
+    """
+    Typed access to a JSON config object, raising ConfigError with the path of the offending value
+    """
+
+    def __init__(self, data, path):
+        """
+        :param data: the JSON object (dictionary)
+        :param path: path of the object, used in error messages
+        """
+        if not isinstance(data, dict):
+            raise ConfigError('%s: object expected' % path)
+        self._data = data
+        self._path = path
+
+    def __error(self, name, expected):
+        return ConfigError('%s.%s: %s expected' % (self._path, name, expected))
+
+    def has(self, name):
+        return name in self._data
+
+    def keys(self):
+        return sorted(self._data.keys())
+
+    def section(self, name):
+        """
+        Get a nested object
+        :param name: key of the object
+        :return: ConfigReader of the object, of an empty object if missing
+        """
+        return ConfigReader(self._data.get(name, {}), '%s.%s' % (self._path, name))
+
+    def number(self, name, default, minimum=0):
+        value = self._data.get(name, default)
+        if isinstance(value, bool) or not isinstance(value, (int, long, float)) or value < minimum:
+            raise self.__error(name, 'number >= %s' % minimum)
+        return value
+
+    def boolean(self, name, default=False):
+        value = self._data.get(name, default)
+        if not isinstance(value, bool):
+            raise self.__error(name, 'boolean')
+        return value
+
+    def string(self, name, default=None):
+        value = self._data.get(name, default)
+        if value is None and default is None:
+            raise self.__error(name, 'string')
+        if not isinstance(value, str):
+            raise self.__error(name, 'string')
+        return value
+
+    def time(self, name):
+        """
+        Get a time of the day
+        :param name: key of the value
+        :return: the time, as a HH:MM:SS string
+        """
+        value = self.string(name)
+        try:
+            time.strptime(value, '%H:%M:%S')
+        except ValueError:
+            raise self.__error(name, 'HH:MM:SS time')
+        return value
+
+    def string_list(self, name):
+        value = self._data.get(name, [])
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            raise self.__error(name, 'list of strings')
+        return tuple(value)
+
+    def object_list(self, name):
+        value = self._data.get(name, [])
+        if not isinstance(value, list):
+            raise self.__error(name, 'list of objects')
+        return tuple(ConfigReader(item, '%s.%s[%d]' % (self._path, name, i)) for i, item in enumerate(value))
+
+
+class abstractclassmethod(classmethod):
+    """
+    Abstract class method, ABCMeta of Python 2 does not see abstractmethod below classmethod
+    """
+    __isabstractmethod__ = True
+
+    def __init__(self, func):
+        func.__isabstractmethod__ = True
+        classmethod.__init__(self, func)
+
+
+class ConfigObject(object):
+    """
+    Base class of the validated module configs.
+    Subclasses list their attributes in __slots__, all of them are set once by the constructor and are read-only.
+    """
+    __metaclass__ = ABCMeta
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in type(self).__slots__:
+            object.__setattr__(self, name, values[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % (name, getattr(self, name)) for name in type(self).__slots__))
+
+    @abstractclassmethod
+    def from_reader(cls, reader):
+        """
+        Build the config from a JSON object
+        :param reader: ConfigReader of the JSON object
+        :return: the config object
+        """
+        pass
+
+    @classmethod
+    def load(cls, config_file):
+        """
+        Load and validate a JSON config file
+        :param config_file: path of the config file, None for the default config
+        :return: the config object, ConfigError is raised if the file is unreadable or invalid
+        """
+        if config_file is None:
+            return cls.from_reader(ConfigReader({}, cls.__name__))
+        data = JsonLoader.load_file(config_file)
+        if data is None:
+            raise ConfigError('%s: cannot read or parse the config file' % config_file)
+        return cls.from_reader(ConfigReader(data, os.path.basename(config_file)))
+
+
 class BotConfig(object):
     """  
     BotConfig class representing bot configuration
     """
     _api_token = None
+    _token = None
     _paths = {}
     _disabled_modules = {}
     _enabled_channels = {}
     _enabled_user_pm = {}
     _should_be_offline = False
     _timeout = {}
+    _options = {}
+
+    # Parsed state, cached by ConfigCache (the API token is only stored in its encoded form)
+    STATE = ('_token', '_paths', '_disabled_modules', '_enabled_channels', '_enabled_user_pm',
+             '_should_be_offline', '_timeout', '_options')
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, cache=None):
+        """
+        :param config_file: path of the config file
+        :param cache: ConfigCache to load the parsed config from, None to always parse the file
+        """
         self._config_file = config_file
+        if cache is not None and config_file is not None:
+            state = cache.load(config_file, self.__compile, 'bot.conf')
+        else:
+            state = self.__compile(config_file)
+        for name in BotConfig.STATE:
+            setattr(self, name, state[name])
+        if self._token is not None:
+            self.__parse_token(self._token)
+
+    def __compile(self, config_file):
+        """
+        Parse the config file
+        :param config_file: path of the config file
+        :return: dictionary of the parsed state
+        """
+        self._token = None
+        self._paths = {}
+        self._disabled_modules = {}
+        self._enabled_channels = {}
+        self._enabled_user_pm = {}
+        self._should_be_offline = False
+        self._timeout = {}
+        self._options = {}
+
         parser = ConfigParser.SafeConfigParser()
         parser.read(config_file)
 
@@ -82,6 +401,11 @@ class BotConfig(object):
         # Parse timeout information
         self.__parse_timeout_info(parser)
 
+        # Parse generic section options
+        self.__parse_options(parser)
+
+        return {name: getattr(self, name) for name in BotConfig.STATE}
+
     def __parse_api(self, parser):
         """
         Parse API options
@@ -96,8 +420,7 @@ class BotConfig(object):
         except ConfigParser.NoSectionError, ConfigParser.NoOptionError:
             token = None
             pass
-        if token is not None:
-            self.__parse_token(token)
+        self._token = token
         self._should_be_offline = offline_mode
 
     def __parse_disabled_modules(self, parser):
@@ -147,6 +470,19 @@ class BotConfig(object):
         except ConfigParser.Error:
             return
 
+    def __parse_options(self, parser):
+        """
+        Parse generic key/value options of every section, keeping raw string values
+        :param parser: the parser object
+        :return: None
+        """
+        for section in parser.sections():
+            try:
+                for name, value in parser.items(section):
+                    self._options.setdefault(section.lower(), {})[name.lower()] = value
+            except ConfigParser.Error:
+                continue
+
     def __parse_enabled_channels(self, parser):
         """
         Parse the enabled channel list options
@@ -181,6 +517,9 @@ class BotConfig(object):
         for (ch, k) in zip(t, key):
             self._api_token += chr(ord(ch) ^ ord(k))
 
+    def get_config_file(self):
+        return self._config_file
+
     def get_path(self, path):
         """
         Get the specified path configuration
@@ -205,6 +544,46 @@ class BotConfig(object):
         else:
             return None
 
+    def get_option(self, section, name, default=None):
+        """
+        Get a raw option value
+        :param section: section name
+        :param name: option name
+        :param default: value returned if the option is not found
+        :return: the option value as string, default if not found
+        """
+        if section is None or name is None:
+            return default
+        options = self._options.get(section.lower())
+        if options is None or name.lower() not in options:
+            return default
+        return options[name.lower()]
+
+    def get_int_option(self, section, name, default=None):
+        val = self.get_option(section, name)
+        try:
+            return int(val) if val is not None else default
+        except ValueError:
+            return default
+
+    def get_float_option(self, section, name, default=None):
+        val = self.get_option(section, name)
+        try:
+            return float(val) if val is not None else default
+        except ValueError:
+            return default
+
+    def get_bool_option(self, section, name, default=False):
+        val = self.get_option(section, name)
+        if val is None:
+            return default
+        val = val.strip().lower()
+        if val in ('1', 'yes', 'true', 'on'):
+            return True
+        if val in ('0', 'no', 'false', 'off'):
+            return False
+        return default
+
     def is_module_disabled(self, mod_name):
         """
         Check whether the given module name has been disabled
@@ -258,47 +637,3 @@ class BotConfig(object):
             parent_dir = os.getcwd()
         return os.path.join(parent_dir, file_name)
 
-
-class BotPrefs:
-    """
-    Class representing the bot preferences
-    """
-    _prefs_dir = ''
-
-    def __init__(self, prefs_dir):
-        self._prefs_dir = prefs_dir
-        if not os.path.exists(self._prefs_dir):
-            os.mkdir(self._prefs_dir)
-
-    @staticmethod
-    def __make_pref_name(pref_name):
-        return pref_name + ".pref"
-
-    def save_prefs(self, pref_name, prefs):
-        if pref_name is None or len(pref_name) == 0 or prefs is None:
-            return False
-        pref_file = os.path.join(self._prefs_dir, BotPrefs.__make_pref_name(pref_name))
-        data = json.dumps(prefs, indent=4, encoding='utf-8')
-        if data is None:
-            return False
-        try:
-            f = open(pref_file, "wt")
-            f.write(data)
-            f.close()
-            return True
-        except IOError:
-            return False
-
-    def load_prefs(self, pref_name):
-        if pref_name is None or len(pref_name) == 0:
-            return None
-        pref_file = os.path.join(self._prefs_dir, BotPrefs.__make_pref_name(pref_name))
-        if not os.path.exists(pref_file):
-            return None
-        try:
-            f = open(pref_file, "rt")
-            result = JsonLoader.json_load_byteified(f)
-            f.close()
-        except (IOError, ValueError):
-            result = None
-        return result
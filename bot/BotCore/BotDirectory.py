@@ -0,0 +1,237 @@
+from threading import Lock
+
+
+class DirectorySnapshot(object):
+    """
+    Immutable view of the member and channel directory.
+    Dictionaries of a snapshot are never modified once published, writers build a new snapshot instead.
+    """
+    __slots__ = ('members', 'members_by_name', 'channels', 'channels_by_name')
+
+    def __init__(self, members=None, members_by_name=None, channels=None, channels_by_name=None):
+        self.members = members if members is not None else {}
+        self.members_by_name = members_by_name if members_by_name is not None else {}
+        self.channels = channels if channels is not None else {}
+        self.channels_by_name = channels_by_name if channels_by_name is not None else {}
+
+
+class BotDirectory(object):
+    """
+    Slack member and channel directory.
+    Bulk loads use cursor pagination, then RTM events keep the directory up to date incrementally.
+    Reads are lock-free: they use the current copy-on-write snapshot.
+    """
+    KEY_ID = 'id'
+    KEY_NAME = 'name'
+    KEY_RAW = 'raw'
+
+    PAGE_SIZE = 200
+    MAX_PAGES = 1000
+
+    MEMBER_EVENTS = frozenset(['team_join', 'user_change'])
+    CHANNEL_EVENTS = frozenset(['channel_created', 'channel_rename', 'group_joined', 'group_rename'])
+    EVENTS = MEMBER_EVENTS | CHANNEL_EVENTS
+
+    def __init__(self, api_call, bot_name, bot_info, logger, page_size=PAGE_SIZE):
+        """
+        :param api_call: function performing Slack Web API calls, same signature as SlackClient.api_call
+        :param bot_name: user name of the bot
+        :param bot_info: dictionary updated in place with the bot member information
+        :param logger: logger object
+        :param page_size: number of items requested per page
+        """
+        self._api_call = api_call
+        self._bot_name = bot_name
+        self._bot_info = bot_info
+        self._logger = logger
+        self._page_size = page_size
+        self._write_lock = Lock()
+        self._snapshot = DirectorySnapshot()
+
+    def get_snapshot(self):
+        return self._snapshot
+
+    def __fetch_all(self, method, item_key):
+        """
+        Fetch all the pages of a paginated list method
+        :param method: API method name
+        :param item_key: key of the item list in the response
+        :return: list of items, None if the first page could not be fetched
+        """
+        items = None
+        cursor = None
+        for _ in range(BotDirectory.MAX_PAGES):
+            kwargs = {'limit': self._page_size}
+            if cursor:
+                kwargs['cursor'] = cursor
+            result = self._api_call(method, **kwargs)
+            if result is None or not result.get('ok'):
+                if items is not None:
+                    self._logger.warning('%s: failed to fetch page, list is truncated' % method)
+                break
+            if items is None:
+                items = []
+            items.extend(result.get(item_key) or [])
+            next_cursor = (result.get('response_metadata') or {}).get('next_cursor')
+            if not next_cursor or next_cursor == cursor:
+                break
+            cursor = next_cursor
+        return items
+
+    @staticmethod
+    def __make_member(user):
+        if 'name' not in user or 'id' not in user:
+            return None
+        return {
+            BotDirectory.KEY_NAME: user['name'].encode('utf-8'),
+            BotDirectory.KEY_ID: user['id'].encode('utf-8'),
+            BotDirectory.KEY_RAW: user}
+
+    @staticmethod
+    def __make_channel(channel):
+        if 'id' not in channel or 'name' not in channel:
+            return None
+        return {
+            BotDirectory.KEY_NAME: channel['name'].encode('utf-8'),
+            BotDirectory.KEY_ID: channel['id'].encode('utf-8'),
+            BotDirectory.KEY_RAW: channel}
+
+    def __put_member(self, members, members_by_name, user):
+        member = BotDirectory.__make_member(user)
+        if member is None:
+            return False
+        if member[BotDirectory.KEY_NAME] == self._bot_name:
+            self._bot_info[BotDirectory.KEY_NAME] = member[BotDirectory.KEY_NAME]
+            self._bot_info[BotDirectory.KEY_ID] = member[BotDirectory.KEY_ID]
+            self._bot_info[BotDirectory.KEY_RAW] = user
+            return True
+        old = members.get(member[BotDirectory.KEY_ID])
+        if old is not None and members_by_name.get(old[BotDirectory.KEY_NAME]) is old:
+            del members_by_name[old[BotDirectory.KEY_NAME]]
+        members[member[BotDirectory.KEY_ID]] = member
+        members_by_name[member[BotDirectory.KEY_NAME]] = member
+        return True
+
+    def __put_channel(self, channels, channels_by_name, raw_channel):
+        chan = BotDirectory.__make_channel(raw_channel)
+        if chan is None:
+            return False
+        old = channels.get(chan[BotDirectory.KEY_ID])
+        if old is not None:
+            if channels_by_name.get(old[BotDirectory.KEY_NAME]) is old:
+                del channels_by_name[old[BotDirectory.KEY_NAME]]
+            # Partial channel objects (e.g. rename events) keep the previously known details
+            if raw_channel is not old[BotDirectory.KEY_RAW]:
+                raw = dict(old[BotDirectory.KEY_RAW])
+                raw.update(raw_channel)
+                chan[BotDirectory.KEY_RAW] = raw
+        channels[chan[BotDirectory.KEY_ID]] = chan
+        channels_by_name[chan[BotDirectory.KEY_NAME]] = chan
+        return True
+
+    def load_members(self):
+        """
+        Bulk load the member list
+        :return: True if successful, False otherwise
+        """
+        users = self.__fetch_all('users.list', 'members')
+        if users is None:
+            return False
+        members = {}
+        members_by_name = {}
+        with self._write_lock:
+            for user in users:
+                self.__put_member(members, members_by_name, user)
+            snapshot = self._snapshot
+            self._snapshot = DirectorySnapshot(members, members_by_name, snapshot.channels, snapshot.channels_by_name)
+        self._logger.info('Directory: %d members loaded' % len(members))
+        return True
+
+    def load_channels(self):
+        """
+        Bulk load the public and private channel lists
+        :return: True if successful, False otherwise
+        """
+        loaded = False
+        channels = {}
+        channels_by_name = {}
+        for method, item_key in (('channels.list', 'channels'), ('groups.list', 'groups')):
+            items = self.__fetch_all(method, item_key)
+            if items is None:
+                continue
+            loaded = True
+            for channel in items:
+                self.__put_channel(channels, channels_by_name, channel)
+        if not loaded:
+            return False
+        with self._write_lock:
+            snapshot = self._snapshot
+            self._snapshot = DirectorySnapshot(snapshot.members, snapshot.members_by_name, channels, channels_by_name)
+        self._logger.info('Directory: %d channels loaded' % len(channels))
+        return True
+
+    def export(self):
+        """
+        Get the raw member (including the bot) and channel objects, as returned by the Web API
+        :return: (list of members, list of channels) tuple
+        """
+        snapshot = self._snapshot
+        users = [member[BotDirectory.KEY_RAW] for member in snapshot.members.values()]
+        if BotDirectory.KEY_RAW in self._bot_info:
+            users.append(self._bot_info[BotDirectory.KEY_RAW])
+        return users, [chan[BotDirectory.KEY_RAW] for chan in snapshot.channels.values()]
+
+    def restore(self, users, channels):
+        """
+        Replace the directory by exported members and channels
+        :param users: list of raw member objects
+        :param channels: list of raw channel objects
+        :return: None
+        """
+        members = {}
+        members_by_name = {}
+        channel_dict = {}
+        channels_by_name = {}
+        with self._write_lock:
+            for user in users:
+                self.__put_member(members, members_by_name, user)
+            for channel in channels:
+                self.__put_channel(channel_dict, channels_by_name, channel)
+            self._snapshot = DirectorySnapshot(members, members_by_name, channel_dict, channels_by_name)
+        self._logger.info('Directory: %d members and %d channels restored' % (len(members), len(channel_dict)))
+
+    def apply_event(self, event):
+        """
+        Update the directory from a RTM event
+        :param event: the RTM event
+        :return: True if the directory has been updated, False otherwise
+        """
+        event_type = event.get('type')
+        if event_type in BotDirectory.MEMBER_EVENTS:
+            user = event.get('user')
+            if not isinstance(user, dict):
+                return False
+            with self._write_lock:
+                snapshot = self._snapshot
+                members = dict(snapshot.members)
+                members_by_name = dict(snapshot.members_by_name)
+                if not self.__put_member(members, members_by_name, user):
+                    return False
+                self._snapshot = DirectorySnapshot(members, members_by_name,
+                                                   snapshot.channels, snapshot.channels_by_name)
+            return True
+        if event_type in BotDirectory.CHANNEL_EVENTS:
+            channel = event.get('channel')
+            if not isinstance(channel, dict):
+                return False
+            with self._write_lock:
+                snapshot = self._snapshot
+                channels = dict(snapshot.channels)
+                channels_by_name = dict(snapshot.channels_by_name)
+                if not self.__put_channel(channels, channels_by_name, channel):
+                    return False
+                self._snapshot = DirectorySnapshot(snapshot.members, snapshot.members_by_name,
+                                                   channels, channels_by_name)
+            self._logger.info('Directory: channel %s updated (%s)' % (channel.get('name'), event_type))
+            return True
+        return False
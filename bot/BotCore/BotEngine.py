@@ -1,10 +1,26 @@
 from BotConfig import *
+from BotOutbound import OutboundScheduler
+from BotQueue import ResponseQueue
+from BotTrigger import BotTrigger, TriggerIndex
+from BotMessage import BotMessage, MentionTokens
+from BotScheduler import BotSerialLanes
+from BotDirectory import BotDirectory
+from BotHistory import BotHistory
+from BotPrefs import BotPrefs
+from BotCache import TTLCache
+from BotRuntime import BotRuntime
+from BotSnapshot import BotSnapshot
+from BotGateway import SlackGateway
+from BotUtils import UrlUtils
 from abc import ABCMeta, abstractmethod
 import logging
 import logging.config
 from slackclient import SlackClient
+import hashlib
 import time
-from threading import Thread, Event, RLock
+import select
+import socket
+from threading import Thread, Event, Lock
 
 
 class User(object):
@@ -99,12 +115,7 @@ class User(object):
         :param input_file: json input file to parse 
         :return: list of User object, None if error
         """
-        try:
-            f = open(input_file, "rb")
-            input_data = JsonLoader.json_load_byteified(f)
-            f.close()
-        except IOError:
-            return
+        input_data = JsonLoader.load_file(input_file)
         if input_data is None:
             return None
         if not isinstance(input_data, list):
@@ -162,6 +173,14 @@ class BotBaseMod:
         """
         pass
 
+    def get_triggers(self):
+        """
+        Declare the messages this module is interested in, called once the module has been registered.
+        The engine compiles all the triggers into one routing index and only calls on_message for matching messages.
+        :return: list of BotTrigger objects, None to receive every event
+        """
+        return None
+
 
 class BotTimer:
     """
@@ -174,24 +193,6 @@ class BotTimer:
         pass
 
 
-class BotThread(Thread):
-    _args = None
-    _func = None
-    _stop_event = None
-    _timer_interval = 0
-
-    def __init__(self, timer_interval, stop_event, func, args=None):
-        Thread.__init__(self)
-        self._timer_interval = timer_interval
-        self._func = func
-        self._args = args
-        self._stop_event = stop_event
-
-    def run(self):
-        while not self._stop_event.wait(self._timer_interval):
-            self._func(*self._args)
-
-
 class BotEngine:
     """
     This class represents the core bot engine
@@ -199,57 +200,117 @@ class BotEngine:
     _logger_name = 'CacCuBot'
     BOT_NAME = "cac_cu"
     PREFS_NAME = "bot_engine"
-    REFRESH_CHANNEL_HISTORY_TIMEOUT = 10
+    WORKSPACE_POST_RATE = 4.0  # messages per second, Slack allows a few hundred per minute per workspace
+    WORKSPACE_POST_BURST = 10
+    CHANNEL_QUEUE_CAPACITY = 100
+    WORKER_THREADS = BotRuntime.WORKER_THREADS
+    HANDLER_THREADS = BotRuntime.HANDLER_THREADS
+    HANDLER_TIMEOUT = 10  # in seconds
+    RELOAD_INTERVAL = 5  # in seconds
+    SNAPSHOT_INTERVAL = 300  # in seconds
+    # Options only applied on startup, a change is reported when bot.conf is reloaded
+    RESTART_OPTIONS = (('engine', 'ingestion_mode'), ('engine', 'worker_threads'), ('engine', 'handler_threads'),
+                       ('engine', 'workspace'), ('prefs', 'backend'), ('history', 'capacity'),
+                       ('http', 'pool_size'), ('http', 'timeout'), ('http', 'idle_timeout'),
+                       ('metrics', 'host'), ('metrics', 'port'))
+    CHANNEL_INFO_CACHE_SIZE = 256
+    MAX_SEND_ATTEMPTS = 3
+    CHANNEL_INFO_CACHE_TTL = 60  # in seconds
+    CHANNEL_KIND_TTL = 86400  # in seconds
+    CHANNEL_KIND_CHANNEL = 'channel'
+    CHANNEL_KIND_GROUP = 'group'
+    CHANNEL_KIND_IM = 'im'
+
+    PRIORITY_REPLY = ResponseQueue.PRIORITY_REPLY
+    PRIORITY_BROADCAST = ResponseQueue.PRIORITY_BROADCAST
+
+    INGESTION_POLLING = 'polling'
+    INGESTION_EVENT = 'event'
 
     KEY_ID = 'id'
     KEY_NAME = 'name'
-    KEY_RAW = 'raw'
-    KEY_HISTORY = 'history'
-    KEY_LAST_REFRESH = 'last_refresh'
-    KEY_CHANNEL_NAME = 'channel_name'
-    KEY_CHANNEL_ID = 'channel_id'
+    KEY_RAW = BotMessage.KEY_RAW
+    KEY_CHANNEL_NAME = BotMessage.KEY_CHANNEL_NAME
+    KEY_CHANNEL_ID = BotMessage.KEY_CHANNEL_ID
     KEY_ATTACHMENTS = 'attachments'
-    KEY_STANDARDIZED_TEXT = 'std_text'
-    KEY_STANDARDIZED_LOWER_TEXT = 'std_lower_text'
-    KEY_RAW_WORDS = 'raw_words'
-    KEY_LOWER_WORDS = 'raw_lower_words'
-    KEY_IS_MESSAGE = 'is_message'
-    KEY_IS_BOT_MENTIONED = 'is_bot_mentioned'
-    KEY_FROM_USER_NAME = 'from_user_name'
-    KEY_FROM_USER_ID = 'from_user_id'
+    KEY_STANDARDIZED_TEXT = BotMessage.KEY_STANDARDIZED_TEXT
+    KEY_STANDARDIZED_LOWER_TEXT = BotMessage.KEY_STANDARDIZED_LOWER_TEXT
+    KEY_RAW_WORDS = BotMessage.KEY_RAW_WORDS
+    KEY_LOWER_WORDS = BotMessage.KEY_LOWER_WORDS
+    KEY_IS_MESSAGE = BotMessage.KEY_IS_MESSAGE
+    KEY_IS_BOT_MENTIONED = BotMessage.KEY_IS_BOT_MENTIONED
+    KEY_FROM_USER_NAME = BotMessage.KEY_FROM_USER_NAME
+    KEY_FROM_USER_ID = BotMessage.KEY_FROM_USER_ID
+    KEY_TRIGGERS = 'triggers'
 
     KEY_TEXT = 'text'
     KEY_LAST_RESPONSE = 'last_response'
     KEY_RESPONSE_TYPE = 'response_type'
     KEY_UPLOAD_RESPONSE = 'upload_response'
+    KEY_SEND_ATTEMPTS = 'send_attempts'
+    KEY_PRIORITY = 'priority'
+    KEY_QUEUED_AT = 'queued_at'
     KEY_COMMENT = 'comment'
     KEY_TITLE = 'title'
     KEY_FILE_TYPE = 'file_type'
     KEY_FILE_NAME = 'file_name'
 
-    _member_list = {}
-    _member_list_name = {}
-    _channel_list = {}
-    _channel_list_name = {}
-    _bot_info = {}
+    _directory = None
+    _bot_info = None
+    _mention_tokens = None
     _slack_client = None
-    _response_queue = []
-    _channel_info = {}
-    _channel_info_name = {}
+    _outbound = None
+    _channel_info = None
+    _channel_kinds = None
     _bot_prefs = None
-    _channel_history = {}
+    _history = None
     _post_delay = 10
     _refresh_time = 5
-    _prefs = {}
+    _ingestion_mode = INGESTION_POLLING
+    _rtm_wait_timeout = 5
+    _prefs = None
     _stop_event = None
-    _response_lock = None
+    _workers = None
+    _scheduler = None
+    _handlers = None
+    _lanes = None
 
-    def __init__(self, config_file):
-        self._bot_config = BotConfig(config_file)
-        self._bot_prefs = BotPrefs(os.path.join(os.getcwd(), '.prefs'))
+    def __init__(self, config_file, runtime=None):
+        """
+        :param config_file: path of the config file
+        :param runtime: BotRuntime shared with other workspace engines, None to create a private one
+        """
+        # Parsed configs are cached across runs, config files are only parsed again when they change
+        if runtime is not None:
+            self._config_cache = runtime.get_config_cache()
+        else:
+            self._config_cache = ConfigCache(os.path.join(os.getcwd(), '.cache'))
+        JsonLoader.set_cache(self._config_cache)
+        self._bot_config = BotConfig(config_file, self._config_cache)
+        # Engines sharing a process are told apart by their workspace name (logger, prefs directory)
+        self._workspace = self._bot_config.get_option('engine', 'workspace', None)
+        if self._workspace is None and runtime is not None and config_file is not None:
+            self._workspace = os.path.splitext(os.path.basename(config_file))[0]
+        prefs_dir = os.path.join(os.getcwd(), '.prefs')
+        if self._workspace is not None:
+            prefs_dir = os.path.join(prefs_dir, self._workspace)
+        if not os.path.exists(prefs_dir):
+            # Backends open their files in the prefs directory
+            os.makedirs(prefs_dir)
+        prefs_backend = self._bot_config.get_option('prefs', 'backend', BotPrefs.BACKEND_JSON).lower()
+        self._bot_prefs = BotPrefs(prefs_dir, BotPrefs.create_backend(prefs_backend, prefs_dir, self._bot_config))
+        self._bot_info = {}
+        self._slack_client = None
+        self._gateway = None
+        self._capture = None
         self._mod_list = []
+        self._routing = None
+        self._running_handlers = {}
+        self._running_handler_seq = 0
+        self._handler_lock = Lock()
+        self._reload_lock = Lock()
+        self._watcher = None
         self._stop_event = Event()
-        self._response_lock = RLock()
 
         # Initialize logger
         self.__init_logger()
@@ -257,19 +318,64 @@ class BotEngine:
         self.__load_config()
 
         self.get_logger().info('================= STARTING BOT ===================')
+        if prefs_backend not in BotPrefs.BACKENDS:
+            self.get_logger().warning('Unknown prefs backend "%s", using %s' % (prefs_backend, BotPrefs.BACKEND_JSON))
+
+        # Timers are fired by a single scheduler thread on a bounded worker pool,
+        # message handlers run on their own pool. Both are shared by the engines of a runtime.
+        self._owns_runtime = runtime is None
+        if runtime is None:
+            runtime = BotRuntime.from_config(self.get_config(), self._config_cache, self.get_logger())
+        self._runtime = runtime
+        self._runtime.start()
+        self._workers = runtime.get_workers()
+        self._scheduler = runtime.get_scheduler()
+        self._handlers = runtime.get_handlers()
+        # Module downloads share the keep-alive connections of the runtime
+        UrlUtils.set_transport(runtime.get_http())
+        self.__init_metrics()
+
+        # Messages of one channel are handled in order
+        self._lanes = BotSerialLanes(self._handlers)
+        self._handler_timeout = self.get_config().get_float_option('engine', 'handler_timeout',
+                                                                   BotEngine.HANDLER_TIMEOUT)
+        self._scheduler.call_every(1, self.check_handlers, owner=self)
+
+        # Prefs are written behind, pending changes are flushed periodically and on stop
+        self._bot_prefs.start(self._scheduler,
+                              self.get_config().get_float_option('prefs', 'flush_interval', BotPrefs.FLUSH_INTERVAL),
+                              self.get_config().get_int_option('prefs', 'flush_changes', BotPrefs.FLUSH_CHANGES))
 
         # Initialize user list
         self.__init_user_list()
 
         # Initialize member list, channel list ...
         self.__init_slack_client()
-        self.refresh_member_list()
-        self.refresh_channel_list()
-
-        info = self.get_config().get_timeout('refresh_channel_history')
-        if info is None:
-            info = BotEngine.REFRESH_CHANNEL_HISTORY_TIMEOUT
-        self._refresh_channel_history_timeout = info
+        self._directory = BotDirectory(self.__api_call, self.BOT_NAME, self._bot_info, self.get_logger(),
+                                       self.get_config().get_int_option('engine', 'directory_page_size',
+                                                                        BotDirectory.PAGE_SIZE))
+        self._channel_info = TTLCache(
+            self.get_config().get_int_option('cache', 'channel_info_size', BotEngine.CHANNEL_INFO_CACHE_SIZE),
+            self.get_config().get_float_option('cache', 'channel_info_ttl', BotEngine.CHANNEL_INFO_CACHE_TTL),
+            self._runtime.get_clock())
+        # Kinds outlive the channel information, bounded the same way
+        self._channel_kinds = TTLCache(
+            self.get_config().get_int_option('cache', 'channel_info_size', BotEngine.CHANNEL_INFO_CACHE_SIZE),
+            BotEngine.CHANNEL_KIND_TTL, self._runtime.get_clock())
+
+        # Warm start: the directory is restored from the last snapshot and revalidated in background,
+        # otherwise startup waits for the directory to be loaded
+        self.__init_snapshot()
+        if self.__restore_snapshot():
+            if self._slack_client is not None:
+                self._workers.submit(self.__revalidate_directory)
+        else:
+            self.refresh_member_list()
+            self.refresh_channel_list()
+        self._mention_tokens = MentionTokens(self._bot_info.get(BotEngine.KEY_NAME),
+                                             self._bot_info.get(BotEngine.KEY_ID))
+        self._history = BotHistory(self.__api_call, self.get_channel_kind, self.get_logger(),
+                                   self.get_config().get_int_option('history', 'capacity', BotHistory.CAPACITY))
 
     def __load_config(self):
         val = self.get_config().get_timeout('engine_post_delay')
@@ -279,22 +385,183 @@ class BotEngine:
         if val is not None:
             self._refresh_time = int(val)
 
+        mode = self.get_config().get_option('engine', 'ingestion_mode', BotEngine.INGESTION_POLLING).lower()
+        if mode not in (BotEngine.INGESTION_POLLING, BotEngine.INGESTION_EVENT):
+            mode = BotEngine.INGESTION_POLLING
+        self._ingestion_mode = mode
+        self._rtm_wait_timeout = self.get_config().get_float_option('engine', 'rtm_wait_timeout', self._refresh_time)
+
+        config = self.get_config()
+        self._outbound = OutboundScheduler(
+            *self.__get_outbound_rates(),
+            channel_capacity=config.get_int_option('outbound', 'queue_capacity', BotEngine.CHANNEL_QUEUE_CAPACITY),
+            drop_policy=config.get_option('outbound', 'drop_policy', ResponseQueue.DROP_OLDEST).lower())
+
         self._prefs = self.get_prefs().load_prefs(BotEngine.PREFS_NAME)
         if self._prefs is None:
             self._prefs = {BotEngine.KEY_LAST_RESPONSE: 0}
 
+    def __init_snapshot(self):
+        config = self.get_config()
+        max_age = config.get_float_option('snapshot', 'max_age', BotSnapshot.MAX_AGE)
+        # A replay starts from the replayed directory events only, never from the state of a previous run
+        if max_age <= 0 or self._runtime.is_virtual():
+            self._snapshot = None
+            return
+        file_name = config.get_option('snapshot', 'file', None)
+        if file_name is None:
+            file_name = os.path.join(os.getcwd(), '.cache', '%s.snapshot' % (self._workspace or BotEngine.PREFS_NAME))
+        self._snapshot = BotSnapshot(file_name, max_age)
+        interval = config.get_float_option('snapshot', 'interval', BotEngine.SNAPSHOT_INTERVAL)
+        if interval > 0:
+            self._scheduler.call_every(interval, self.save_snapshot, owner=self)
+
+    def __get_token_id(self):
+        # Snapshots are only restored by the workspace which wrote them, the token itself is not saved
+        token = self.get_config().get_api_token()
+        return hashlib.sha1(token).hexdigest() if token is not None else None
+
+    def save_snapshot(self, with_outbound=False):
+        """
+        Checkpoint the directory, the channel information cache and (on stop) the outbound queue
+        :param with_outbound: True to save the queued responses, only done once the sender has stopped
+        so they cannot be sent twice
+        :return: size of the snapshot file, 0 if not saved
+        """
+        if self._snapshot is None or BotEngine.KEY_ID not in self._bot_info:
+            return 0
+        users, channels = self._directory.export()
+        state = {
+            'token_id': self.__get_token_id(),
+            'users': users,
+            'channels': channels,
+            'channel_info': self._channel_info.export(),
+            'channel_kinds': dict((channel_id, kind) for channel_id, _, kind in self._channel_kinds.export()),
+            'outbound': self._outbound.get_pending() if with_outbound else []
+        }
+        size = self._snapshot.save(state)
+        if size == 0:
+            self.get_logger().warning('Snapshot: failed to write %s' % self._snapshot.get_path())
+        return size
+
+    def __restore_snapshot(self):
+        """
+        Restore the engine state from the snapshot
+        :return: True if restored, False otherwise
+        """
+        if self._snapshot is None:
+            return False
+        loaded = self._snapshot.load()
+        # Queued responses must not be sent again if the bot does not stop cleanly next time
+        self._snapshot.discard()
+        if loaded is None:
+            return False
+        state, age = loaded
+        if state.get('token_id') != self.__get_token_id():
+            return False
+        try:
+            self._directory.restore(state['users'], state['channels'])
+            self._channel_info.restore(state['channel_info'])
+            for channel_id, kind in state['channel_kinds'].iteritems():
+                self._channel_kinds.put(channel_id, kind)
+            for response, priority in state['outbound']:
+                self._outbound.push(response, priority)
+        except (KeyError, TypeError, ValueError):
+            self.get_logger().warning('Snapshot: invalid state, loading the directory')
+            return False
+        if BotEngine.KEY_ID not in self._bot_info:
+            return False
+        self.get_logger().info('Snapshot: state of %d seconds ago restored, %d responses queued' %
+                               (age, len(state['outbound'])))
+        return True
+
+    def __revalidate_directory(self):
+        self.refresh_member_list()
+        self.refresh_channel_list()
+        # The bot may have been renamed meanwhile
+        self._mention_tokens = MentionTokens(self._bot_info.get(BotEngine.KEY_NAME),
+                                             self._bot_info.get(BotEngine.KEY_ID))
+        self.get_logger().info('Snapshot: directory revalidated')
+
+    def __get_outbound_rates(self):
+        """
+        Get the outbound rate limits from the config
+        :return: (channel rate, channel burst, workspace rate, workspace burst) tuple
+        """
+        # Per-channel rate defaults to the legacy post delay, which used to be global
+        config = self.get_config()
+        post_delay = config.get_timeout('engine_post_delay')
+        post_delay = int(post_delay) if post_delay is not None else self._post_delay
+        return (config.get_float_option('outbound', 'channel_rate', 1.0 / max(post_delay, 1)),
+                config.get_int_option('outbound', 'channel_burst', 1),
+                config.get_float_option('outbound', 'workspace_rate', BotEngine.WORKSPACE_POST_RATE),
+                config.get_int_option('outbound', 'workspace_burst', BotEngine.WORKSPACE_POST_BURST))
+
+    def __init_metrics(self):
+        """
+        Register the metrics of the engine, labelled with the workspace name
+        :return: None
+        """
+        metrics = self._runtime.get_metrics()
+        self._metrics_workspace = self._workspace or ''
+        self._handler_metric = metrics.histogram('bot_handler_seconds', 'Running time of the module handlers',
+                                                 ('workspace', 'module', 'handler'))
+        self._event_metric = metrics.counter('bot_events_total', 'RTM events received', ('workspace', 'type'))
+        self._send_metric = metrics.histogram('bot_send_seconds', 'Duration of the API calls sending responses',
+                                              ('workspace', 'method'))
+        self._delay_metric = metrics.histogram('bot_response_delay_seconds',
+                                               'Time from queuing a response to sending it', ('workspace',))
+        self._response_metric = metrics.counter('bot_responses_total', 'Responses sent, requeued or dropped',
+                                                ('workspace', 'result'))
+        metrics.add_collector(self.__collect_metrics, owner=self)
+
+    def __collect_metrics(self):
+        metrics = self._runtime.get_metrics()
+        workspace = self._metrics_workspace
+        stats = self.get_queue_stats()
+        depth = metrics.gauge('bot_outbound_depth', 'Responses waiting to be sent', ('workspace', 'priority'))
+        for priority, value in enumerate(stats['depth_by_priority']):
+            depth.set((workspace, priority), value)
+        for name in ('enqueued', 'dequeued', 'dropped'):
+            counter = metrics.counter('bot_outbound_%s_total' % name, 'Responses %s by the outbound queue' % name,
+                                      ('workspace', 'priority'))
+            for priority, value in enumerate(stats[name]):
+                counter.set((workspace, priority), value)
+        for method, counters in self.get_api_stats().iteritems():
+            for name in ('calls', 'failures', 'retries', 'throttled', 'paced'):
+                metrics.counter('bot_api_%s_total' % name, 'Web API %s' % name,
+                                ('workspace', 'method')).set((workspace, method), counters[name])
+        stats = self._bot_prefs.get_stats()
+        for name in ('writes', 'failed_writes', 'coalesced', 'flushes'):
+            metrics.counter('bot_prefs_%s_total' % name, 'Prefs %s' % name.replace('_', ' '),
+                            ('workspace',)).set((workspace,), stats[name])
+        metrics.counter('bot_prefs_flush_seconds_total', 'Time spent flushing the prefs',
+                        ('workspace',)).set((workspace,), stats['flush_time'])
+        metrics.gauge('bot_prefs_last_flush_seconds', 'Duration of the last prefs flush',
+                      ('workspace',)).set((workspace,), stats['last_flush_time'])
+        metrics.gauge('bot_prefs_dirty_namespaces', 'Prefs namespaces waiting to be written',
+                      ('workspace',)).set((workspace,), stats['dirty'])
+        with self._handler_lock:
+            running = len(self._running_handlers)
+        metrics.gauge('bot_running_handlers', 'Module handlers running', ('workspace',)).set((workspace,), running)
+
     def __init_logger(self):
         logger_config_file = self.get_config().get_path('logger_config_file')
         parsed_from_file = False
         if logger_config_file is not None:
             try:
-                logging.config.fileConfig(logger_config_file)
+                # Keep the loggers of the engines created before
+                logging.config.fileConfig(logger_config_file, disable_existing_loggers=False)
                 parsed_from_file = True
             except ConfigParser.Error as err:
                 print err.message
                 parsed_from_file = False
 
-        self._logger = logging.getLogger(self._logger_name)
+        if self._workspace is None:
+            self._logger = logging.getLogger(self._logger_name)
+        else:
+            # Child of the bot logger, shares its handlers
+            self._logger = logging.getLogger('%s.%s' % (self._logger_name, self._workspace))
         if not parsed_from_file:
             # No config file found, setup default logger config
             self._logger.setLevel(logging.DEBUG)
@@ -316,65 +583,39 @@ class BotEngine:
             self._user_list = User.parse_user_list(user_config_path)
 
     def __init_slack_client(self):
-        if self._slack_client is None and not self.get_config().should_be_offline():
+        # A replay (virtual clock runtime) never connects to Slack
+        if self._slack_client is None and not self.get_config().should_be_offline() and not self._runtime.is_virtual():
             self._slack_client = SlackClient(self.get_config().get_api_token())
+            # Web API calls go through the rate limit aware gateway, on the keep-alive connections of the runtime
+            self._gateway = SlackGateway(
+                self._runtime.get_http(), self.get_config().get_api_token(), self.get_logger(),
+                self.get_config().get_int_option('gateway', 'max_retries', SlackGateway.MAX_RETRIES),
+                self.get_config().get_float_option('gateway', 'max_wait', SlackGateway.MAX_WAIT),
+                self.get_config().get_float_option('gateway', 'backoff', SlackGateway.BACKOFF))
+
+    def __api_call(self, method, **kwargs):
+        """
+        Call a Slack Web API method through the gateway
+        :param method: API method name
+        :param kwargs: method arguments, None values are left out
+        :return: decoded response, {'ok': False, 'error': ...} if the call failed, None when offline
+        """
+        if self._gateway is None:
+            return None
+        return self._gateway.call(method, **kwargs)
 
     def refresh_member_list(self):
         if self._slack_client is None:
             return
-        api_call = self._slack_client.api_call("users.list")
-        if api_call is not None and api_call.get('ok'):
-            # Retrieve all users so we can find our bot
-            users = api_call.get('members')
-            for user in users:
-                if 'name' in user and 'id' in user:
-                    user_id = user['id']
-                    user_name = user['name']
-                    if user_name == self.BOT_NAME:
-                        self._bot_info[BotEngine.KEY_NAME] = user_name.encode('utf-8')
-                        self._bot_info[BotEngine.KEY_ID] = user_id.encode('utf-8')
-                        self._bot_info[BotEngine.KEY_RAW] = user
-                        self.get_logger().debug('Bot name = %s, ID = %s' % (user_name, user_id))
-                    else:
-                        member = {
-                            BotEngine.KEY_NAME: user_name.encode('utf-8'),
-                            BotEngine.KEY_ID: user_id.encode('utf-8'),
-                            'raw': user}
-                        self._member_list[user_id] = member
-                        self._member_list_name[user_name] = member
-                        self.get_logger().debug('Member name = %s, ID = %s' % (user_name, user_id))
+        self._directory.load_members()
+        if BotEngine.KEY_ID in self._bot_info:
+            self.get_logger().debug('Bot name = %s, ID = %s' % (self._bot_info[BotEngine.KEY_NAME],
+                                                                self._bot_info[BotEngine.KEY_ID]))
 
     def refresh_channel_list(self):
         if self._slack_client is None:
             return
-        api_call = self._slack_client.api_call("channels.list")
-        if api_call is not None and api_call.get('ok'):
-            channels = api_call.get('channels')
-            for channel in channels:
-                if 'id' not in channel or 'name' not in channel:
-                    continue
-                chan = {
-                    BotEngine.KEY_NAME: channel['name'].encode('utf-8'),
-                    BotEngine.KEY_ID: channel['id'].encode('utf-8'),
-                    BotEngine.KEY_RAW: channel
-                }
-                self._channel_list[chan[BotEngine.KEY_ID]] = chan
-                self._channel_list_name[chan[BotEngine.KEY_NAME]] = chan
-                self.get_logger().debug('Channel name = %s, ID = %s' % (chan['name'], chan['id']))
-        api_call = self._slack_client.api_call("groups.list")
-        if api_call is not None and api_call.get('ok'):
-            channels = api_call.get('groups')
-            for channel in channels:
-                if 'id' not in channel or 'name' not in channel:
-                    continue
-                chan = {
-                    BotEngine.KEY_NAME: channel['name'].encode('utf-8'),
-                    BotEngine.KEY_ID: channel['id'].encode('utf-8'),
-                    BotEngine.KEY_RAW: channel
-                }
-                self._channel_list[chan[BotEngine.KEY_ID]] = chan
-                self._channel_list_name[chan[BotEngine.KEY_NAME]] = chan
-                self.get_logger().debug('Channel name = %s, ID = %s' % (chan['name'], chan['id']))
+        self._directory.load_channels()
 
     def get_user_list(self):
         # Get user list
@@ -390,6 +631,9 @@ class BotEngine:
     def get_prefs(self):
         return self._bot_prefs
 
+    def get_config_cache(self):
+        return self._config_cache
+
     def register_mod(self, mod):
         """
         Register a bot module
@@ -399,6 +643,7 @@ class BotEngine:
         if mod is None or issubclass(mod, BotBaseMod):
             return False
         self._mod_list.append(mod)
+        self._routing = None
 
     def get_logger(self):
         # Get logger object
@@ -409,7 +654,8 @@ class BotEngine:
         return self._bot_info
 
     def get_member_list(self):
-        return self._member_list
+        # Read-only view, the directory publishes a new dictionary on every change
+        return self._directory.get_snapshot().members
 
     def get_member_by_id(self, member_id):
         """
@@ -417,9 +663,9 @@ class BotEngine:
         :param member_id: ID of member to check
         :return: a tuple of member object and user object representing the member
         """
-        if member_id is None or member_id not in self._member_list:
+        member = self._directory.get_snapshot().members.get(member_id) if member_id is not None else None
+        if member is None:
             return None, None
-        member = self._member_list[member_id]
         if self._user_list is not None and member[BotEngine.KEY_NAME] in self._user_list:
             user = self._user_list[member[BotEngine.KEY_NAME]]
         else:
@@ -427,166 +673,226 @@ class BotEngine:
         return member, user
 
     def get_member_by_name(self, member_name):
-        if member_name is None or member_name not in self._member_list_name:
+        member = self._directory.get_snapshot().members_by_name.get(member_name) if member_name is not None else None
+        if member is None:
             return None, None
-        member = self._member_list_name[member_name]
         if self._user_list is not None and member_name in self._user_list:
             user = self._user_list[member_name]
         else:
             user = None
         return member, user
 
-    def query_channel_info_by_id(self, channel_id, force=False):
-        if channel_id is None:
-            return None
-        if channel_id in self._channel_info and not force:
-            return self._channel_info[channel_id]
-
+    def get_channel_kind(self, channel_id):
+        """
+        Get the kind of a channel, as remembered from the last channel info query or guessed from the ID prefix
+        :param channel_id: channel ID
+        :return: CHANNEL_KIND_CHANNEL, CHANNEL_KIND_GROUP or CHANNEL_KIND_IM
+        """
+        kind = self._channel_kinds.get(channel_id)
+        if kind is not None:
+            return kind
+        if channel_id.startswith('G'):
+            return BotEngine.CHANNEL_KIND_GROUP
+        if channel_id.startswith('D'):
+            return BotEngine.CHANNEL_KIND_IM
+        return BotEngine.CHANNEL_KIND_CHANNEL
+
+    def __load_channel_info(self, channel_id):
+        """
+        Fetch the information of a channel, trying the remembered channel kind first
+        :param channel_id: channel ID
+        :return: channel information, None if not found
+        """
         if self._slack_client is None:
             return None
-        is_group = False
-        chan_info = self._slack_client.api_call("channels.info", channel=channel_id)
-        if chan_info is None or not chan_info.get('ok'):
-            chan_info = self._slack_client.api_call("groups.info", channel=channel_id)
-            is_group = True
-        if chan_info is not None and chan_info.get('ok'):
-            the_channel = chan_info.get('group' if is_group else 'channel')
-            self._channel_info[channel_id] = the_channel
-            self._channel_info_name[the_channel[BotEngine.KEY_NAME]] = the_channel
-            return self._channel_info[channel_id]
-        else:
+        kind = self.get_channel_kind(channel_id)
+        kinds = [kind] + [k for k in (BotEngine.CHANNEL_KIND_CHANNEL, BotEngine.CHANNEL_KIND_GROUP) if k != kind]
+        for kind in kinds:
+            chan_info = self.__api_call(kind + 's.info', channel=channel_id)
+            if chan_info is not None and chan_info.get('ok') and kind in chan_info:
+                self._channel_kinds.put(channel_id, kind)
+                return chan_info[kind]
+        return None
+
+    def query_channel_info_by_id(self, channel_id, force=False):
+        """
+        Get channel information, cached for channel_info_ttl seconds
+        :param channel_id: channel ID
+        :param force: True to bypass the cache
+        :return: channel information, None if not found
+        """
+        if channel_id is None:
             return None
+        return self._channel_info.get_or_load(channel_id, self.__load_channel_info, force)
 
     def query_channel_info_by_name(self, channel_name, force=False):
         if channel_name is None:
             return None
-        if channel_name in self._channel_info_name and not force:
-            return self._channel_info_name[channel_name]
-        if self._slack_client is None:
-            return None
-        if channel_name not in self._channel_list_name:
-            return None
-        channel_id = self._channel_list_name[channel_name]['id']
-
-        is_group = False
-        chan_info = self._slack_client.api_call("channels.info", channel=channel_id)
-        if chan_info is None or not chan_info.get('ok'):
-            chan_info = self._slack_client.api_call("groups.info", channel=channel_id)
-            is_group = True
-        if chan_info is not None and chan_info.get('ok'):
-            the_channel = chan_info.get('group' if is_group else 'channel')
-            self._channel_info[channel_id] = the_channel
-            self._channel_info_name[the_channel[BotEngine.KEY_NAME]] = the_channel
-            return self._channel_info[channel_id]
-        else:
+        chan = self.get_channel_by_name(channel_name)
+        if chan is None:
             return None
+        return self.query_channel_info_by_id(chan[BotEngine.KEY_ID], force)
+
+    def get_channel_info_stats(self):
+        return self._channel_info.get_stats()
 
     def get_channel_by_id(self, channel_id):
-        if channel_id is None or channel_id not in self._channel_list:
+        if channel_id is None:
             return None
-        return self._channel_list[channel_id]
+        return self._directory.get_snapshot().channels.get(channel_id)
 
     def get_channel_by_name(self, channel_name):
-        if channel_name is None or channel_name not in self._channel_list_name:
+        if channel_name is None:
             return None
-        return self._channel_list_name[channel_name]
+        return self._directory.get_snapshot().channels_by_name.get(channel_name)
+
+    def get_directory(self):
+        return self._directory
 
     def query_channel_history_by_name(self, channel_name, force=False, **kwargs):
         """
-        Get channel message history by channel name
+        Get channel message history by channel name, served from the history kept from RTM events
         :param channel_name: channel name to query information 
-        :param force: force refresh channel history
+        :param force: force backfilling the channel history from the server
+        :param kwargs: count, latest, oldest and inclusive, as for the Slack history methods
         :return: channel history
         """
-        need_refresh = False
         if channel_name is None or channel_name == '':
             return None
 
-        if channel_name not in self._channel_list_name:
+        chan = self.get_channel_by_name(channel_name)
+        if chan is None:
             return None
-        channel_id = self._channel_info_name[channel_name]['id']
+        channel_id = chan[BotEngine.KEY_ID]
 
         if force:
-            need_refresh = True
-        else:
-            if channel_id in self._channel_history:
-                last_refresh = self._channel_history[channel_id][BotEngine.KEY_LAST_REFRESH]
-                if time.time() - last_refresh > self._refresh_channel_history_timeout:
-                    need_refresh = True
-            else:
-                need_refresh = True
-        if not need_refresh:
-            return self._channel_history[channel_id][BotEngine.KEY_HISTORY]
+            self._history.invalidate(channel_id)
+        return self._history.get_history(channel_id, **kwargs)
 
-        if self._slack_client is None:
-            return None
-        result = self._slack_client.api_call('channels.history', channel=channel_id, **kwargs)
-        if result is not None and result.get('ok'):
-            self._channel_history[channel_id][BotEngine.KEY_HISTORY] = result
-            self._channel_history[channel_id][BotEngine.KEY_LAST_REFRESH] = time.time()
-            return result
-        else:
-            return None
+    def get_history(self):
+        return self._history
 
     @staticmethod
     def on_timer(bot_core, timer_obj, timer_id):
-        timer_obj.on_timer(timer_id, bot_core)
+        bot_core.call_handler(timer_obj, timer_obj.on_timer, [timer_id, bot_core])
 
     def register_timer(self, timer_obj, timer_id, timer_interval):
+        """
+        Register an interval timer, timer_obj.on_timer is called every timer_interval seconds
+        :param timer_obj: BotTimer object
+        :param timer_id: timer identifier passed to on_timer
+        :param timer_interval: interval in seconds
+        :return: timer handle, None if error
+        """
         if timer_id is None or timer_obj is None:
-            return
+            return None
         interval = timer_interval if timer_interval > 0 else 1
-        t = BotThread(interval, self._stop_event, BotEngine.on_timer, args=[self, timer_obj, timer_id])
-        t.start()
+        return self._scheduler.call_every(interval, BotEngine.on_timer, [self, timer_obj, timer_id], owner=timer_obj)
+
+    def cancel_timers(self, timer_obj):
+        """
+        Cancel all the timers registered by an object
+        :param timer_obj: BotTimer object
+        :return: number of cancelled timers
+        """
+        return self._scheduler.cancel_owner(timer_obj)
+
+    def get_scheduler(self):
+        return self._scheduler
+
+    def get_workers(self):
+        return self._workers
+
+    def get_runtime(self):
+        return self._runtime
 
-    def queue_response(self, response):
-        if response is not None:
-            with self._response_lock:
-                self._response_queue.append(response)
+    def get_fetch_cache(self):
+        """
+        Get the cache of the data fetched by modules, shared by all the engines of the runtime
+        :return: TTLCache object
+        """
+        return self._runtime.get_fetch_cache()
+
+    def get_workspace(self):
+        return self._workspace
+
+    def now(self):
+        """
+        Get the current time, modules read it instead of the system clock so that a replay runs at the captured time
+        :return: timestamp
+        """
+        return self._runtime.time()
+
+    def localtime(self):
+        """
+        Get the current local time, see now
+        :return: struct_time object
+        """
+        return time.localtime(self._runtime.time())
+
+    def queue_response(self, response, priority=PRIORITY_BROADCAST):
+        """
+        Queue a response to be sent
+        :param response: the response
+        :param priority: PRIORITY_REPLY for direct replies, PRIORITY_BROADCAST for scheduled messages
+        :return: None
+        """
+        if response is not None and self._capture is not None:
+            self._capture(response, priority)
+            return
+        if not response:
+            # An empty response only tells that the message has been handled
+            return
+        # The queue owns a copy, the caller may keep using its response
+        response = self.__stamp(response, priority)
+        if not self._outbound.push(response, priority):
+            self.get_logger().warning('Response to %s dropped' % response.get(BotEngine.KEY_CHANNEL_ID))
 
     def insert_top_response(self, response):
-        if response is not None:
-            with self._response_lock:
-                self._response_queue.insert(0, response)
+        if response is not None and self._capture is not None:
+            self._capture(response, BotEngine.PRIORITY_REPLY)
+        elif response:
+            self._outbound.push(self.__stamp(response, BotEngine.PRIORITY_REPLY), BotEngine.PRIORITY_REPLY, front=True)
 
-    def __preprocess_msg(self, msg):
-        the_msg = {'raw': msg}
-        # Try tokenizing the message
-        if 'type' in msg and msg['type'] == 'message' and 'subtype' not in msg and 'channel' in msg:
-            the_msg[BotEngine.KEY_IS_MESSAGE] = True
-            the_msg[BotEngine.KEY_CHANNEL_ID] = msg['channel'].encode('utf-8')
-            chan = self.get_channel_by_id(the_msg[BotEngine.KEY_CHANNEL_ID])
-            if chan is not None:
-                if not self.get_config().is_channel_enabled(chan['name']):
-                    return
-                the_msg[BotEngine.KEY_CHANNEL_NAME] = chan['name']
-            bot_mentioned = False
-            if 'user' in msg:
-                user_id = msg['user'].encode('utf-8')
-                the_msg[BotEngine.KEY_FROM_USER_ID] = user_id
-                the_user, _ = self.get_member_by_id(user_id)
-                if the_user is not None:
-                    the_msg[BotEngine.KEY_FROM_USER_NAME] = the_user[BotEngine.KEY_NAME]
-            if 'text' in msg:
-                # Pre-process text content
-                the_msg[BotEngine.KEY_RAW_WORDS] = [s.encode('utf-8') for s in msg['text'].split()]
-                the_msg[BotEngine.KEY_STANDARDIZED_TEXT] = ' '.join(the_msg[BotEngine.KEY_RAW_WORDS])
-                the_msg[BotEngine.KEY_LOWER_WORDS] = [s.encode('utf-8').lower() for s in msg['text'].split()]
-                the_msg[BotEngine.KEY_STANDARDIZED_LOWER_TEXT] = ' '.join(the_msg[BotEngine.KEY_LOWER_WORDS])
-                for word in the_msg[BotEngine.KEY_LOWER_WORDS]:
-                    if word == '<@' + self._bot_info['name'] + '>' or word == self._bot_info['name']:
-                        bot_mentioned = True
-                        break
-                if not bot_mentioned:
-                    for word in the_msg[BotEngine.KEY_RAW_WORDS]:
-                        if word == '<@' + self._bot_info['id'] + '>':
-                            bot_mentioned = True
-                            break
-            the_msg[BotEngine.KEY_IS_BOT_MENTIONED] = bot_mentioned
-        else:
-            the_msg[BotEngine.KEY_IS_MESSAGE] = False
+    def __stamp(self, response, priority):
+        response = dict(response)
+        response[BotEngine.KEY_QUEUED_AT] = self.now()
+        response[BotEngine.KEY_PRIORITY] = priority
+        return response
 
-        return the_msg
+    def get_queue_stats(self):
+        return self._outbound.get_stats()
+
+    def get_api_stats(self):
+        """
+        Get the per-method counters of the Web API calls
+        :return: dictionary of method name: counters, see SlackGateway.get_stats
+        """
+        return self._gateway.get_stats() if self._gateway is not None else {}
+
+    def get_http_stats(self):
+        """
+        Get the counters of the HTTP transport shared by the engines of the runtime
+        :return: dictionary of counters, see BotHttp.get_stats
+        """
+        return self._runtime.get_http().get_stats()
+
+    def __get_member_name(self, member_id):
+        member, _ = self.get_member_by_id(member_id)
+        return member[BotEngine.KEY_NAME] if member is not None else None
+
+    def __preprocess_msg(self, msg):
+        if msg.get('type') != 'message' or 'subtype' in msg or 'channel' not in msg:
+            return BotMessage(msg)
+        channel_id = msg['channel'].encode('utf-8')
+        channel_name = None
+        chan = self.get_channel_by_id(channel_id)
+        if chan is not None:
+            if not self.get_config().is_channel_enabled(chan['name']):
+                return None
+            channel_name = chan['name']
+        user_id = msg['user'].encode('utf-8') if 'user' in msg else None
+        return BotMessage(msg, channel_id, channel_name, user_id, self.__get_member_name, self._mention_tokens)
 
     def __response(self, response):
         if response is None:
@@ -600,12 +906,9 @@ class BotEngine:
 
         channel = response[BotEngine.KEY_CHANNEL_ID]
 
-        if BotEngine.KEY_LAST_RESPONSE in self._prefs:
-            last_response = self._prefs[BotEngine.KEY_LAST_RESPONSE]
-        else:
-            last_response = 0
-        if self._slack_client is None or time.time() - last_response < self._post_delay:
+        if self._slack_client is None:
             return response
+        started = time.time()
         if response_type == BotEngine.KEY_UPLOAD_RESPONSE:
             if BotEngine.KEY_TEXT in response:
                 content = response[BotEngine.KEY_TEXT]
@@ -631,13 +934,14 @@ class BotEngine:
                 title = response[BotEngine.KEY_TITLE]
             else:
                 return None
-            self._slack_client.api_call('files.upload',
-                                        channels=channel,
-                                        content=content,
-                                        filetype=file_type,
-                                        filename=file_name,
-                                        title=title,
-                                        initial_comment=comment)
+            method = 'files.upload'
+            result = self.__api_call(method,
+                                     channels=channel,
+                                     content=content,
+                                     filetype=file_type,
+                                     filename=file_name,
+                                     title=title,
+                                     initial_comment=comment)
         else:
             if BotEngine.KEY_ATTACHMENTS in response:
                 attachments = response[BotEngine.KEY_ATTACHMENTS]
@@ -648,27 +952,252 @@ class BotEngine:
                 text = response[BotEngine.KEY_TEXT]
             else:
                 return None
-            self._slack_client.api_call('chat.postMessage',
-                                        channel=channel,
-                                        text=text,
-                                        as_user=True,
-                                        parse='full',
-                                        attachments=attachments,
-                                        link_names=True)
-        self._prefs[BotEngine.KEY_LAST_RESPONSE] = time.time()
+            method = 'chat.postMessage'
+            result = self.__api_call(method,
+                                     channel=channel,
+                                     text=text,
+                                     as_user=True,
+                                     parse='full',
+                                     attachments=attachments,
+                                     link_names=True)
+        self._send_metric.observe((self._metrics_workspace, method), time.time() - started)
+        if self.__check_sent(method, response, result):
+            self._prefs[BotEngine.KEY_LAST_RESPONSE] = self.now()
         return None
 
-    def __process_msg(self, msg):
-        the_msg = self.__preprocess_msg(msg)
-        if the_msg is None:
-            return
+    def __check_sent(self, method, response, result):
+        """
+        Requeue a response that Slack has not processed (rate limited, or failed before the request was sent).
+        Other failures are not retried: the request may have been posted, e.g. timed out waiting for the answer.
+        :param method: API method used to send the response
+        :param response: the response
+        :param result: result of the API call
+        :return: True if the response has been sent
+        """
+        if result is not None and result.get('ok'):
+            self._response_metric.inc((self._metrics_workspace, 'sent'))
+            if BotEngine.KEY_QUEUED_AT in response:
+                self._delay_metric.observe((self._metrics_workspace,),
+                                           time.time() - response[BotEngine.KEY_QUEUED_AT])
+            return True
+        error = result.get('error') if result is not None else None
+        if SlackGateway.is_unsent(result):
+            attempts = response.get(BotEngine.KEY_SEND_ATTEMPTS, 0) + 1
+            if attempts < BotEngine.MAX_SEND_ATTEMPTS:
+                response[BotEngine.KEY_SEND_ATTEMPTS] = attempts
+                # Back at the front of its own priority class, a broadcast does not get ahead of the replies
+                self._outbound.push(response, response.get(BotEngine.KEY_PRIORITY, BotEngine.PRIORITY_REPLY),
+                                    front=True)
+                self._response_metric.inc((self._metrics_workspace, 'requeued'))
+                # Sending is paused while the method is rate limited
+                self._stop_event.wait(result.get('retry_after', 0))
+                return False
+        self._response_metric.inc((self._metrics_workspace, 'dropped'))
+        self.get_logger().warning('%s: response to %s dropped (%s)' % (method, response[BotEngine.KEY_CHANNEL_ID],
+                                                                      error))
+        return False
+
+    def __get_mod_config_file(self, mod):
+        # Module configs are declared in [paths] as <module name>_config_file
+        return self.get_config().get_path('%s_config_file' % mod.get_mod_name())
+
+    def __watch_config_files(self):
+        self._watcher.watch(self.get_config().get_config_file())
+        self._watcher.watch(self.get_config().get_path('user_config_file'))
         for mod in self._mod_list:
-            response = mod.on_message(self, the_msg)
+            self._watcher.watch(self.__get_mod_config_file(mod))
+
+    def start_config_watch(self):
+        """
+        Poll the config files and reload the changed ones, [reload] interval=0 disables it
+        :return: True if started, False otherwise
+        """
+        interval = self.get_config().get_float_option('reload', 'interval', BotEngine.RELOAD_INTERVAL)
+        if interval <= 0 or self._watcher is not None:
+            return False
+        self._watcher = ConfigWatcher()
+        self.__watch_config_files()
+        self._scheduler.call_every(interval, self.check_config_files, owner=self)
+        return True
+
+    def check_config_files(self):
+        """
+        Reload what depends on the config files changed since the previous check
+        :return: number of changed files
+        """
+        with self._reload_lock:
+            changed = set(self._watcher.poll())
+            if len(changed) == 0:
+                return 0
+            old_config = self.get_config()
+            reload_mods = [mod for mod in self._mod_list if self.__get_mod_config_file(mod) in changed]
+            reload_users = old_config.get_path('user_config_file') in changed
+            if old_config.get_config_file() in changed:
+                new_config = self.reload_config()
+                if new_config is not None:
+                    # Modules and user list pointing to other files are reloaded too
+                    for mod in self._mod_list:
+                        if (mod not in reload_mods and
+                                self.__get_mod_config_file(mod) != old_config.get_path(
+                                    '%s_config_file' % mod.get_mod_name())):
+                            reload_mods.append(mod)
+                    reload_users = reload_users or (new_config.get_path('user_config_file') !=
+                                                    old_config.get_path('user_config_file'))
+                    self.__watch_config_files()
+            if reload_users:
+                self.__init_user_list()
+                self.get_logger().info('Config: user list reloaded')
+            for mod in reload_mods:
+                self.reload_mod(mod)
+            return len(changed)
+
+    def reload_config(self):
+        """
+        Parse bot.conf again and apply the options that can change while running.
+        Modules, RTM session and queued responses are kept.
+        :return: the new BotConfig object, None if the file could not be read
+        """
+        old_config = self.get_config()
+        if not os.path.exists(old_config.get_config_file()):
+            self.get_logger().error('Config: %s not found, keeping the current config' %
+                                    old_config.get_config_file())
+            return None
+        new_config = BotConfig(old_config.get_config_file(), self._config_cache)
+        if (new_config.get_api_token() != old_config.get_api_token() or
+                new_config.should_be_offline() != old_config.should_be_offline()):
+            self.get_logger().warning('Config: API settings changed, restart needed')
+        for section, name in BotEngine.RESTART_OPTIONS:
+            if new_config.get_option(section, name) != old_config.get_option(section, name):
+                self.get_logger().warning('Config: [%s] %s changed, restart needed' % (section, name))
+        for mod in self._mod_list:
+            if new_config.is_module_disabled(mod.get_mod_name()) != old_config.is_module_disabled(mod.get_mod_name()):
+                self.get_logger().warning('Config: module %s enabled/disabled, restart needed' % mod.get_mod_name())
+
+        self._bot_config = new_config
+        self._rtm_wait_timeout = new_config.get_float_option('engine', 'rtm_wait_timeout', self._refresh_time)
+        self._handler_timeout = new_config.get_float_option('engine', 'handler_timeout', BotEngine.HANDLER_TIMEOUT)
+        self._outbound.set_rates(*self.__get_outbound_rates())
+        self.get_logger().info('Config: %s reloaded' % new_config.get_config_file())
+        return new_config
+
+    def reload_mod(self, mod):
+        """
+        Replace a module by a new instance initialized from its current config.
+        The old instance is kept if the new one fails to initialize.
+        :param mod: the registered module
+        :return: the new module, None if errors occurred
+        """
+        new_mod = type(mod)()
+        try:
+            new_mod.on_registered(self)
+        except Exception as e:
+            self.cancel_timers(new_mod)
+            self.get_logger().error('Config: failed to reload module %s, keeping the running one: %s' %
+                                    (mod.get_mod_name(), e), exc_info=not isinstance(e, ConfigError))
+            return None
+        mods = list(self._mod_list)
+        if mod not in mods:
+            self.cancel_timers(new_mod)
+            return None
+        mods[mods.index(mod)] = new_mod
+        self._mod_list = mods
+        # New messages are routed to the new instance, handlers of the old one already running complete
+        self.compile_triggers()
+        self.cancel_timers(mod)
+        self.get_logger().info('Config: module %s reloaded' % new_mod.get_mod_name())
+        return new_mod
+
+    def compile_triggers(self):
+        """
+        Compile the triggers declared by the registered modules into the routing index
+        :return: the trigger index
+        """
+        mods = tuple(self._mod_list)
+        index = TriggerIndex()
+        for mod_index, mod in enumerate(mods):
+            index.add(mod_index, mod.get_triggers())
+        index.compile()
+        self._routing = (mods, index)
+        return self._routing
+
+    def __route_msg(self, the_msg):
+        routing = self._routing
+        if routing is None:
+            routing = self.compile_triggers()
+        mods, index = routing
+        mod_indexes, matches = index.route(the_msg)
+        the_msg[BotEngine.KEY_TRIGGERS] = matches
+        return [mods[i] for i in mod_indexes]
+
+    @staticmethod
+    def __handler_name(obj):
+        try:
+            return obj.get_mod_name()
+        except AttributeError:
+            return type(obj).__name__
+
+    def call_handler(self, obj, func, args):
+        """
+        Call a module handler, keeping track of its running time (timeout and bot_handler_seconds metric)
+        :param obj: the module (or timer object) owning the handler
+        :param func: the handler
+        :param args: list of arguments of the handler
+        :return: the handler result
+        """
+        name = BotEngine.__handler_name(obj)
+        timeout = self.get_config().get_float_option('handler_timeouts', name, self._handler_timeout)
+        started = time.time()
+        entry = [started + timeout, name, func.__name__, self._lanes.current()]
+        with self._handler_lock:
+            self._running_handler_seq += 1
+            key = self._running_handler_seq
+            self._running_handlers[key] = entry
+        try:
+            return func(*args)
+        finally:
+            self._handler_metric.observe((self._metrics_workspace, name, func.__name__), time.time() - started)
+            with self._handler_lock:
+                del self._running_handlers[key]
+
+    def check_handlers(self):
+        """
+        Report handlers running longer than their timeout.
+        The channel of an overdue message handler is released so the next messages do not wait for it,
+        its response (if any) is still queued once it finishes.
+        :return: None
+        """
+        now = time.time()
+        overdue = []
+        with self._handler_lock:
+            for entry in self._running_handlers.values():
+                if entry[0] <= now:
+                    overdue.append(list(entry))
+                    entry[0] = float('inf')  # Report only once
+        for _, name, func_name, lane in overdue:
+            self.get_logger().warning('[%s] %s exceeded its timeout' % (name, func_name))
+            if lane is not None:
+                self._lanes.detach(*lane)
+
+    def __dispatch_msg(self, the_msg, mods):
+        for mod in mods:
+            response = self.call_handler(mod, mod.on_message, [self, the_msg])
             if response is not None:
                 # One of the module has response
-                self.insert_top_response(response)
+                self.queue_response(response, BotEngine.PRIORITY_REPLY)
                 return
 
+    def __process_msg(self, msg):
+        self._event_metric.inc((self._metrics_workspace, msg.get('type')))
+        if msg.get('type') in BotDirectory.EVENTS:
+            self._directory.apply_event(msg)
+        self._history.on_event(msg)
+        the_msg = self.__preprocess_msg(msg)
+        if the_msg is None:
+            return
+        mods = self.__route_msg(the_msg)
+        if len(mods) > 0:
+            self._lanes.submit(the_msg.get(BotEngine.KEY_CHANNEL_ID), self.__dispatch_msg, [the_msg, mods])
+
     @staticmethod
     def replace_text(original_text, subs_dict):
         """
@@ -691,28 +1220,89 @@ class BotEngine:
     def on_check_messages(self, is_offline_mode):
         try:
             if not is_offline_mode:
-                msg_list = self._slack_client.rtm_read()
-                if msg_list is not None and len(msg_list) > 0:
-                    for msg in msg_list:
-                        self.__process_msg(msg)
-
-                        # Then send queued response
-            if not is_offline_mode:
-                not_processed_list = []
-                with self._response_lock:
-                    for response in self._response_queue:
-                        result = self.__response(response)
-                        if result is not None:
-                            not_processed_list.append(result)
-                    self._response_queue = not_processed_list
+                self.__read_messages()
         except:
             self.get_logger().exception('Exception on BotEngine.on_check_messages')
             raise
 
+    def __read_messages(self):
+        msg_list = self._slack_client.rtm_read()
+        if msg_list is not None and len(msg_list) > 0:
+            for msg in msg_list:
+                self.__process_msg(msg)
+
+    def send_loop(self):
+        """
+        Send queued responses as soon as their channel and workspace rate limits allow
+        :return: None
+        """
+        while not self._stop_event.is_set():
+            response = self._outbound.pop(self._refresh_time)
+            if response is None:
+                continue
+            try:
+                self.__response(response)
+            except Exception:
+                self.get_logger().exception('Exception on BotEngine.send_loop')
+
+    def __wait_for_events(self, timeout):
+        """
+        Block until the RTM websocket has pending data or the timeout expires
+        :param timeout: maximum time to wait (in seconds)
+        :return: None
+        """
+        try:
+            sock = self._slack_client.server.websocket.sock
+        except AttributeError:
+            sock = None
+        if sock is None:
+            # Not connected (yet), just wait for the auto-reconnect of the next read
+            self._stop_event.wait(timeout)
+            return
+        if hasattr(sock, 'pending') and sock.pending() > 0:
+            # Data already decrypted and buffered by the SSL layer
+            return
+        try:
+            select.select([sock], [], [], timeout)
+        except (select.error, socket.error, ValueError):
+            self._stop_event.wait(timeout)
+
+    def event_loop(self):
+        """
+        Event-driven ingestion: dispatch RTM events as soon as they arrive on the websocket
+        :return: None
+        """
+        while not self._stop_event.is_set():
+            self.__wait_for_events(self._rtm_wait_timeout)
+            if self._stop_event.is_set():
+                break
+            self.on_check_messages(False)
+
+    def start_replay(self, capture):
+        """
+        Prepare the engine to replay recorded RTM events (see replay_event) instead of running
+        :param capture: function called with (response, priority) for each response instead of sending it
+        :return: None
+        """
+        self._capture = capture
+        self.compile_triggers()
+        # The bot member may come from the replayed directory events
+        self._mention_tokens = MentionTokens(self._bot_info.get(BotEngine.KEY_NAME),
+                                             self._bot_info.get(BotEngine.KEY_ID))
+        self.get_logger().info('Slack Bot running in REPLAY mode')
+
+    def replay_event(self, msg):
+        """
+        Process a recorded RTM event as if it had just been read
+        :param msg: the RTM event
+        :return: None
+        """
+        self.__process_msg(msg)
+
     def run(self):
         """
         Execute the main bot thread
-        :return: None
+        :return: True if the bot is running, False if it failed to start
         """
         is_offline_mode = self.get_config().should_be_offline()
         if is_offline_mode:
@@ -720,11 +1310,47 @@ class BotEngine:
         else:
             if self._slack_client is None:
                 self.get_logger().critical('Failed to interfacing with API server!')
-                return
+                return False
             if not self._slack_client.rtm_connect():
                 self.get_logger().critical('Failed to start the bot client!')
-                return
+                return False
             self.get_logger().info('Slack Bot CONNECTED to server')
 
-        t = BotThread(self._refresh_time, self._stop_event, BotEngine.main_timer_event, args=[self, is_offline_mode])
-        t.start()
+        self.compile_triggers()
+        self.start_config_watch()
+
+        if self._ingestion_mode == BotEngine.INGESTION_EVENT and not is_offline_mode:
+            self.get_logger().info('Slack Bot ingesting RTM events in EVENT mode')
+            t = Thread(target=self.event_loop, name='BotEventLoop')
+            t.start()
+        else:
+            self._scheduler.call_every(self._refresh_time, BotEngine.main_timer_event, [self, is_offline_mode],
+                                       owner=self)
+
+        if not is_offline_mode:
+            sender = Thread(target=self.send_loop, name='BotSender')
+            sender.start()
+        return True
+
+    def stop(self):
+        """
+        Stop the bot threads
+        :return: None
+        """
+        self._stop_event.set()
+        self._outbound.close()
+        self.save_snapshot(with_outbound=True)
+        if self._owns_runtime:
+            self._runtime.stop()
+        else:
+            # The runtime keeps running for the other engines
+            self._scheduler.cancel_owner(self)
+            for mod in self._mod_list:
+                self._scheduler.cancel_owner(mod)
+            self._runtime.get_metrics().remove_collectors(self)
+        self._bot_prefs.close()
+        self.get_logger().info('Slack Bot STOPPED, prefs: %s, http: %s' % (self._bot_prefs.get_stats(),
+                                                                          self.get_http_stats()))
+
+    def is_running(self):
+        return not self._stop_event.is_set()
@@ -0,0 +1,213 @@
+import json
+import logging
+import random
+import time
+from threading import Lock
+from BotOutbound import TokenBucket
+from BotHttp import RequestNotSent
+
+
+class SlackGateway(object):
+    """
+    Slack Web API front end aware of the rate limits.
+    Calls are paced per method after the Slack method tiers, a 429 response (or a "ratelimited" error)
+    blocks the method for the Retry-After delay. Idempotent reads are retried with jittered exponential
+    backoff, writes are never sent twice: the caller gets an error result and may requeue them when
+    is_unsent tells the request never reached Slack.
+    Results always are dictionaries, failures are reported the Slack way: {'ok': False, 'error': ...}
+    """
+    API_URL = 'https://slack.com/api/'
+    # Requests per minute and burst size of the Slack tiers
+    TIERS = {1: (1, 1), 2: (20, 5), 3: (50, 10), 4: (100, 20)}
+    DEFAULT_TIER = 3
+    # Methods without a tier (chat.postMessage) are paced by the outbound scheduler
+    METHOD_TIERS = {
+        'users.list': 2, 'channels.list': 2, 'groups.list': 2, 'im.list': 2, 'conversations.list': 2,
+        'files.upload': 2,
+        'channels.info': 3, 'groups.info': 3, 'conversations.info': 3,
+        'channels.history': 3, 'groups.history': 3, 'im.history': 3, 'mpim.history': 3,
+        'conversations.history': 3,
+        'chat.postMessage': None,
+    }
+    READ_SUFFIXES = ('.list', '.info', '.history')
+    ERROR_RATE_LIMITED = 'ratelimited'
+    ERROR_REQUEST_FAILED = 'request_failed'
+    ERROR_NOT_SENT = 'request_not_sent'
+    # Errors worth sending the same request again
+    TRANSIENT_ERRORS = (ERROR_RATE_LIMITED, ERROR_REQUEST_FAILED, ERROR_NOT_SENT, 'internal_error', 'fatal_error',
+                        'service_unavailable', 'request_timeout')
+    # Errors of requests Slack has not processed, writes can be sent again without duplicating them
+    UNSENT_ERRORS = (ERROR_RATE_LIMITED, ERROR_NOT_SENT)
+    MAX_RETRIES = 3
+    MAX_WAIT = 30  # in seconds
+    BACKOFF = 1  # in seconds
+    RETRY_AFTER = 1  # in seconds, when the 429 response has no Retry-After header
+
+    def __init__(self, http, token, logger=None, max_retries=MAX_RETRIES, max_wait=MAX_WAIT, backoff=BACKOFF):
+        """
+        :param http: BotHttp transport
+        :param token: Slack API token
+        :param logger: logger of the throttled calls, None for the bot logger
+        :param max_retries: number of retries of the idempotent reads
+        :param max_wait: longest pause of a read waiting for its method to be allowed again (in seconds)
+        :param backoff: base delay of the retries, doubled on each attempt (in seconds)
+        """
+        self._http = http
+        self._token = token
+        self._logger = logger if logger is not None else logging.getLogger('CacCuBot')
+        self._max_retries = max_retries
+        self._max_wait = max_wait
+        self._backoff = backoff
+        self._buckets = {}
+        self._blocked_until = {}
+        self._counters = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def is_idempotent(method):
+        return method.endswith(SlackGateway.READ_SUFFIXES)
+
+    @staticmethod
+    def is_transient(result):
+        """
+        Check whether a failed call can be sent again later
+        :param result: call result
+        :return: True if the failure is transient
+        """
+        return result is not None and not result.get('ok') and result.get('error') in SlackGateway.TRANSIENT_ERRORS
+
+    @staticmethod
+    def is_unsent(result):
+        """
+        Check whether a failed call has not been processed by Slack, so that a write can be sent again
+        :param result: call result
+        :return: True if the call was rate limited or failed before the request was sent
+        """
+        return result is not None and not result.get('ok') and result.get('error') in SlackGateway.UNSENT_ERRORS
+
+    @staticmethod
+    def __encode(kwargs):
+        fields = {}
+        for name, value in kwargs.iteritems():
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            elif isinstance(value, (list, dict)):
+                value = json.dumps(value)
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            fields[name] = value
+        return fields
+
+    def __count(self, method, name):
+        # Must be called with the lock held
+        counters = self._counters.get(method)
+        if counters is None:
+            counters = {'calls': 0, 'throttled': 0, 'retries': 0, 'failures': 0, 'paced': 0}
+            self._counters[method] = counters
+        counters[name] += 1
+
+    def __ready_at(self, method, now):
+        """
+        Take a pacing token of the method if it is allowed now
+        :return: time at which the method is allowed, "now" if the call can be sent right away
+        """
+        with self._lock:
+            ready_at = self._blocked_until.get(method, 0)
+            tier = SlackGateway.METHOD_TIERS.get(method, SlackGateway.DEFAULT_TIER)
+            if tier is not None:
+                bucket = self._buckets.get(method)
+                if bucket is None:
+                    per_minute, burst = SlackGateway.TIERS[tier]
+                    bucket = TokenBucket(per_minute / 60.0, burst, now)
+                    self._buckets[method] = bucket
+                ready_at = max(ready_at, bucket.ready_at(now))
+                if ready_at <= now:
+                    bucket.consume(now)
+            if ready_at > now:
+                self.__count(method, 'paced')
+            return ready_at
+
+    def __throttle(self, method, response):
+        try:
+            retry_after = float(response.headers.get('retry-after', SlackGateway.RETRY_AFTER))
+        except ValueError:
+            retry_after = SlackGateway.RETRY_AFTER
+        with self._lock:
+            self._blocked_until[method] = max(self._blocked_until.get(method, 0), time.time() + retry_after)
+            self.__count(method, 'throttled')
+        self._logger.warning('%s: rate limited, retry after %.1f seconds' % (method, retry_after))
+        return retry_after
+
+    def __send(self, method, fields):
+        """
+        Send one request
+        :return: call result
+        """
+        headers = {'Authorization': 'Bearer %s' % self._token}
+        try:
+            response = self._http.post_form(SlackGateway.API_URL + method, fields, headers,
+                                            idempotent=SlackGateway.is_idempotent(method))
+        except RequestNotSent as e:
+            self._logger.warning('%s: API call not sent: %s' % (method, e))
+            return {'ok': False, 'error': SlackGateway.ERROR_NOT_SENT}
+        except IOError as e:
+            self._logger.warning('%s: API call failed: %s' % (method, e))
+            return {'ok': False, 'error': SlackGateway.ERROR_REQUEST_FAILED}
+        if response.status == 429:
+            return {'ok': False, 'error': SlackGateway.ERROR_RATE_LIMITED,
+                    'retry_after': self.__throttle(method, response)}
+        try:
+            result = json.loads(response.body)
+        except ValueError:
+            result = None
+        if not isinstance(result, dict):
+            error = 'service_unavailable' if response.status >= 500 else 'invalid_response'
+            return {'ok': False, 'error': error}
+        if result.get('error') == SlackGateway.ERROR_RATE_LIMITED:
+            result['retry_after'] = self.__throttle(method, response)
+        return result
+
+    def call(self, method, **kwargs):
+        """
+        Call a Web API method
+        :param method: API method name
+        :param kwargs: method arguments, None values are left out
+        :return: decoded response; on failure {'ok': False, 'error': ...}, with 'retry_after' (in seconds)
+            when the method is rate limited
+        """
+        fields = SlackGateway.__encode(kwargs)
+        retries = self._max_retries if SlackGateway.is_idempotent(method) else 0
+        with self._lock:
+            self.__count(method, 'calls')
+        attempt = 0
+        while True:
+            now = time.time()
+            ready_at = self.__ready_at(method, now)
+            if ready_at > now:
+                if retries == 0 or ready_at - now > self._max_wait:
+                    # Writes are not delayed here, the caller requeues them
+                    result = {'ok': False, 'error': SlackGateway.ERROR_RATE_LIMITED, 'retry_after': ready_at - now}
+                    break
+                time.sleep(ready_at - now)
+                continue
+            result = self.__send(method, fields)
+            if result.get('ok') or not SlackGateway.is_transient(result) or attempt >= retries:
+                break
+            attempt += 1
+            with self._lock:
+                self.__count(method, 'retries')
+            if result.get('error') != SlackGateway.ERROR_RATE_LIMITED:
+                # Rate limited calls wait for their method to be allowed again, other failures back off
+                time.sleep(random.uniform(0, self._backoff * (2 ** attempt)))
+        if not result.get('ok'):
+            with self._lock:
+                self.__count(method, 'failures')
+        return result
+
+    def get_stats(self):
+        """
+        Get the counters of the called methods
+        :return: dictionary of method name: {calls, throttled, retries, failures, paced}
+        """
+        with self._lock:
+            return dict((method, dict(counters)) for method, counters in self._counters.iteritems())
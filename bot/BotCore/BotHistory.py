@@ -0,0 +1,245 @@
+from collections import deque
+from threading import Lock
+
+
+class ChannelHistory(object):
+    """
+    Ring buffer of the latest messages of one channel, oldest first
+    """
+
+    def __init__(self, capacity):
+        self.messages = deque(maxlen=capacity)
+        self.last_ts = None  # ts of the newest message, as a string
+        self.synced = False  # False until the channel has been (back)filled from the Web API
+        self.gap_start = None  # ts of the newest message before the gap to backfill, None to fetch the latest ones
+        self.backfill_lock = Lock()
+
+
+class BotHistory(object):
+    """
+    Per-channel message history fed from RTM message events, kept only for the channels read at least once.
+    The Web API is only used to fill a channel on first read, and to backfill the gap left by a reconnection
+    (fetching only the messages newer than the last one received).
+    """
+    KEY_TS = 'ts'
+    KEY_MESSAGES = 'messages'
+    KEY_HAS_MORE = 'has_more'
+
+    CAPACITY = 200
+    MAX_FETCH_COUNT = 1000  # Slack limit of the history methods
+    DEFAULT_COUNT = 100  # Slack default of the history methods
+    HIDDEN_SUBTYPES = frozenset(['message_changed', 'message_deleted', 'message_replied'])
+
+    def __init__(self, api_call, channel_kind, logger, capacity=CAPACITY):
+        """
+        :param api_call: function performing Slack Web API calls, same signature as SlackClient.api_call
+        :param channel_kind: function returning the kind of a channel ID ('channel', 'group' or 'im')
+        :param logger: logger object
+        :param capacity: maximum number of messages kept per channel
+        """
+        self._api_call = api_call
+        self._channel_kind = channel_kind
+        self._logger = logger
+        self._capacity = capacity if capacity > 0 else 1
+        self._channels = {}
+        self._lock = Lock()
+        self._fetches = 0
+
+    def __get_channel(self, channel_id):
+        # Must be called with the lock held
+        chan = self._channels.get(channel_id)
+        if chan is None:
+            chan = ChannelHistory(self._capacity)
+            self._channels[channel_id] = chan
+        return chan
+
+    @staticmethod
+    def __ts(message):
+        try:
+            return float(message.get(BotHistory.KEY_TS))
+        except (TypeError, ValueError):
+            return None
+
+    def on_event(self, event):
+        """
+        Update the history from a RTM event
+        :param event: the RTM event
+        :return: None
+        """
+        event_type = event.get('type')
+        if event_type == 'hello':
+            # (Re)connected: messages posted while disconnected have to be backfilled
+            with self._lock:
+                for chan in self._channels.values():
+                    self.__mark_gap(chan)
+            return
+        if event_type != 'message' or 'channel' not in event:
+            return
+        subtype = event.get('subtype')
+        with self._lock:
+            chan = self._channels.get(event['channel'])
+            if chan is None:
+                # Never read, the first read fills it from the Web API
+                return
+            if subtype == 'message_changed':
+                self.__replace(chan, event.get('message'))
+            elif subtype == 'message_deleted':
+                self.__delete(chan, event.get('deleted_ts'))
+            elif subtype not in BotHistory.HIDDEN_SUBTYPES and BotHistory.KEY_TS in event:
+                self.__append(chan, event)
+
+    @staticmethod
+    def __mark_gap(chan):
+        # Must be called with the lock held, an older gap not backfilled yet is kept
+        if chan.synced:
+            chan.synced = False
+            chan.gap_start = chan.last_ts
+
+    @staticmethod
+    def __append(chan, message):
+        ts = BotHistory.__ts(message)
+        if ts is None:
+            return
+        if chan.last_ts is None or ts > float(chan.last_ts):
+            chan.messages.append(message)
+            chan.last_ts = message[BotHistory.KEY_TS]
+            return
+        # Delivered out of order, inserted at its place unless already there
+        newer = []
+        while len(chan.messages) > 0:
+            last = BotHistory.__ts(chan.messages[-1])
+            if last == ts:
+                break
+            if last < ts:
+                chan.messages.append(message)
+                break
+            newer.append(chan.messages.pop())
+        else:
+            chan.messages.append(message)
+        # The oldest message falls off a full buffer
+        chan.messages.extend(reversed(newer))
+
+    @staticmethod
+    def __replace(chan, message):
+        if not isinstance(message, dict) or BotHistory.KEY_TS not in message:
+            return
+        ts = message[BotHistory.KEY_TS]
+        # Edited messages are usually recent ones, search from the end
+        for i in range(len(chan.messages) - 1, -1, -1):
+            if chan.messages[i].get(BotHistory.KEY_TS) == ts:
+                chan.messages[i] = message
+                return
+
+    @staticmethod
+    def __delete(chan, ts):
+        if ts is None:
+            return
+        for i in range(len(chan.messages) - 1, -1, -1):
+            if chan.messages[i].get(BotHistory.KEY_TS) == ts:
+                del chan.messages[i]
+                return
+
+    def __fetch(self, channel_id, oldest):
+        """
+        Fetch the messages newer than oldest (or the latest ones if None)
+        :param channel_id: channel ID
+        :param oldest: ts of the oldest message to exclude, None to fetch the latest messages
+        :return: list of messages (newest first), None on failure
+        """
+        method = self._channel_kind(channel_id) + 's.history'
+        if method == 'ims.history':
+            method = 'im.history'
+        messages = []
+        latest = None
+        while len(messages) < self._capacity:
+            kwargs = {'channel': channel_id, 'count': min(self._capacity - len(messages), BotHistory.MAX_FETCH_COUNT)}
+            if oldest is not None:
+                kwargs['oldest'] = oldest
+            if latest is not None:
+                kwargs['latest'] = latest
+            result = self._api_call(method, **kwargs)
+            self._fetches += 1
+            if result is None or not result.get('ok'):
+                self._logger.warning('%s: failed to fetch history of %s' % (method, channel_id))
+                return None if len(messages) == 0 else messages
+            page = result.get(BotHistory.KEY_MESSAGES) or []
+            messages.extend(page)
+            if oldest is None or not result.get(BotHistory.KEY_HAS_MORE) or len(page) == 0:
+                # Without oldest, only the latest messages are needed
+                break
+            latest = page[-1].get(BotHistory.KEY_TS)
+        return messages
+
+    def __backfill(self, channel_id, chan):
+        with chan.backfill_lock:
+            with self._lock:
+                if chan.synced:
+                    return True
+                oldest = chan.gap_start
+            fetched = self.__fetch(channel_id, oldest)
+            if fetched is None:
+                return False
+            with self._lock:
+                # Merge with the messages received from RTM in the meantime
+                merged = {}
+                for message in fetched:
+                    if BotHistory.KEY_TS in message and message.get('subtype') not in BotHistory.HIDDEN_SUBTYPES:
+                        merged[message[BotHistory.KEY_TS]] = message
+                for message in chan.messages:
+                    merged[message[BotHistory.KEY_TS]] = message
+                ordered = sorted(merged.values(), key=BotHistory.__ts)
+                chan.messages.clear()
+                chan.messages.extend(ordered)
+                if len(ordered) > 0:
+                    chan.last_ts = ordered[-1][BotHistory.KEY_TS]
+                chan.synced = True
+                chan.gap_start = None
+            self._logger.info('History: %d messages backfilled for %s' % (len(fetched), channel_id))
+            return True
+
+    def invalidate(self, channel_id):
+        with self._lock:
+            chan = self._channels.get(channel_id)
+            if chan is not None:
+                self.__mark_gap(chan)
+
+    def get_history(self, channel_id, count=DEFAULT_COUNT, latest=None, oldest=None, inclusive=False):
+        """
+        Get the latest messages of a channel, in the same shape as the Slack history methods
+        :param channel_id: channel ID
+        :param count: maximum number of messages
+        :param latest: only messages older than this ts
+        :param oldest: only messages newer than this ts
+        :param inclusive: include messages with latest or oldest ts
+        :return: dictionary with the messages (newest first), None if the channel could not be filled
+        """
+        with self._lock:
+            chan = self.__get_channel(channel_id)
+            synced = chan.synced
+        if not synced and not self.__backfill(channel_id, chan) and len(chan.messages) == 0:
+            return None
+        latest = float(latest) if latest is not None else None
+        oldest = float(oldest) if oldest is not None else None
+        count = int(count)
+        messages = []
+        has_more = False
+        with self._lock:
+            for message in reversed(chan.messages):
+                ts = BotHistory.__ts(message)
+                if latest is not None and (ts > latest or (ts == latest and not inclusive)):
+                    continue
+                if oldest is not None and (ts < oldest or (ts == oldest and not inclusive)):
+                    break
+                if len(messages) >= count:
+                    has_more = True
+                    break
+                messages.append(message)
+        return {'ok': True, BotHistory.KEY_MESSAGES: messages, BotHistory.KEY_HAS_MORE: has_more}
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'channels': len(self._channels),
+                'messages': sum(len(chan.messages) for chan in self._channels.values()),
+                'fetches': self._fetches
+            }
@@ -0,0 +1,309 @@
+import httplib
+import select
+import socket
+import ssl
+import time
+import urllib
+import urlparse
+import zlib
+from threading import Lock
+
+
+def _is_timeout(error):
+    # SSL sockets of some Python 2 versions report timeouts as SSLError
+    return isinstance(error, socket.timeout) or 'timed out' in str(error)
+
+
+def _is_dropped(conn):
+    """
+    Check whether the server closed an idle connection: the socket of an idle connection is only readable
+    once the server has closed it (or sent unexpected data)
+    """
+    if conn.sock is None:
+        return True
+    try:
+        return len(select.select([conn.sock], [], [], 0)[0]) > 0
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class RequestNotSent(IOError):
+    """
+    The request failed before it was sent (connection or write failure), sending it again cannot duplicate it
+    """
+    pass
+
+
+class HttpResponse(object):
+    """
+    Fully read HTTP response, the connection is back in its pool once the response exists
+    """
+    def __init__(self, status, headers, body):
+        """
+        :param status: HTTP status code
+        :param headers: dictionary of the response headers, names in lower case
+        :param body: decoded response body
+        """
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def ok(self):
+        return 200 <= self.status < 300
+
+
+class BotHttp(object):
+    """
+    HTTP transport keeping idle connections alive in one pool per host, so that consecutive
+    requests to the same host (Slack Web API calls, module fetches) skip the TCP and TLS handshakes.
+    Responses are requested gzip-compressed and decoded transparently.
+    A request failing on a reused connection is sent again on a fresh one only if it cannot have been
+    processed twice: it was not written, or it is idempotent and the server closed the connection without
+    answering. Timeouts are never retried.
+    """
+    POOL_SIZE = 4
+    TIMEOUT = 10  # in seconds
+    IDLE_TIMEOUT = 60  # in seconds
+    MAX_REDIRECTS = 5
+    USER_AGENT = 'CacCuBot'
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, pool_size=POOL_SIZE, timeout=TIMEOUT, idle_timeout=IDLE_TIMEOUT):
+        """
+        :param pool_size: maximum number of idle connections kept per host
+        :param timeout: default socket timeout of the requests (in seconds)
+        :param idle_timeout: idle connections older than this are closed instead of reused (in seconds)
+        """
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._idle_timeout = idle_timeout
+        self._pools = {}
+        self._ssl_context = None
+        self._lock = Lock()
+        self._stats = {'requests': 0, 'connections': 0, 'reused': 0, 'retries': 0, 'errors': 0, 'gzip': 0}
+
+    def __count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def __acquire(self, key, timeout):
+        """
+        Take an idle connection of the pool or open a new one
+        :return: (connection, reused) tuple
+        """
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            pool = self._pools.get(key)
+            while pool:
+                candidate, released_at = pool.pop()
+                if now - released_at <= self._idle_timeout and not _is_dropped(candidate):
+                    conn = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            self.__count('reused')
+            return conn, True
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, port, timeout=timeout, context=self.__get_ssl_context())
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=timeout)
+        self.__count('connections')
+        return conn, False
+
+    def __get_ssl_context(self):
+        # Loading the CA certificates costs more than the TLS handshake on small hosts, it is done once
+        with self._lock:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return self._ssl_context
+
+    def __release(self, key, conn):
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self._pool_size:
+                pool.append((conn, time.time()))
+                return
+        conn.close()
+
+    def __send(self, key, method, path, body, headers, timeout, idempotent):
+        conn, reused = self.__acquire(key, timeout)
+        try:
+            return self.__exchange(key, conn, method, path, body, headers)
+        except RequestNotSent:
+            if not reused:
+                raise
+        except (httplib.BadStatusLine, socket.error) as e:
+            # The request was written: it may have been processed unless the server closed the connection
+            # without answering, and even then only idempotent requests are sent again
+            if not reused or not idempotent or _is_timeout(e):
+                raise
+        # The server closed the idle connection in the meantime, the other idle ones of the host
+        # are likely closed as well: drop them and try once more on a fresh connection
+        self.__count('retries')
+        with self._lock:
+            stale = [idle for idle, _ in self._pools.pop(key, [])]
+        for idle in stale:
+            idle.close()
+        conn, _ = self.__acquire(key, timeout)
+        return self.__exchange(key, conn, method, path, body, headers)
+
+    def __exchange(self, key, conn, method, path, body, headers):
+        """
+        Send a request and read its response
+        :return: HttpResponse object
+        :raise RequestNotSent: the connection or the write failed (write timeouts excepted)
+        :raise httplib.HTTPException, socket.error: the request failed once written
+        """
+        try:
+            if conn.sock is None:
+                conn.connect()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            raise RequestNotSent('Connection to %s failed: %s' % (key[1], e))
+        try:
+            conn.request(method, path, body, headers)
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            if _is_timeout(e):
+                # Part of the request may have been received
+                raise
+            raise RequestNotSent('Sending to %s failed: %s' % (key[1], e))
+        try:
+            response = conn.getresponse()
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+        return self.__finish(key, conn, response, data)
+
+    def __finish(self, key, conn, response, data):
+        if response.will_close:
+            conn.close()
+        else:
+            self.__release(key, conn)
+        headers = dict((name.lower(), value) for name, value in response.getheaders())
+        if headers.get('content-encoding', '').lower() == 'gzip':
+            try:
+                data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+            except zlib.error:
+                raise IOError('Invalid gzip response')
+            self.__count('gzip')
+        return HttpResponse(response.status, headers, data)
+
+    def request(self, method, url, body=None, headers=None, timeout=None, idempotent=None):
+        """
+        Perform a request on a pooled connection
+        :param method: HTTP method
+        :param url: absolute http or https URL
+        :param body: request body string, None for no body
+        :param headers: dictionary of additional request headers
+        :param timeout: socket timeout (in seconds), None for the default one
+        :param idempotent: True if processing the request twice is harmless, None to decide from the method
+        :return: HttpResponse object
+        :raise RequestNotSent: the request failed before it was sent
+        :raise IOError: the request failed
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise IOError('Unsupported URL: %s' % url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        all_headers = {'Accept-Encoding': 'gzip', 'User-Agent': BotHttp.USER_AGENT}
+        if headers:
+            all_headers.update(headers)
+        if idempotent is None:
+            idempotent = method in BotHttp.IDEMPOTENT_METHODS
+        self.__count('requests')
+        try:
+            return self.__send(key, method, path, body, all_headers, self._timeout if timeout is None else timeout,
+                               idempotent)
+        except httplib.HTTPException as e:
+            self.__count('errors')
+            raise IOError('%s %s: %r' % (method, url, e))
+        except IOError:
+            # socket.error included
+            self.__count('errors')
+            raise
+
+    def get(self, url, headers=None, timeout=None):
+        """
+        GET a URL, following redirects
+        :return: HttpResponse object
+        :raise IOError: the request failed
+        """
+        for _ in range(BotHttp.MAX_REDIRECTS + 1):
+            response = self.request('GET', url, headers=headers, timeout=timeout)
+            location = response.headers.get('location')
+            if response.status not in BotHttp.REDIRECT_STATUSES or not location:
+                return response
+            url = urlparse.urljoin(url, location)
+        raise IOError('Too many redirects: %s' % url)
+
+    def post_form(self, url, fields, headers=None, timeout=None, idempotent=False):
+        """
+        POST url-encoded form fields
+        :param fields: dictionary of string values, None values are left out
+        :param idempotent: True if the POST only reads (a Web API list or info call)
+        :return: HttpResponse object
+        :raise IOError: the request failed
+        """
+        all_headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        if headers:
+            all_headers.update(headers)
+        body = urllib.urlencode([(k, v) for k, v in fields.iteritems() if v is not None])
+        return self.request('POST', url, body, all_headers, timeout, idempotent)
+
+    def get_stats(self):
+        """
+        :return: dictionary of counters: requests, connections (opened), reused, retries, errors, gzip, idle
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = sum(len(pool) for pool in self._pools.itervalues())
+        return stats
+
+    def close(self):
+        """
+        Close the idle connections
+        :return: None
+        """
+        with self._lock:
+            pools = self._pools
+            self._pools = {}
+        for pool in pools.itervalues():
+            for conn, _ in pool:
+                conn.close()
+
+
+class OfflineHttp(BotHttp):
+    """
+    Transport of the offline replay, it never reaches the network: GET requests of the preloaded URLs are answered
+    with their recorded body, any other request fails as if the host was unreachable
+    """
+
+    def __init__(self, bodies=None):
+        """
+        :param bodies: dictionary of URL -> response body string
+        """
+        BotHttp.__init__(self)
+        self._bodies = dict(bodies) if bodies is not None else {}
+
+    def request(self, method, url, body=None, headers=None, timeout=None, idempotent=None):
+        with self._lock:
+            self._stats['requests'] += 1
+            if method == 'GET' and url in self._bodies:
+                return HttpResponse(200, {}, self._bodies[url])
+            self._stats['errors'] += 1
+        raise RequestNotSent('Offline: %s %s' % (method, url))
@@ -0,0 +1,210 @@
+_MISSING = object()
+
+
+class MentionTokens(object):
+    """
+    Words that mention the bot, computed once when the bot identity is known
+    """
+    __slots__ = ('lower_tokens', 'raw_tokens', 'name_hint')
+
+    def __init__(self, bot_name=None, bot_id=None):
+        lower_tokens = set()
+        raw_tokens = set()
+        if bot_name:
+            lower_tokens.add('<@' + bot_name + '>')
+            lower_tokens.add(bot_name)
+        if bot_id:
+            raw_tokens.add('<@' + bot_id + '>')
+        self.lower_tokens = frozenset(lower_tokens)
+        self.raw_tokens = frozenset(raw_tokens)
+        # Every mention token contains either "<@" or the bot name, used to skip tokenizing most messages
+        self.name_hint = bot_name.decode('utf-8').lower() if bot_name else None
+
+    def may_mention(self, text):
+        """
+        Cheap pre-check on the raw text
+        :param text: raw (unicode) message text
+        :return: False if the text cannot contain any mention token
+        """
+        if u'<@' in text:
+            return True
+        return self.name_hint is not None and self.name_hint in text.lower()
+
+
+class BotMessage(object):
+    """
+    Message passed to module handlers.
+    The text is tokenized once and derived fields (words, lower text, bot mention...) are only computed
+    on first access. The object behaves like the dictionary built by former engine versions: a key is
+    only present when the value makes sense for the message.
+    """
+    KEY_RAW = 'raw'
+    KEY_IS_MESSAGE = 'is_message'
+    KEY_CHANNEL_ID = 'channel_id'
+    KEY_CHANNEL_NAME = 'channel_name'
+    KEY_FROM_USER_ID = 'from_user_id'
+    KEY_FROM_USER_NAME = 'from_user_name'
+    KEY_STANDARDIZED_TEXT = 'std_text'
+    KEY_STANDARDIZED_LOWER_TEXT = 'std_lower_text'
+    KEY_RAW_WORDS = 'raw_words'
+    KEY_LOWER_WORDS = 'raw_lower_words'
+    KEY_IS_BOT_MENTIONED = 'is_bot_mentioned'
+
+    __slots__ = ('raw', 'is_message', 'channel_id', 'channel_name', 'from_user_id',
+                 '_member_lookup', '_mention_tokens', '_from_user_name',
+                 '_raw_words', '_std_text', '_std_lower_text', '_lower_words', '_is_bot_mentioned', '_extra')
+
+    def __init__(self, raw, channel_id=None, channel_name=None, from_user_id=None,
+                 member_lookup=None, mention_tokens=None):
+        """
+        :param raw: the raw RTM event
+        :param channel_id: channel ID, None if the event is not a message
+        :param channel_name: channel name, None if unknown
+        :param from_user_id: sender ID, None if unknown
+        :param member_lookup: function returning the member name of a member ID (or None)
+        :param mention_tokens: MentionTokens of the bot
+        """
+        self.raw = raw
+        self.is_message = channel_id is not None
+        self.channel_id = channel_id
+        self.channel_name = channel_name
+        self.from_user_id = from_user_id
+        self._member_lookup = member_lookup
+        self._mention_tokens = mention_tokens
+        self._from_user_name = _MISSING
+        self._raw_words = _MISSING
+        self._std_text = _MISSING
+        self._std_lower_text = _MISSING
+        self._lower_words = _MISSING
+        self._is_bot_mentioned = _MISSING
+        self._extra = None
+
+    def __has_text(self):
+        return self.is_message and 'text' in self.raw
+
+    def __tokenize(self):
+        # Split and encode the text only once, everything else derives from it
+        self._raw_words = [w.encode('utf-8') for w in self.raw['text'].split()]
+        self._std_text = ' '.join(self._raw_words)
+
+    def get_raw_words(self):
+        if self._raw_words is _MISSING:
+            self.__tokenize()
+        return self._raw_words
+
+    def get_std_text(self):
+        if self._std_text is _MISSING:
+            self.__tokenize()
+        return self._std_text
+
+    def get_std_lower_text(self):
+        if self._std_lower_text is _MISSING:
+            self._std_lower_text = self.get_std_text().lower()
+        return self._std_lower_text
+
+    def get_lower_words(self):
+        if self._lower_words is _MISSING:
+            text = self.get_std_lower_text()
+            self._lower_words = text.split(' ') if len(text) > 0 else []
+        return self._lower_words
+
+    def get_from_user_name(self):
+        if self._from_user_name is _MISSING:
+            name = None
+            if self.from_user_id is not None and self._member_lookup is not None:
+                name = self._member_lookup(self.from_user_id)
+            self._from_user_name = name
+        return self._from_user_name
+
+    def is_bot_mentioned(self):
+        if self._is_bot_mentioned is _MISSING:
+            mentioned = False
+            tokens = self._mention_tokens
+            if self.__has_text() and tokens is not None and tokens.may_mention(self.raw['text']):
+                lower_tokens = tokens.lower_tokens
+                raw_tokens = tokens.raw_tokens
+                mentioned = (any(w in lower_tokens for w in self.get_lower_words()) or
+                             any(w in raw_tokens for w in self.get_raw_words()))
+            self._is_bot_mentioned = mentioned
+        return self._is_bot_mentioned
+
+    def __lookup(self, key):
+        """
+        Get the value of a key
+        :param key: the key
+        :return: the value, _MISSING if the key is not present
+        """
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        getter = BotMessage._GETTERS.get(key)
+        if getter is None:
+            return _MISSING
+        return getter(self)
+
+    # Dictionary compatibility
+    def __getitem__(self, key):
+        val = self.__lookup(key)
+        if val is _MISSING:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = value
+
+    def __contains__(self, key):
+        return self.__lookup(key) is not _MISSING
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        val = self.__lookup(key)
+        return default if val is _MISSING else val
+
+    def keys(self):
+        result = [k for k in BotMessage._GETTERS if k in self]
+        if self._extra is not None:
+            result.extend(k for k in self._extra if k not in BotMessage._GETTERS)
+        return result
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return 'BotMessage(%r)' % dict(self.items())
+
+
+def _text_getter(func):
+    # Text derived keys are only present for messages having a text
+    def getter(msg):
+        if not msg.is_message or 'text' not in msg.raw:
+            return _MISSING
+        return func(msg)
+    return getter
+
+
+def _optional(value):
+    return _MISSING if value is None else value
+
+
+BotMessage._GETTERS = {
+    BotMessage.KEY_RAW: lambda msg: msg.raw,
+    BotMessage.KEY_IS_MESSAGE: lambda msg: msg.is_message,
+    BotMessage.KEY_CHANNEL_ID: lambda msg: _optional(msg.channel_id),
+    BotMessage.KEY_CHANNEL_NAME: lambda msg: _optional(msg.channel_name),
+    BotMessage.KEY_FROM_USER_ID: lambda msg: _optional(msg.from_user_id),
+    BotMessage.KEY_FROM_USER_NAME: lambda msg: _optional(msg.get_from_user_name()),
+    BotMessage.KEY_IS_BOT_MENTIONED: lambda msg: msg.is_bot_mentioned() if msg.is_message else _MISSING,
+    BotMessage.KEY_RAW_WORDS: _text_getter(BotMessage.get_raw_words),
+    BotMessage.KEY_STANDARDIZED_TEXT: _text_getter(BotMessage.get_std_text),
+    BotMessage.KEY_LOWER_WORDS: _text_getter(BotMessage.get_lower_words),
+    BotMessage.KEY_STANDARDIZED_LOWER_TEXT: _text_getter(BotMessage.get_std_lower_text),
+}
@@ -0,0 +1,284 @@
+import bisect
+import BaseHTTPServer
+import socket
+from threading import Lock, Thread
+
+
+def _escape(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        # Label values from the config are byte strings, the ones from Slack events are unicode
+        value = value.decode('utf-8', 'replace')
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+class MetricFamily(object):
+    """
+    Metric and its values, one per combination of label values
+    """
+    TYPE = 'untyped'
+
+    def __init__(self, name, help_text, label_names=()):
+        """
+        :param name: metric name
+        :param help_text: description of the metric
+        :param label_names: tuple of label names, values are given in the same order
+        """
+        self._name = name
+        self._help = help_text
+        self._label_names = tuple(label_names)
+        self._values = {}
+        self._lock = Lock()
+
+    def get_name(self):
+        return self._name
+
+    def set(self, labels, value):
+        """
+        Set the value of a metric collected from other counters
+        :param labels: tuple of label values
+        :param value: the value
+        :return: None
+        """
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        """
+        :return: list of (name suffix, label value tuple, extra label pairs, value) tuples
+        """
+        with self._lock:
+            return [('', labels, (), value) for labels, value in sorted(self._values.iteritems())]
+
+    def render(self):
+        """
+        Render the metric in the Prometheus text format
+        :return: list of lines
+        """
+        lines = ['# HELP %s %s' % (self._name, self._help.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE %s %s' % (self._name, self.TYPE)]
+        for suffix, labels, extra, value in self.samples():
+            pairs = zip(self._label_names, labels) + list(extra)
+            if len(pairs) > 0:
+                label_text = '{%s}' % ','.join('%s="%s"' % (name, _escape(label_value))
+                                               for name, label_value in pairs)
+            else:
+                label_text = ''
+            lines.append('%s%s%s %s' % (self._name, suffix, label_text, _format_value(value)))
+        return lines
+
+
+class Counter(MetricFamily):
+    TYPE = 'counter'
+
+    def inc(self, labels=(), value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Gauge(MetricFamily):
+    TYPE = 'gauge'
+
+
+class Histogram(MetricFamily):
+    """
+    Histogram of durations, observations are counted in fixed buckets
+    """
+    TYPE = 'histogram'
+    # Upper bounds of the buckets (in seconds)
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, help_text, label_names=(), buckets=BUCKETS):
+        MetricFamily.__init__(self, name, help_text, label_names)
+        self._buckets = tuple(sorted(buckets))
+
+    def observe(self, labels, value):
+        """
+        Count an observation
+        :param labels: tuple of label values
+        :param value: observed value (in seconds)
+        :return: None
+        """
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Counts of the buckets and of +Inf, sum
+                entry = [[0] * (len(self._buckets) + 1), 0.0]
+                self._values[labels] = entry
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in sorted(self._values.iteritems())]
+        samples = []
+        for labels, counts, total in values:
+            cumulated = 0
+            for bound, count in zip(self._buckets + (float('inf'),), counts):
+                cumulated += count
+                samples.append(('_bucket', labels, (('le', _format_value(bound)),), cumulated))
+            samples.append(('_sum', labels, (), total))
+            samples.append(('_count', labels, (), cumulated))
+        return samples
+
+
+class BotMetrics(object):
+    """
+    Registry of the metrics of the process.
+    Hot path metrics (handler durations, events, sends) are updated as they happen, the others are read
+    from the stats of the components by collectors when the metrics are rendered.
+    """
+
+    def __init__(self):
+        self._families = {}
+        self._collectors = []
+        self._lock = Lock()
+
+    def __get_family(self, family_type, name, help_text, label_names, *args):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = family_type(name, help_text, label_names, *args)
+                self._families[name] = family
+            elif not isinstance(family, family_type):
+                raise ValueError('Metric %s already registered as %s' % (name, family.TYPE))
+            return family
+
+    def counter(self, name, help_text, label_names=()):
+        """
+        Get a counter, registered on first use
+        :return: Counter object
+        """
+        return self.__get_family(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        """
+        Get a gauge, registered on first use
+        :return: Gauge object
+        """
+        return self.__get_family(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(), buckets=Histogram.BUCKETS):
+        """
+        Get a histogram, registered on first use
+        :return: Histogram object
+        """
+        return self.__get_family(Histogram, name, help_text, label_names, buckets)
+
+    def add_collector(self, func, owner=None):
+        """
+        Register a function updating metrics from component stats before each rendering
+        :param func: function without arguments
+        :param owner: object removing the collector with remove_collectors
+        :return: None
+        """
+        with self._lock:
+            self._collectors.append((func, owner))
+
+    def remove_collectors(self, owner):
+        with self._lock:
+            self._collectors = [(func, o) for func, o in self._collectors if o is not owner]
+
+    def render(self, logger=None):
+        """
+        Render all the metrics in the Prometheus text format
+        :param logger: logger of the collector errors
+        :return: UTF-8 encoded string
+        """
+        with self._lock:
+            collectors = list(self._collectors)
+        for func, _ in collectors:
+            try:
+                func()
+            except Exception:
+                if logger is not None:
+                    logger.exception('Exception on metrics collector')
+        with self._lock:
+            families = sorted(self._families.itervalues(), key=MetricFamily.get_name)
+        lines = []
+        for family in families:
+            lines.extend(family.render())
+        text = '\n'.join(lines) + '\n'
+        return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+class MetricsServer(object):
+    """
+    Local HTTP endpoint serving the metrics to a Prometheus scraper on GET /metrics
+    """
+    PATH = '/metrics'
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, metrics, host, port, logger):
+        """
+        :param metrics: BotMetrics object
+        :param host: address to listen on
+        :param port: TCP port
+        :param logger: logger of the errors
+        """
+        self._metrics = metrics
+        self._address = (host, port)
+        self._logger = logger
+        self._server = None
+        self._thread = None
+
+    def __make_handler(self):
+        metrics = self._metrics
+        logger = self._logger
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != MetricsServer.PATH:
+                    self.send_error(404)
+                    return
+                body = metrics.render(logger)
+                self.send_response(200)
+                self.send_header('Content-Type', MetricsServer.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Scrapes are not logged
+                pass
+
+        return MetricsHandler
+
+    def start(self):
+        """
+        Start serving on a background thread
+        :return: True if started, False if the address could not be bound
+        """
+        try:
+            self._server = BaseHTTPServer.HTTPServer(self._address, self.__make_handler())
+        except socket.error as e:
+            self._logger.error('Metrics: failed to listen on %s:%d: %s' % (self._address[0], self._address[1], e))
+            return False
+        self._thread = Thread(target=self._server.serve_forever, name='BotMetrics')
+        self._thread.daemon = True
+        self._thread.start()
+        self._logger.info('Metrics: serving http://%s:%d%s' % (self._server.server_address[0],
+                                                              self._server.server_address[1], MetricsServer.PATH))
+        return True
+
+    def get_port(self):
+        return self._server.server_address[1] if self._server is not None else None
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
@@ -0,0 +1,286 @@
+import heapq
+import itertools
+import time
+from threading import Condition
+from BotQueue import ResponseQueue
+
+
+class TokenBucket(object):
+    """
+    Classic token bucket: holds up to "capacity" tokens, refilled at "rate" tokens per second
+    """
+
+    def __init__(self, rate, capacity, now=None):
+        self._rate = float(rate) if rate > 0 else 1.0
+        self._capacity = float(capacity) if capacity >= 1 else 1.0
+        self._tokens = self._capacity
+        self._last = time.time() if now is None else now
+
+    def __refill(self, now):
+        if now > self._last:
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+
+    def ready_at(self, now):
+        """
+        Get the time at which one token will be available
+        :param now: current time
+        :return: timestamp, "now" if a token is available right away
+        """
+        self.__refill(now)
+        if self._tokens >= 1:
+            return now
+        return now + (1 - self._tokens) / self._rate
+
+    def consume(self, now):
+        """
+        Try taking one token
+        :param now: current time
+        :return: True if a token has been taken, False otherwise
+        """
+        self.__refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def full_at(self, now):
+        """
+        Get the time at which the bucket will be full again
+        :param now: current time
+        :return: timestamp, "now" if the bucket is full
+        """
+        self.__refill(now)
+        return now + (self._capacity - self._tokens) / self._rate
+
+    def set_rate(self, rate, capacity, now):
+        """
+        Change the rate and the capacity, the tokens left are kept
+        :param rate: new rate (tokens per second)
+        :param capacity: new capacity
+        :param now: current time
+        :return: None
+        """
+        self.__refill(now)
+        self._rate = float(rate) if rate > 0 else 1.0
+        self._capacity = float(capacity) if capacity >= 1 else 1.0
+        self._tokens = min(self._tokens, self._capacity)
+
+
+class OutboundScheduler(object):
+    """
+    Outbound response scheduler.
+    Responses are queued per channel, each channel owns a token bucket and all channels share one
+    workspace-wide bucket. Channels having pending responses wait in a heap ordered by the time
+    their bucket refills, then move to a heap of ready channels ordered by the priority of their next
+    response, so picking the next sendable response costs O(log n) and the sender sleeps until the
+    earliest refill instead of rescanning the queue.
+    Each channel queue is a bounded ResponseQueue: direct replies go ahead of broadcasts, in the channel and
+    across the channels waiting for the workspace bucket.
+    """
+    KEY_CHANNEL_ID = 'channel_id'
+
+    def __init__(self, channel_rate=1.0, channel_burst=1, workspace_rate=1.0, workspace_burst=1,
+                 channel_capacity=0, drop_policy=ResponseQueue.DROP_OLDEST):
+        self._channel_rate = channel_rate
+        self._channel_burst = channel_burst
+        self._channel_capacity = channel_capacity
+        self._drop_policy = drop_policy
+        self._workspace_bucket = TokenBucket(workspace_rate, workspace_burst)
+        self._buckets = {}
+        self._channels = {}
+        self._waiting = []  # (ready_at, seq, channel_id) heap of the channels waiting for their bucket
+        self._ready = []  # (priority, seq, channel_id) heap of the channels waiting for the workspace bucket
+        self._scheduled = {}  # channel_id -> (seq, priority) of its current heap entry
+        self._idle = []  # (full_at, channel_id) heap of the buckets of the channels without pending responses
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._closed = False
+        self._enqueued = [0] * ResponseQueue.PRIORITY_CLASSES
+        self._dequeued = [0] * ResponseQueue.PRIORITY_CLASSES
+        self._dropped = [0] * ResponseQueue.PRIORITY_CLASSES
+        self._depth = [0] * ResponseQueue.PRIORITY_CLASSES
+
+    def set_rates(self, channel_rate, channel_burst, workspace_rate, workspace_burst):
+        """
+        Change the rate limits, the queued responses are kept
+        :param channel_rate: per-channel rate (messages per second)
+        :param channel_burst: per-channel burst size
+        :param workspace_rate: workspace-wide rate (messages per second)
+        :param workspace_burst: workspace-wide burst size
+        :return: None
+        """
+        with self._cond:
+            now = time.time()
+            self._channel_rate = channel_rate
+            self._channel_burst = channel_burst
+            self._workspace_bucket.set_rate(workspace_rate, workspace_burst, now)
+            for bucket in self._buckets.itervalues():
+                bucket.set_rate(channel_rate, channel_burst, now)
+            # The deadlines of the waiting channels changed with the rates
+            for channel_id in self._scheduled.keys():
+                self.__schedule(channel_id, now)
+            self.__evict_idle(now)
+            self._cond.notify_all()
+
+    def __bucket(self, channel_id):
+        bucket = self._buckets.get(channel_id)
+        if bucket is None:
+            bucket = TokenBucket(self._channel_rate, self._channel_burst)
+            self._buckets[channel_id] = bucket
+        return bucket
+
+    def __schedule(self, channel_id, now):
+        # Must be called with the condition held, an entry of the channel already in a heap becomes stale
+        ready_at = self.__bucket(channel_id).ready_at(now)
+        priority = self._channels[channel_id].top_priority()
+        seq = next(self._seq)
+        self._scheduled[channel_id] = (seq, priority)
+        if ready_at <= now:
+            heapq.heappush(self._ready, (priority, seq, channel_id))
+        else:
+            heapq.heappush(self._waiting, (ready_at, seq, channel_id))
+
+    def __evict_idle(self, now):
+        # Must be called with the condition held, a full bucket is the same as a new one
+        while len(self._idle) > 0 and self._idle[0][0] <= now:
+            _, channel_id = heapq.heappop(self._idle)
+            bucket = self._buckets.get(channel_id)
+            if bucket is None or channel_id in self._channels:
+                continue
+            full_at = bucket.full_at(now)
+            if full_at <= now:
+                del self._buckets[channel_id]
+            else:
+                # Rates changed since the channel became idle
+                heapq.heappush(self._idle, (full_at, channel_id))
+
+    def __is_current(self, seq, channel_id):
+        scheduled = self._scheduled.get(channel_id)
+        return scheduled is not None and scheduled[0] == seq
+
+    def __next_ready(self, now):
+        """
+        Move the channels whose bucket refilled to the ready heap
+        :return: the ready channel with the most important response, None if there is none
+        """
+        while len(self._waiting) > 0 and self._waiting[0][0] <= now:
+            _, seq, channel_id = heapq.heappop(self._waiting)
+            if self.__is_current(seq, channel_id):
+                heapq.heappush(self._ready, (self._scheduled[channel_id][1], seq, channel_id))
+        while len(self._ready) > 0:
+            _, seq, channel_id = self._ready[0]
+            if self.__is_current(seq, channel_id):
+                return channel_id
+            heapq.heappop(self._ready)
+        return None
+
+    def push(self, response, priority=ResponseQueue.PRIORITY_BROADCAST, front=False):
+        """
+        Queue a response
+        :param response: response to queue
+        :param priority: priority class of the response
+        :param front: True to put the response ahead of the other ones of its priority class
+        :return: True if the response has been queued, False if it is not sendable or has been dropped
+        """
+        if response is None or OutboundScheduler.KEY_CHANNEL_ID not in response:
+            return False
+        channel_id = response[OutboundScheduler.KEY_CHANNEL_ID]
+        priority = ResponseQueue.normalize_priority(priority)
+        with self._cond:
+            pending = self._channels.get(channel_id)
+            if pending is None:
+                pending = ResponseQueue(self._channel_capacity, self._drop_policy)
+                self._channels[channel_id] = pending
+            dropped, dropped_priority = pending.push(response, priority, front)
+            self._enqueued[priority] += 1
+            if dropped is response:
+                self._dropped[priority] += 1
+                return False
+            self._depth[priority] += 1
+            if dropped is not None:
+                self._dropped[dropped_priority] += 1
+                self._depth[dropped_priority] -= 1
+            scheduled = self._scheduled.get(channel_id)
+            if scheduled is None or pending.top_priority() < scheduled[1]:
+                # Scheduled again when a reply gets ahead of the broadcasts of the channel
+                self.__schedule(channel_id, time.time())
+                self._cond.notify()
+        return True
+
+    def pop(self, timeout=None):
+        """
+        Wait for the next sendable response
+        :param timeout: maximum time to wait (in seconds), None to wait until a response is ready
+        :return: the response, None if timed out or the scheduler has been closed
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while not self._closed:
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    return None
+                channel_id = self.__next_ready(now)
+                if channel_id is not None:
+                    ready_at = self._workspace_bucket.ready_at(now)
+                elif len(self._waiting) > 0:
+                    ready_at = self._waiting[0][0]
+                else:
+                    self._cond.wait(None if deadline is None else deadline - now)
+                    continue
+                if ready_at > now:
+                    wait_until = ready_at if deadline is None else min(ready_at, deadline)
+                    self._cond.wait(wait_until - now)
+                    continue
+                heapq.heappop(self._ready)
+                self._workspace_bucket.consume(now)
+                self.__bucket(channel_id).consume(now)
+                pending = self._channels[channel_id]
+                priority = pending.top_priority()
+                response = pending.pop()
+                self._dequeued[priority] += 1
+                self._depth[priority] -= 1
+                if len(pending) > 0:
+                    self.__schedule(channel_id, now)
+                else:
+                    del self._channels[channel_id]
+                    del self._scheduled[channel_id]
+                    heapq.heappush(self._idle, (self._buckets[channel_id].full_at(now), channel_id))
+                    self.__evict_idle(now)
+                return response
+        return None
+
+    def get_pending(self):
+        """
+        Get the queued responses, they stay queued
+        :return: list of (response, priority class) tuples
+        """
+        with self._cond:
+            pending = []
+            for channel_queue in self._channels.values():
+                pending.extend(channel_queue.items())
+            return pending
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get_stats(self):
+        """
+        Get queue counters
+        :return: dictionary of counters, per priority class lists are indexed by priority
+        """
+        with self._cond:
+            return {
+                'depth': sum(self._depth),
+                'depth_by_priority': list(self._depth),
+                'enqueued': list(self._enqueued),
+                'dequeued': list(self._dequeued),
+                'dropped': list(self._dropped),
+                'channels': len(self._channels)
+            }
+
+    def __len__(self):
+        with self._cond:
+            return sum(self._depth)
@@ -0,0 +1,785 @@
+import os
+import json
+import sqlite3
+import time
+from abc import ABCMeta, abstractmethod
+from threading import Lock, RLock
+from BotConfig import JsonLoader
+
+
+def _copy(value):
+    # Deep copy of a JSON compatible value
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.iteritems()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+
+def _write_atomic(file_path, data, sync=False):
+    """
+    Replace a file so that readers (and a crash) see either the old or the new content, never a truncated one
+    :param file_path: path of the file
+    :param data: new content
+    :param sync: True to flush the content to the disk before replacing the file
+    :return: None
+    """
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wt') as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.rename(tmp_path, file_path)
+
+
+def _read_json(file_path):
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path, 'rt') as f:
+            return JsonLoader.json_load_byteified(f)
+    except (IOError, ValueError):
+        return None
+
+
+class PrefsBackend(object):
+    """
+    Storage of the prefs namespaces. Calls are serialized by BotPrefs.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def load(self, pref_name):
+        """
+        Load a namespace
+        :param pref_name: namespace name
+        :return: the prefs, None if not found
+        """
+        pass
+
+    @abstractmethod
+    def store(self, pref_name, prefs, keys=None):
+        """
+        Persist a namespace
+        :param pref_name: namespace name
+        :param prefs: the prefs
+        :param keys: top level keys changed since the previous store, None if unknown
+        :return: True if successful, False otherwise
+        """
+        pass
+
+    def store_many(self, items):
+        """
+        Persist several namespaces
+        :param items: list of (namespace name, prefs, changed keys) tuples
+        :return: list of results, one per item
+        """
+        return [self.store(pref_name, prefs, keys) for pref_name, prefs, keys in items]
+
+    def close(self):
+        pass
+
+
+class JsonPrefsBackend(PrefsBackend):
+    """
+    One JSON file per namespace, rewritten whole on every store
+    """
+    EXTENSION = '.pref'
+
+    def __init__(self, prefs_dir):
+        self._prefs_dir = prefs_dir
+
+    def __make_path(self, pref_name):
+        return os.path.join(self._prefs_dir, pref_name + JsonPrefsBackend.EXTENSION)
+
+    def load(self, pref_name):
+        return _read_json(self.__make_path(pref_name))
+
+    def store(self, pref_name, prefs, keys=None):
+        data = json.dumps(prefs, indent=4, encoding='utf-8')
+        try:
+            _write_atomic(self.__make_path(pref_name), data)
+            return True
+        except (IOError, OSError):
+            return False
+
+
+class _Journal(object):
+    """
+    Journal state of one namespace
+    """
+
+    def __init__(self, state):
+        self.state = state  # copy of the prefs as persisted (snapshot + journal)
+        self.file = None
+        self.records = 0  # number of records appended since the last compaction
+        self.corrupted = False  # True if the journal ends with a record truncated by a crash
+
+
+class JournalPrefsBackend(PrefsBackend):
+    """
+    Append-only journal per namespace: a store only appends the values that changed since the previous one
+    (one JSON line per changed key path), so its cost depends on the change and not on the namespace size.
+    The journal is periodically compacted into a snapshot. A line truncated by a crash is ignored on replay.
+    """
+    SNAPSHOT_EXTENSION = '.snap'
+    JOURNAL_EXTENSION = '.journal'
+
+    SYNC_NONE = 'none'  # records stay in the process buffers until compaction or close
+    SYNC_FLUSH = 'flush'  # records are handed to the OS on every store, they survive a process crash
+    SYNC_FSYNC = 'fsync'  # records are written to the disk on every store, they survive a power loss
+
+    COMPACT_RECORDS = 1000
+
+    KEY_PATH = 'p'
+    KEY_VALUE = 'v'
+    KEY_DELETED = 'd'
+
+    def __init__(self, prefs_dir, sync=SYNC_FLUSH, compact_records=COMPACT_RECORDS):
+        """
+        :param prefs_dir: directory of the journal and snapshot files
+        :param sync: SYNC_NONE, SYNC_FLUSH or SYNC_FSYNC
+        :param compact_records: number of journal records triggering a compaction
+        """
+        self._prefs_dir = prefs_dir
+        self._sync = sync
+        self._compact_records = compact_records if compact_records > 0 else 1
+        self._journals = {}
+        self._lock = Lock()
+        self._appended = 0
+        self._compactions = 0
+
+    def __make_path(self, pref_name, extension):
+        return os.path.join(self._prefs_dir, pref_name + extension)
+
+    @staticmethod
+    def __apply(root, path, value, deleted):
+        if len(path) == 0:
+            return None if deleted else value
+        if not isinstance(root, dict):
+            root = {}
+        node = root
+        for k in path[:-1]:
+            child = node.get(k)
+            if not isinstance(child, dict):
+                child = {}
+                node[k] = child
+            node = child
+        if deleted:
+            node.pop(path[-1], None)
+        else:
+            node[path[-1]] = value
+        return root
+
+    @staticmethod
+    def __diff(old, new, path, records, complete=True):
+        """
+        Append the records turning old into new
+        :param old: persisted value
+        :param new: current value
+        :param path: key path of the values
+        :param records: list of records to append to
+        :param complete: False if new only holds some of the keys of the dictionary (no deletion then)
+        :return: None
+        """
+        if isinstance(old, dict) and isinstance(new, dict):
+            for k, v in new.iteritems():
+                if k in old:
+                    JournalPrefsBackend.__diff(old[k], v, path + [k], records)
+                else:
+                    records.append({JournalPrefsBackend.KEY_PATH: path + [k], JournalPrefsBackend.KEY_VALUE: v})
+            if not complete:
+                return
+            for k in old:
+                if k not in new:
+                    records.append({JournalPrefsBackend.KEY_PATH: path + [k], JournalPrefsBackend.KEY_DELETED: 1})
+        elif type(old) != type(new) or old != new:
+            records.append({JournalPrefsBackend.KEY_PATH: path, JournalPrefsBackend.KEY_VALUE: new})
+
+    def __replay(self, pref_name):
+        state = _read_json(self.__make_path(pref_name, JournalPrefsBackend.SNAPSHOT_EXTENSION))
+        if state is None:
+            # Not journaled yet, start from the file of the JSON backend
+            state = _read_json(self.__make_path(pref_name, JsonPrefsBackend.EXTENSION))
+        journal = _Journal(state)
+        journal_path = self.__make_path(pref_name, JournalPrefsBackend.JOURNAL_EXTENSION)
+        if os.path.exists(journal_path):
+            with open(journal_path, 'rt') as f:
+                for line in f:
+                    record = JsonLoader.json_loads_byteified(line)
+                    if not isinstance(record, dict) or JournalPrefsBackend.KEY_PATH not in record:
+                        # Truncated by a crash, the following records (if any) cannot be trusted
+                        journal.corrupted = True
+                        break
+                    journal.state = JournalPrefsBackend.__apply(journal.state, record[JournalPrefsBackend.KEY_PATH],
+                                                                record.get(JournalPrefsBackend.KEY_VALUE),
+                                                                record.get(JournalPrefsBackend.KEY_DELETED))
+                    journal.records += 1
+        return journal
+
+    def __get_journal(self, pref_name):
+        # Must be called with the lock held
+        journal = self._journals.get(pref_name)
+        if journal is None:
+            journal = self.__replay(pref_name)
+            self._journals[pref_name] = journal
+            if journal.corrupted:
+                # Records appended after the truncated one would be lost on next replay
+                try:
+                    self.__compact(pref_name, journal)
+                except (IOError, OSError):
+                    pass
+        return journal
+
+    def load(self, pref_name):
+        with self._lock:
+            return _copy(self.__get_journal(pref_name).state)
+
+    def __compact(self, pref_name, journal):
+        # Must be called with the lock held
+        if journal.file is not None:
+            journal.file.close()
+            journal.file = None
+        data = json.dumps(journal.state, indent=4, encoding='utf-8')
+        _write_atomic(self.__make_path(pref_name, JournalPrefsBackend.SNAPSHOT_EXTENSION), data,
+                      self._sync != JournalPrefsBackend.SYNC_NONE)
+        # A crash before truncating only replays records already in the snapshot
+        open(self.__make_path(pref_name, JournalPrefsBackend.JOURNAL_EXTENSION), 'wt').close()
+        journal.records = 0
+        self._compactions += 1
+
+    def store(self, pref_name, prefs, keys=None):
+        with self._lock:
+            journal = self.__get_journal(pref_name)
+            records = []
+            if keys is not None and isinstance(journal.state, dict) and isinstance(prefs, dict):
+                # Only the changed keys have to be compared
+                for k in keys:
+                    if k in prefs:
+                        JournalPrefsBackend.__diff(journal.state, {k: prefs[k]}, [], records, False)
+                    elif k in journal.state:
+                        records.append({JournalPrefsBackend.KEY_PATH: [k], JournalPrefsBackend.KEY_DELETED: 1})
+            else:
+                JournalPrefsBackend.__diff(journal.state, prefs, [], records)
+            if len(records) == 0:
+                return True
+            lines = ''.join(json.dumps(r, encoding='utf-8') + '\n' for r in records)
+            try:
+                if journal.file is None:
+                    journal.file = open(self.__make_path(pref_name, JournalPrefsBackend.JOURNAL_EXTENSION), 'at')
+                journal.file.write(lines)
+                if self._sync != JournalPrefsBackend.SYNC_NONE:
+                    journal.file.flush()
+                    if self._sync == JournalPrefsBackend.SYNC_FSYNC:
+                        os.fsync(journal.file.fileno())
+                for r in records:
+                    journal.state = JournalPrefsBackend.__apply(journal.state, r[JournalPrefsBackend.KEY_PATH],
+                                                                _copy(r.get(JournalPrefsBackend.KEY_VALUE)),
+                                                                r.get(JournalPrefsBackend.KEY_DELETED))
+                journal.records += len(records)
+                self._appended += len(records)
+                if journal.records >= self._compact_records:
+                    self.__compact(pref_name, journal)
+                return True
+            except (IOError, OSError):
+                return False
+
+    def close(self):
+        with self._lock:
+            for pref_name, journal in self._journals.items():
+                try:
+                    if journal.records > 0:
+                        self.__compact(pref_name, journal)
+                    elif journal.file is not None:
+                        journal.file.close()
+                        journal.file = None
+                except (IOError, OSError):
+                    pass
+
+    def get_stats(self):
+        with self._lock:
+            return {'appended_records': self._appended, 'compactions': self._compactions}
+
+
+class SqlitePrefsBackend(PrefsBackend):
+    """
+    SQLite database in WAL mode holding one row per top level key, so a store only writes the keys whose value
+    changed. The stores of a flush are batched in a single transaction.
+    """
+    FILE_NAME = 'prefs.db'
+
+    # PRAGMA synchronous value of each durability level
+    SYNCHRONOUS = {
+        JournalPrefsBackend.SYNC_NONE: 'OFF',
+        JournalPrefsBackend.SYNC_FLUSH: 'NORMAL',
+        JournalPrefsBackend.SYNC_FSYNC: 'FULL'
+    }
+
+    def __init__(self, prefs_dir, file_name=FILE_NAME, sync=JournalPrefsBackend.SYNC_FLUSH):
+        """
+        :param prefs_dir: directory of the database (and of the JSON files imported on first load)
+        :param file_name: database file name
+        :param sync: durability level, as for JournalPrefsBackend
+        """
+        self._prefs_dir = prefs_dir
+        self._lock = Lock()
+        self._stored = {}  # namespace -> {key: serialized value} as persisted
+        self._transactions = 0
+        self._rows_written = 0
+        self._rows_deleted = 0
+        # Transactions are explicit, the connection is shared by the threads flushing the prefs (under the lock)
+        self._conn = sqlite3.connect(os.path.join(prefs_dir, file_name), check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=%s' % SqlitePrefsBackend.SYNCHRONOUS.get(sync, 'NORMAL'))
+        self._conn.execute('CREATE TABLE IF NOT EXISTS prefs ('
+                           'namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+                           'PRIMARY KEY (namespace, key))')
+
+    def __get_stored(self, pref_name):
+        # Must be called with the lock held
+        stored = self._stored.get(pref_name)
+        if stored is None:
+            rows = self._conn.execute('SELECT key, value FROM prefs WHERE namespace = ?', (pref_name,)).fetchall()
+            stored = {k.encode('utf-8'): v.encode('utf-8') for k, v in rows}
+            self._stored[pref_name] = stored
+        return stored
+
+    def has_namespace(self, pref_name):
+        with self._lock:
+            return len(self.__get_stored(pref_name)) > 0
+
+    def load(self, pref_name):
+        with self._lock:
+            stored = self.__get_stored(pref_name)
+            if len(stored) == 0:
+                # Not in the database yet, start from the file of the JSON backend
+                return _read_json(os.path.join(self._prefs_dir, pref_name + JsonPrefsBackend.EXTENSION))
+            return {k: JsonLoader.json_loads_byteified(v) for k, v in stored.iteritems()}
+
+    def __changes(self, pref_name, prefs, keys):
+        """
+        Compute the rows to write and to delete
+        :return: tuple of (dictionary of key -> serialized value, list of deleted keys)
+        """
+        stored = self.__get_stored(pref_name)
+        upserts = {}
+        deletes = []
+        for k in (prefs.keys() if keys is None else keys):
+            if k in prefs:
+                data = json.dumps(prefs[k], encoding='utf-8')
+                if stored.get(k) != data:
+                    upserts[k] = data
+            elif k in stored:
+                deletes.append(k)
+        if keys is None:
+            deletes.extend(k for k in stored if k not in prefs)
+        return upserts, deletes
+
+    def store_many(self, items):
+        with self._lock:
+            results = []
+            changes = []
+            for pref_name, prefs, keys in items:
+                if not isinstance(prefs, dict):
+                    results.append(False)
+                    continue
+                try:
+                    upserts, deletes = self.__changes(pref_name, prefs, keys)
+                except (TypeError, ValueError):
+                    results.append(False)
+                    continue
+                results.append(True)
+                if len(upserts) > 0 or len(deletes) > 0:
+                    changes.append((pref_name, upserts, deletes))
+            if len(changes) == 0:
+                return results
+            try:
+                self._conn.execute('BEGIN')
+                for pref_name, upserts, deletes in changes:
+                    self._conn.executemany('INSERT OR REPLACE INTO prefs (namespace, key, value) VALUES (?, ?, ?)',
+                                           [(pref_name, k, v) for k, v in upserts.iteritems()])
+                    self._conn.executemany('DELETE FROM prefs WHERE namespace = ? AND key = ?',
+                                           [(pref_name, k) for k in deletes])
+                self._conn.execute('COMMIT')
+            except sqlite3.Error:
+                try:
+                    self._conn.execute('ROLLBACK')
+                except sqlite3.Error:
+                    pass
+                return [False] * len(items)
+            self._transactions += 1
+            for pref_name, upserts, deletes in changes:
+                stored = self._stored[pref_name]
+                stored.update(upserts)
+                for k in deletes:
+                    stored.pop(k, None)
+                self._rows_written += len(upserts)
+                self._rows_deleted += len(deletes)
+            return results
+
+    def store(self, pref_name, prefs, keys=None):
+        return self.store_many([(pref_name, prefs, keys)])[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'transactions': self._transactions,
+                'rows_written': self._rows_written,
+                'rows_deleted': self._rows_deleted
+            }
+
+
+class PrefsNamespace(object):
+    """
+    Prefs of one namespace: the live dictionary, edited by its module under the namespace lock, and a copy-on-write
+    snapshot, replaced on each save, that readers and the persistence use without locking.
+    A snapshot must never be modified.
+    """
+    __slots__ = ('data', 'lock', 'version', '_snapshot')
+
+    def __init__(self, data=None):
+        self.data = data
+        self.lock = RLock()
+        self.version = 0
+        self._snapshot = None
+
+    def publish(self):
+        """
+        Publish a copy of the live dictionary, called once it has been loaded or modified and saved
+        :return: None
+        """
+        with self.lock:
+            self.version += 1
+            self._snapshot = _copy(self.data)
+
+    def snapshot(self):
+        """
+        Get an immutable copy of the prefs as of their last save, the reference is replaced and never modified
+        :return: the copy, None if the namespace has no prefs
+        """
+        return self._snapshot
+
+
+class BotPrefs(object):
+    """
+    Class representing the bot preferences.
+    Namespaces are kept in memory once loaded or saved. Until write-behind is started, save_prefs writes
+    the namespace immediately; after that it only marks the namespace dirty and the pending changes are flushed
+    by a scheduler timer, or as soon as enough changes have built up.
+    get_pref/set_pref/increment_pref access single keys and only mark these keys dirty.
+    """
+    FLUSH_INTERVAL = 30  # in seconds
+    FLUSH_CHANGES = 50
+
+    BACKEND_JSON = 'json'
+    BACKEND_JOURNAL = 'journal'
+    BACKEND_SQLITE = 'sqlite'
+    BACKENDS = (BACKEND_JSON, BACKEND_JOURNAL, BACKEND_SQLITE)
+
+    _prefs_dir = ''
+
+    def __init__(self, prefs_dir, backend=None):
+        """
+        :param prefs_dir: directory of the prefs files
+        :param backend: PrefsBackend storing the namespaces, JsonPrefsBackend if None
+        """
+        self._prefs_dir = prefs_dir
+        if not os.path.exists(self._prefs_dir):
+            os.makedirs(self._prefs_dir)
+        self._backend = backend if backend is not None else JsonPrefsBackend(prefs_dir)
+        self._namespaces = {}  # namespace name -> PrefsNamespace
+        self._dirty = {}  # namespace -> [number of changes not written yet, set of changed keys or None for all]
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._scheduler = None
+        self._flush_changes = BotPrefs.FLUSH_CHANGES
+        self._flush_pending = False
+        self._saves = 0
+        self._writes = 0
+        self._coalesced = 0
+        self._failed_writes = 0
+        self._flushes = 0
+        self._flush_time = 0.0
+        self._last_flush_time = 0.0
+
+    @staticmethod
+    def create_backend(name, prefs_dir, config=None):
+        """
+        Create a prefs backend from its name
+        :param name: BACKEND_JSON, BACKEND_JOURNAL or BACKEND_SQLITE
+        :param prefs_dir: directory of the prefs files
+        :param config: BotConfig to read the backend options from ([prefs] section)
+        :return: the backend, None if the name is unknown
+        """
+        if config is not None:
+            sync = config.get_option('prefs', 'journal_sync', JournalPrefsBackend.SYNC_FLUSH).lower()
+        else:
+            sync = JournalPrefsBackend.SYNC_FLUSH
+        if name == BotPrefs.BACKEND_JSON:
+            return JsonPrefsBackend(prefs_dir)
+        if name == BotPrefs.BACKEND_JOURNAL:
+            if config is None:
+                return JournalPrefsBackend(prefs_dir, sync)
+            return JournalPrefsBackend(
+                prefs_dir, sync,
+                compact_records=config.get_int_option('prefs', 'journal_compact_records',
+                                                      JournalPrefsBackend.COMPACT_RECORDS))
+        if name == BotPrefs.BACKEND_SQLITE:
+            if config is None:
+                return SqlitePrefsBackend(prefs_dir, sync=sync)
+            return SqlitePrefsBackend(prefs_dir, config.get_option('prefs', 'sqlite_file',
+                                                                   SqlitePrefsBackend.FILE_NAME), sync)
+        return None
+
+    def get_backend(self):
+        return self._backend
+
+    def start(self, scheduler, flush_interval=FLUSH_INTERVAL, flush_changes=FLUSH_CHANGES):
+        """
+        Start write-behind
+        :param scheduler: BotScheduler firing the flushes
+        :param flush_interval: maximum time a change stays in memory (in seconds)
+        :param flush_changes: number of pending changes triggering an early flush
+        :return: None
+        """
+        with self._lock:
+            self._scheduler = scheduler
+            self._flush_changes = flush_changes if flush_changes > 0 else 1
+        scheduler.call_every(flush_interval, self.flush, owner=self)
+
+    def close(self):
+        """
+        Stop write-behind, flush all the pending changes and close the backend
+        :return: None
+        """
+        with self._lock:
+            scheduler = self._scheduler
+            self._scheduler = None
+        if scheduler is not None:
+            scheduler.cancel_owner(self)
+        self.flush()
+        with self._flush_lock:
+            self._backend.close()
+
+    def __write(self, items):
+        """
+        Write namespaces, must be called with the flush lock held
+        :param items: list of (namespace name, prefs, changed keys) tuples
+        :return: list of results
+        """
+        try:
+            return self._backend.store_many(items)
+        except (TypeError, ValueError, IOError, OSError, sqlite3.Error):
+            return [False] * len(items)
+
+    def __get_namespace(self, pref_name):
+        with self._lock:
+            ns = self._namespaces.get(pref_name)
+            if ns is None:
+                ns = PrefsNamespace()
+                self._namespaces[pref_name] = ns
+            return ns
+
+    def __changed(self, ns, pref_name, key=None):
+        """
+        Record a change, then write it (write-through) or mark it dirty (write-behind)
+        :param ns: the PrefsNamespace
+        :param pref_name: namespace name
+        :param key: changed key, None if any key may have changed
+        :return: True if successful, False otherwise
+        """
+        ns.publish()
+        with self._lock:
+            self._saves += 1
+            if self._scheduler is not None:
+                dirty = self._dirty.get(pref_name)
+                if dirty is None:
+                    dirty = [0, set()]
+                    self._dirty[pref_name] = dirty
+                dirty[0] += 1
+                if key is None:
+                    dirty[1] = None
+                elif dirty[1] is not None:
+                    dirty[1].add(key)
+                if not self._flush_pending and sum(d[0] for d in self._dirty.values()) >= self._flush_changes:
+                    self._flush_pending = True
+                    self._scheduler.call_later(0, self.flush)
+                return True
+        # The flush lock is never held while taking a namespace lock: the caller may still hold the namespace lock,
+        # the latest snapshot is written in case another thread saved meanwhile
+        with self._flush_lock:
+            result = self.__write([(pref_name, ns.snapshot(), None if key is None else [key])])[0]
+        with self._lock:
+            if result:
+                self._writes += 1
+            else:
+                self._failed_writes += 1
+        return result
+
+    def save_prefs(self, pref_name, prefs):
+        """
+        Save the prefs of a namespace.
+        The prefs dictionary should be modified under the namespace lock (see lock_prefs).
+        :param pref_name: namespace name
+        :param prefs: the prefs
+        :return: True if successful, False otherwise
+        """
+        if pref_name is None or len(pref_name) == 0 or prefs is None:
+            return False
+        ns = self.__get_namespace(pref_name)
+        if ns.data is not prefs:
+            with ns.lock:
+                ns.data = prefs
+        return self.__changed(ns, pref_name)
+
+    def __load(self, pref_name):
+        ns = self.__get_namespace(pref_name)
+        if ns.data is None:
+            with self._flush_lock:
+                result = self._backend.load(pref_name)
+            with ns.lock:
+                if ns.data is None and result is not None:
+                    ns.data = result
+                    ns.publish()
+        return ns
+
+    def load_prefs(self, pref_name):
+        """
+        Load the prefs of a namespace, the same dictionary is returned to every caller
+        :param pref_name: namespace name
+        :return: the prefs, None if the namespace does not exist
+        """
+        if pref_name is None or len(pref_name) == 0:
+            return None
+        return self.__load(pref_name).data
+
+    def lock_prefs(self, pref_name):
+        """
+        Get the (reentrant) lock to hold while modifying the prefs dictionary of a namespace
+        :param pref_name: namespace name
+        :return: the lock
+        """
+        return self.__get_namespace(pref_name).lock
+
+    def get_snapshot(self, pref_name):
+        """
+        Get an immutable copy of the prefs of a namespace as of their last save, without locking
+        :param pref_name: namespace name
+        :return: the copy (must not be modified), None if the namespace does not exist
+        """
+        if pref_name is None or len(pref_name) == 0:
+            return None
+        return self.__load(pref_name).snapshot()
+
+    def get_pref(self, pref_name, key, default=None):
+        """
+        Get the value of a key
+        :param pref_name: namespace name
+        :param key: the key
+        :param default: value returned if the key is not set
+        :return: the value
+        """
+        prefs = self.load_prefs(pref_name)
+        if prefs is None:
+            return default
+        return prefs.get(key, default)
+
+    def set_pref(self, pref_name, key, value):
+        """
+        Set the value of a key, only this key is written
+        :param pref_name: namespace name
+        :param key: the key
+        :param value: the new value
+        :return: True if successful, False otherwise
+        """
+        if pref_name is None or len(pref_name) == 0:
+            return False
+        ns = self.__load(pref_name)
+        with ns.lock:
+            if ns.data is None:
+                ns.data = {}
+            ns.data[key] = value
+        return self.__changed(ns, pref_name, key)
+
+    def increment_pref(self, pref_name, key, delta=1):
+        """
+        Atomically increment the value of a key
+        :param pref_name: namespace name
+        :param key: the key
+        :param delta: increment
+        :return: the new value, None if the key holds a non-numeric value
+        """
+        if pref_name is None or len(pref_name) == 0:
+            return None
+        ns = self.__load(pref_name)
+        with ns.lock:
+            if ns.data is None:
+                ns.data = {}
+            value = ns.data.get(key, 0)
+            if not isinstance(value, (int, long, float)):
+                return None
+            value += delta
+            ns.data[key] = value
+        self.__changed(ns, pref_name, key)
+        return value
+
+    def flush(self):
+        """
+        Write the dirty namespaces
+        :return: number of namespaces written
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty = self._dirty
+                self._dirty = {}
+                self._flush_pending = False
+                pending = [(name, self._namespaces[name], d) for name, d in dirty.iteritems()]
+            if len(pending) == 0:
+                return 0
+            started = time.time()
+            # Serialized from snapshots: the modules keep editing their prefs while the backend writes
+            pending = [(name, ns.snapshot(), d) for name, ns, d in pending]
+            results = self.__write([(name, prefs, None if d[1] is None else list(d[1])) for name, prefs, d in pending])
+            written = 0
+            with self._lock:
+                self._flushes += 1
+                self._last_flush_time = time.time() - started
+                self._flush_time += self._last_flush_time
+                for (name, prefs, d), result in zip(pending, results):
+                    if result:
+                        written += 1
+                        self._writes += 1
+                        self._coalesced += d[0] - 1
+                        continue
+                    # Keep the namespace dirty, retried on next flush
+                    self._failed_writes += 1
+                    current = self._dirty.get(name)
+                    if current is None:
+                        self._dirty[name] = d
+                    else:
+                        current[0] += d[0]
+                        current[1] = None if current[1] is None or d[1] is None else current[1] | d[1]
+            return written
+
+    def get_stats(self):
+        """
+        :return: dictionary of counters, flush_time (total) and last_flush_time in seconds
+        """
+        with self._lock:
+            return {
+                'namespaces': len(self._namespaces),
+                'dirty': len(self._dirty),
+                'saves': self._saves,
+                'writes': self._writes,
+                'coalesced': self._coalesced,
+                'failed_writes': self._failed_writes,
+                'flushes': self._flushes,
+                'flush_time': self._flush_time,
+                'last_flush_time': self._last_flush_time
+            }
@@ -0,0 +1,92 @@
+from collections import deque
+
+
+class ResponseQueue(object):
+    """
+    Bounded response queue with priority classes.
+    Each priority class is a FIFO deque so every operation is O(1) (the number of classes is fixed).
+    Lower class value means higher priority. This class is not thread-safe, the owner must lock it.
+    """
+    PRIORITY_REPLY = 0  # direct replies to user messages
+    PRIORITY_BROADCAST = 1  # scheduled/timer messages
+    PRIORITY_CLASSES = 2
+
+    DROP_NEWEST = 'drop_newest'  # reject the incoming response when full
+    DROP_OLDEST = 'drop_oldest'  # evict the oldest response of the lowest priority class when full
+
+    def __init__(self, capacity=0, drop_policy=DROP_OLDEST):
+        self._capacity = capacity if capacity > 0 else 0
+        self._drop_policy = drop_policy
+        self._classes = [deque() for _ in range(ResponseQueue.PRIORITY_CLASSES)]
+        self._size = 0
+
+    @staticmethod
+    def normalize_priority(priority):
+        if priority is None or priority < 0:
+            return ResponseQueue.PRIORITY_REPLY
+        if priority >= ResponseQueue.PRIORITY_CLASSES:
+            return ResponseQueue.PRIORITY_CLASSES - 1
+        return priority
+
+    def push(self, item, priority=PRIORITY_BROADCAST, front=False):
+        """
+        Queue an item
+        :param item: item to queue
+        :param priority: priority class of the item
+        :param front: True to put the item ahead of its priority class
+        :return: tuple of the dropped item (possibly the given item) and its priority class if the queue was
+        full, (None, None) otherwise
+        """
+        priority = ResponseQueue.normalize_priority(priority)
+        dropped = None, None
+        if 0 < self._capacity <= self._size:
+            if self._drop_policy != ResponseQueue.DROP_OLDEST:
+                return item, priority
+            # Evict from the lowest priority class which is not more important than the new item
+            for p in range(ResponseQueue.PRIORITY_CLASSES - 1, priority - 1, -1):
+                if len(self._classes[p]) > 0:
+                    dropped = self._classes[p].popleft(), p
+                    self._size -= 1
+                    break
+            if dropped[0] is None:
+                return item, priority
+        if front:
+            self._classes[priority].appendleft(item)
+        else:
+            self._classes[priority].append(item)
+        self._size += 1
+        return dropped
+
+    def pop(self):
+        """
+        Take the first item of the highest non-empty priority class
+        :return: the item, None if the queue is empty
+        """
+        for items in self._classes:
+            if len(items) > 0:
+                self._size -= 1
+                return items.popleft()
+        return None
+
+    def top_priority(self):
+        """
+        Get the priority class of the next item
+        :return: priority class, None if the queue is empty
+        """
+        for p in range(ResponseQueue.PRIORITY_CLASSES):
+            if len(self._classes[p]) > 0:
+                return p
+        return None
+
+    def items(self):
+        """
+        Get the queued items in the order they would be popped
+        :return: list of (item, priority class) tuples
+        """
+        return [(item, p) for p in range(ResponseQueue.PRIORITY_CLASSES) for item in self._classes[p]]
+
+    def depth(self, priority):
+        return len(self._classes[ResponseQueue.normalize_priority(priority)])
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,183 @@
+import logging
+import os
+import time
+from threading import Lock
+from BotCache import TTLCache
+from BotConfig import ConfigCache
+from BotHttp import BotHttp
+from BotMetrics import BotMetrics, MetricsServer
+from BotScheduler import BotScheduler, BotWorkerPool, BotInlinePool
+
+
+class BotRuntime(object):
+    """
+    Resources shared by the workspace engines of one process: the worker pools, the timer scheduler,
+    the compiled config cache, the cache of the data fetched by modules (exchange rates, lotto results...),
+    the pooled HTTP transport and the metrics registry with its local HTTP endpoint.
+    An engine created without a runtime owns a private one.
+    A runtime created with a VirtualClock runs everything on the calling thread (offline replay):
+    timers and tasks only run in advance_to and run_pending.
+    """
+    WORKER_THREADS = 4
+    HANDLER_THREADS = 4
+    FETCH_CACHE_SIZE = 64
+    FETCH_CACHE_TTL = 300  # in seconds
+    METRICS_HOST = '127.0.0.1'
+    METRICS_PORT = 0  # disabled
+
+    def __init__(self, worker_threads=WORKER_THREADS, handler_threads=HANDLER_THREADS,
+                 fetch_cache_size=FETCH_CACHE_SIZE, fetch_cache_ttl=FETCH_CACHE_TTL, config_cache=None, http=None,
+                 logger=None, clock=None, metrics_address=None):
+        """
+        :param worker_threads: number of threads firing timers
+        :param handler_threads: number of threads running message handlers
+        :param fetch_cache_size: maximum number of entries of the fetch cache
+        :param fetch_cache_ttl: default time-to-live of the fetch cache entries (in seconds)
+        :param config_cache: ConfigCache object, None to cache in .cache of the working directory
+        :param http: BotHttp object, None for a transport with the default settings
+        :param logger: logger reporting the task errors, None for the bot logger
+        :param clock: VirtualClock object, None for the system clock
+        :param metrics_address: (host, port) tuple of the metrics endpoint, None to disable it
+        """
+        self._logger = logger if logger is not None else logging.getLogger('CacCuBot')
+        self._clock = clock
+        if clock is not None:
+            self._workers = BotInlinePool(error_handler=self.__on_worker_error)
+            self._handlers = BotInlinePool(error_handler=self.__on_worker_error)
+        else:
+            self._workers = BotWorkerPool(worker_threads, error_handler=self.__on_worker_error)
+            self._handlers = BotWorkerPool(handler_threads, name='BotHandler', error_handler=self.__on_worker_error)
+        self._scheduler = BotScheduler(self._workers, clock)
+        self._config_cache = config_cache if config_cache is not None else ConfigCache(
+            os.path.join(os.getcwd(), '.cache'))
+        self._fetch_cache = TTLCache(fetch_cache_size, fetch_cache_ttl, clock)
+        self._http = http if http is not None else BotHttp()
+        self._metrics = BotMetrics()
+        self._metrics.add_collector(self.__collect_metrics, owner=self)
+        self._metrics_server = None
+        if metrics_address is not None and metrics_address[1] > 0 and clock is None:
+            self._metrics_server = MetricsServer(self._metrics, metrics_address[0], metrics_address[1], self._logger)
+        self._lock = Lock()
+        self._started = False
+        self._stopped = False
+
+    @staticmethod
+    def from_config(bot_config, config_cache=None, logger=None, clock=None, http=None):
+        """
+        Create a runtime sized from the [engine], [cache], [http] and [metrics] sections of a config
+        :param bot_config: BotConfig object
+        :param config_cache: ConfigCache object, None for the default one
+        :param logger: logger reporting the task errors
+        :param clock: VirtualClock object, None for the system clock
+        :param http: BotHttp object, None for a transport sized from the [http] section
+        :return: the runtime
+        """
+        if http is None:
+            http = BotHttp(bot_config.get_int_option('http', 'pool_size', BotHttp.POOL_SIZE),
+                           bot_config.get_float_option('http', 'timeout', BotHttp.TIMEOUT),
+                           bot_config.get_float_option('http', 'idle_timeout', BotHttp.IDLE_TIMEOUT))
+        return BotRuntime(
+            bot_config.get_int_option('engine', 'worker_threads', BotRuntime.WORKER_THREADS),
+            bot_config.get_int_option('engine', 'handler_threads', BotRuntime.HANDLER_THREADS),
+            bot_config.get_int_option('cache', 'fetch_size', BotRuntime.FETCH_CACHE_SIZE),
+            bot_config.get_float_option('cache', 'fetch_ttl', BotRuntime.FETCH_CACHE_TTL),
+            config_cache, http, logger, clock,
+            (bot_config.get_option('metrics', 'host', BotRuntime.METRICS_HOST),
+             bot_config.get_int_option('metrics', 'port', BotRuntime.METRICS_PORT)))
+
+    def __on_worker_error(self, task_name, exc_info):
+        self._logger.error('Exception on worker task %s' % task_name, exc_info=exc_info)
+
+    def __collect_metrics(self):
+        stats = self._http.get_stats()
+        for name in ('requests', 'connections', 'reused', 'retries', 'errors'):
+            self._metrics.counter('bot_http_%s_total' % name, 'HTTP transport %s' % name).set((), stats[name])
+        self._metrics.gauge('bot_http_idle_connections', 'Idle keep-alive connections').set((), stats['idle'])
+        stats = self._fetch_cache.get_stats()
+        for name in ('hits', 'misses', 'loads', 'evictions'):
+            self._metrics.counter('bot_fetch_cache_%s_total' % name, 'Fetch cache %s' % name).set((), stats[name])
+        self._metrics.gauge('bot_fetch_cache_entries', 'Entries of the fetch cache').set((), stats['size'])
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._workers.start()
+        self._handlers.start()
+        self._scheduler.start()
+        if self._metrics_server is not None:
+            self._metrics_server.start()
+
+    def stop(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        if self._metrics_server is not None:
+            self._metrics_server.stop()
+        self._scheduler.stop()
+        self._workers.stop()
+        self._handlers.stop()
+        self._http.close()
+
+    def is_virtual(self):
+        return self._clock is not None
+
+    def time(self):
+        """
+        Get the current time, from the virtual clock in replay
+        :return: timestamp
+        """
+        return self._clock.time() if self._clock is not None else time.time()
+
+    def get_clock(self):
+        return self._clock
+
+    def run_pending(self):
+        """
+        Run the queued tasks of a virtual clock runtime until both pools are idle
+        :return: number of tasks run
+        """
+        count = 0
+        while True:
+            ran = self._workers.run_pending() + self._handlers.run_pending()
+            if ran == 0:
+                return count
+            count += ran
+
+    def advance_to(self, timestamp):
+        """
+        Move the virtual clock forward, firing the due timers in deadline order.
+        The tasks queued by a timer run before the next timer is fired.
+        :param timestamp: new timestamp
+        :return: number of fired timers
+        """
+        fired = 0
+        self.run_pending()
+        while self._scheduler.fire_next(timestamp):
+            fired += 1
+            self.run_pending()
+        self._clock.set(timestamp)
+        return fired
+
+    def get_workers(self):
+        return self._workers
+
+    def get_handlers(self):
+        return self._handlers
+
+    def get_scheduler(self):
+        return self._scheduler
+
+    def get_config_cache(self):
+        return self._config_cache
+
+    def get_fetch_cache(self):
+        return self._fetch_cache
+
+    def get_http(self):
+        return self._http
+
+    def get_metrics(self):
+        return self._metrics
@@ -0,0 +1,411 @@
+import heapq
+import itertools
+import sys
+import time
+import Queue
+from collections import deque
+from threading import Thread, Condition, Lock, local
+
+
+class BotWorkerPool(object):
+    """
+    Fixed-size pool of worker threads executing submitted tasks in FIFO order
+    """
+
+    def __init__(self, size=4, name='BotWorker', error_handler=None):
+        """
+        :param size: number of worker threads
+        :param name: thread name prefix
+        :param error_handler: function called with (description, exc_info) when a task raises an exception
+        """
+        self._size = size if size > 0 else 1
+        self._name = name
+        self._error_handler = error_handler
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._lock = Lock()
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            if len(self._threads) > 0:
+                return
+            for i in range(self._size):
+                t = Thread(target=self.__work, name='%s-%d' % (self._name, i))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    def get_size(self):
+        return self._size
+
+    def submit(self, func, args=None, done=None):
+        """
+        Queue a task
+        :param func: function to execute
+        :param args: list of arguments of the function
+        :param done: function called (in the worker thread) once the task has finished, whatever the outcome
+        :return: True if queued, False if the pool has been stopped
+        """
+        if self._stopped:
+            return False
+        self._tasks.put((func, args, done))
+        return True
+
+    def __work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            func, args, done = task
+            try:
+                func(*(args or []))
+            except Exception:
+                self.__report(func)
+            finally:
+                if done is not None:
+                    try:
+                        done()
+                    except Exception:
+                        self.__report(done)
+
+    def __report(self, func):
+        if self._error_handler is not None:
+            self._error_handler(getattr(func, '__name__', repr(func)), sys.exc_info())
+
+    def stop(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            for _ in self._threads:
+                self._tasks.put(None)
+
+
+class BotInlinePool(object):
+    """
+    Worker pool stand-in of the offline replay: submitted tasks are queued, then run in submission order
+    on the thread calling run_pending, so a replay does not depend on thread scheduling
+    """
+
+    def __init__(self, error_handler=None):
+        """
+        :param error_handler: function called with (description, exc_info) when a task raises an exception
+        """
+        self._error_handler = error_handler
+        self._tasks = deque()
+        self._lock = Lock()
+        self._stopped = False
+
+    def start(self):
+        pass
+
+    def get_size(self):
+        return 1
+
+    def submit(self, func, args=None, done=None):
+        with self._lock:
+            if self._stopped:
+                return False
+            self._tasks.append((func, args, done))
+        return True
+
+    def run_pending(self):
+        """
+        Run the queued tasks, including the ones they submit
+        :return: number of tasks run
+        """
+        count = 0
+        while True:
+            with self._lock:
+                if len(self._tasks) == 0:
+                    return count
+                func, args, done = self._tasks.popleft()
+            count += 1
+            try:
+                func(*(args or []))
+            except Exception:
+                self.__report(func)
+            finally:
+                if done is not None:
+                    try:
+                        done()
+                    except Exception:
+                        self.__report(done)
+
+    def __report(self, func):
+        if self._error_handler is not None:
+            self._error_handler(getattr(func, '__name__', repr(func)), sys.exc_info())
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._tasks.clear()
+
+
+class VirtualClock(object):
+    """
+    Clock of the offline replay, only moved forward explicitly
+    """
+
+    def __init__(self, start):
+        """
+        :param start: initial timestamp
+        """
+        self._now = float(start)
+
+    def time(self):
+        return self._now
+
+    def set(self, timestamp):
+        """
+        Move the clock forward, it never goes back
+        :param timestamp: new timestamp
+        :return: None
+        """
+        if timestamp > self._now:
+            self._now = float(timestamp)
+
+
+class BotSerialLanes(object):
+    """
+    Run tasks on a worker pool while keeping the submission order of tasks sharing the same key:
+    tasks of one key (lane) run one at a time, tasks of different keys run in parallel.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._lanes = {}  # key -> [deque of pending tasks, token of the running task]
+        self._lock = Lock()
+        self._current = local()
+
+    def submit(self, key, func, args=None):
+        """
+        Queue a task in a lane
+        :param key: lane key
+        :param func: function to execute
+        :param args: list of arguments of the function
+        :return: None
+        """
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = [deque(), None]
+                self._lanes[key] = lane
+            lane[0].append((func, args))
+            if lane[1] is None:
+                self.__start_next(key, lane)
+
+    def __start_next(self, key, lane):
+        # Must be called with the lock held
+        if len(lane[0]) == 0:
+            lane[1] = None
+            del self._lanes[key]
+            return
+        func, args = lane[0].popleft()
+        token = object()
+        lane[1] = token
+        self._pool.submit(self.__run, [key, token, func, args])
+
+    def __run(self, key, token, func, args):
+        self._current.task = (key, token)
+        try:
+            func(*(args or []))
+        finally:
+            self._current.task = None
+            self.detach(key, token)
+
+    def current(self):
+        """
+        Get the lane task executed by the calling thread
+        :return: tuple of (key, token), None if not running a lane task
+        """
+        return getattr(self._current, 'task', None)
+
+    def detach(self, key, token):
+        """
+        Let the next task of a lane start without waiting for the given (running) task to finish
+        :param key: lane key
+        :param token: token of the running task
+        :return: True if the lane has been released, False if the task was not holding it anymore
+        """
+        with self._lock:
+            lane = self._lanes.get(key)
+            if lane is None or lane[1] is not token:
+                return False
+            self.__start_next(key, lane)
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(lane[0]) for lane in self._lanes.values())
+
+
+class BotTimerHandle(object):
+    """
+    Handle of a timer registered with BotScheduler, can be used to cancel it
+    """
+
+    def __init__(self, deadline, interval, func, args, owner):
+        self.deadline = deadline
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.owner = owner
+        self.cancelled = False
+        self.running = False
+
+    def is_periodic(self):
+        return self.interval is not None and self.interval > 0
+
+
+class BotScheduler(object):
+    """
+    Central timer scheduler: one thread sleeping on a heap of deadlines and firing the callbacks on a worker pool,
+    so the thread count does not depend on the number of timers.
+    A periodic timer is skipped while its previous run is still in progress, so a callback never overlaps itself.
+    With a VirtualClock, there is no thread: timers are fired by fire_next as the clock is moved forward.
+    """
+
+    def __init__(self, pool, clock=None):
+        """
+        :param pool: worker pool running the callbacks
+        :param clock: VirtualClock object, None for the system clock
+        """
+        self._pool = pool
+        self._clock = clock
+        self._time = clock.time if clock is not None else time.time
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None or self._clock is not None:
+                return
+            self._thread = Thread(target=self.__run, name='BotScheduler')
+            self._thread.start()
+
+    def __push(self, handle):
+        # Must be called with the condition held
+        heapq.heappush(self._heap, (handle.deadline, next(self._seq), handle))
+        self._cond.notify()
+
+    def call_every(self, interval, func, args=None, owner=None):
+        """
+        Register an interval timer, first fired one interval from now
+        :param interval: interval in seconds
+        :param func: callback
+        :param args: list of arguments of the callback
+        :param owner: object owning the timer (see cancel_owner)
+        :return: timer handle
+        """
+        interval = interval if interval > 0 else 1
+        handle = BotTimerHandle(self._time() + interval, interval, func, args, owner)
+        with self._cond:
+            self.__push(handle)
+        return handle
+
+    def call_at(self, deadline, func, args=None, owner=None):
+        """
+        Register a one-shot timer
+        :param deadline: timestamp at which the callback is fired
+        :param func: callback
+        :param args: list of arguments of the callback
+        :param owner: object owning the timer (see cancel_owner)
+        :return: timer handle
+        """
+        handle = BotTimerHandle(deadline, None, func, args, owner)
+        with self._cond:
+            self.__push(handle)
+        return handle
+
+    def call_later(self, delay, func, args=None, owner=None):
+        return self.call_at(self._time() + delay, func, args, owner)
+
+    @staticmethod
+    def cancel(handle):
+        if handle is not None:
+            handle.cancelled = True
+
+    def cancel_owner(self, owner):
+        """
+        Cancel all the timers of an owner
+        :param owner: the owner
+        :return: number of cancelled timers
+        """
+        count = 0
+        with self._cond:
+            for _, _, handle in self._heap:
+                if handle.owner is owner and not handle.cancelled:
+                    handle.cancelled = True
+                    count += 1
+        return count
+
+    def __len__(self):
+        with self._cond:
+            return len([h for _, _, h in self._heap if not h.cancelled])
+
+    def __fire(self, handle):
+        # Must be called with the condition held
+        if handle.is_periodic():
+            if not handle.running:
+                handle.running = True
+                self._pool.submit(handle.func, handle.args, lambda: self.__done(handle))
+            # Fixed rate, but never try catching up missed ticks
+            now = self._time()
+            handle.deadline += handle.interval
+            if handle.deadline <= now:
+                handle.deadline = now + handle.interval
+            self.__push(handle)
+        else:
+            self._pool.submit(handle.func, handle.args)
+
+    @staticmethod
+    def __done(handle):
+        handle.running = False
+
+    def __run(self):
+        with self._cond:
+            while not self._stopped:
+                if len(self._heap) == 0:
+                    self._cond.wait()
+                    continue
+                deadline, _, handle = self._heap[0]
+                if handle.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                now = time.time()
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+                heapq.heappop(self._heap)
+                self.__fire(handle)
+
+    def fire_next(self, until):
+        """
+        Fire the earliest timer due at a given time, moving the virtual clock to its deadline
+        :param until: timestamp
+        :return: True if a timer has been fired, False if no timer is due
+        """
+        with self._cond:
+            while len(self._heap) > 0 and not self._stopped:
+                deadline, _, handle = self._heap[0]
+                if handle.cancelled:
+                    heapq.heappop(self._heap)
+                    continue
+                if deadline > until:
+                    break
+                heapq.heappop(self._heap)
+                if self._clock is not None:
+                    self._clock.set(deadline)
+                self.__fire(handle)
+                return True
+        return False
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
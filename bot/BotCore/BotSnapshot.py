@@ -0,0 +1,70 @@
+import cPickle
+import os
+import time
+import zlib
+from threading import Lock
+
+
+class BotSnapshot(object):
+    """
+    Checkpoint file of the engine state, used to warm-start without waiting for the Slack directory.
+    The state is a dictionary pickled and compressed into one file, replaced atomically on every save.
+    """
+    VERSION = 1
+    MAX_AGE = 86400  # in seconds
+
+    def __init__(self, path, max_age=MAX_AGE):
+        """
+        :param path: path of the snapshot file
+        :param max_age: snapshots older than this are ignored (in seconds)
+        """
+        self._path = path
+        self._max_age = max_age
+        self._lock = Lock()
+
+    def get_path(self):
+        return self._path
+
+    def save(self, state):
+        """
+        Write a snapshot
+        :param state: dictionary of picklable values
+        :return: size of the file, 0 if errors occurred
+        """
+        data = zlib.compress(cPickle.dumps((BotSnapshot.VERSION, time.time(), state), cPickle.HIGHEST_PROTOCOL))
+        tmp_path = self._path + '.tmp'
+        with self._lock:
+            try:
+                parent_dir = os.path.dirname(self._path)
+                if parent_dir != '' and not os.path.exists(parent_dir):
+                    os.makedirs(parent_dir)
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp_path, self._path)
+            except (IOError, OSError):
+                return 0
+        return len(data)
+
+    def load(self):
+        """
+        Read the snapshot
+        :return: (state, age in seconds) tuple, None if there is no usable snapshot
+        """
+        with self._lock:
+            try:
+                with open(self._path, 'rb') as f:
+                    version, saved_at, state = cPickle.loads(zlib.decompress(f.read()))
+            except (IOError, EOFError, ValueError, TypeError, AttributeError, ImportError, zlib.error,
+                    cPickle.UnpicklingError):
+                return None
+        age = time.time() - saved_at
+        if version != BotSnapshot.VERSION or not isinstance(state, dict) or not 0 <= age <= self._max_age:
+            return None
+        return state, age
+
+    def discard(self):
+        with self._lock:
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
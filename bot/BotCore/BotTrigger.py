@@ -0,0 +1,170 @@
+from collections import deque
+from BotMessage import BotMessage
+
+
+class AhoCorasick(object):
+    """
+    Multi-pattern string matcher (Aho-Corasick automaton).
+    All the patterns are found with a single scan of the text, whatever the number of patterns.
+    """
+
+    def __init__(self, patterns):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self._patterns = []
+        for pattern in patterns:
+            self.__add(pattern)
+        self.__build()
+
+    def __add(self, pattern):
+        if pattern is None or len(pattern) == 0:
+            return
+        index = len(self._patterns)
+        self._patterns.append(pattern)
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][ch] = nxt
+            node = nxt
+        self._out[node].append(index)
+
+    def __build(self):
+        queue = deque(self._goto[0].values())
+        while len(queue) > 0:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].iteritems():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f > 0 and ch not in self._goto[f]:
+                    f = self._fail[f]
+                target = self._goto[f].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def search(self, text):
+        """
+        Find all pattern occurrences
+        :param text: text to search in
+        :return: list of (start position, pattern) tuples, ordered by end position
+        """
+        result = []
+        if text is None or len(self._patterns) == 0:
+            return result
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        node = 0
+        for i, ch in enumerate(text):
+            while node > 0 and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                for index in out[node]:
+                    pattern = self._patterns[index]
+                    result.append((i - len(pattern) + 1, pattern))
+        return result
+
+
+class BotTrigger(object):
+    """
+    Declares which messages a module is interested in.
+    A message fires the trigger when it contains one of the phrases (if any) and satisfies all the predicates.
+    """
+
+    def __init__(self, trigger_id, phrases=None, mentioned=None, channels=None, users=None):
+        """
+        :param trigger_id: unique trigger identifier
+        :param phrases: list of lower case phrases to look for in the standardized lower text, None for any text
+        :param mentioned: True/False to require the bot to be mentioned or not, None for both
+        :param channels: list of channel names the message must come from, None for any channel
+        :param users: list of user names or IDs the message must come from, None for any user
+        """
+        self.trigger_id = trigger_id
+        self.phrases = [p for p in phrases if p] if phrases is not None else None
+        self.mentioned = mentioned
+        self.channels = frozenset(channels) if channels is not None else None
+        self.users = frozenset(users) if users is not None else None
+
+    def accepts(self, msg):
+        if self.mentioned is not None and self.mentioned != msg.get(BotMessage.KEY_IS_BOT_MENTIONED, False):
+            return False
+        if self.channels is not None and msg.get(BotMessage.KEY_CHANNEL_NAME) not in self.channels:
+            return False
+        if (self.users is not None and msg.get(BotMessage.KEY_FROM_USER_ID) not in self.users and
+                msg.get(BotMessage.KEY_FROM_USER_NAME) not in self.users):
+            return False
+        return True
+
+
+class TriggerIndex(object):
+    """
+    Routing table compiled from module triggers.
+    Every phrase of every trigger is compiled into one Aho-Corasick automaton, so each message is scanned once
+    and only the modules whose triggers fired are called. Modules declaring no trigger receive every event.
+    """
+
+    def __init__(self):
+        self._catch_all = set()
+        self._triggers = []  # list of (module index, trigger)
+        self._phrase_map = {}  # phrase -> list of (index in self._triggers, rank of the phrase in the trigger)
+        self._predicate_only = []  # indexes in self._triggers of triggers having no phrase
+        self._matcher = AhoCorasick([])
+
+    def add(self, mod_index, triggers):
+        """
+        Add the triggers of a module
+        :param mod_index: index of the module in the engine module list
+        :param triggers: list of BotTrigger, None to receive every event
+        :return: None
+        """
+        if triggers is None:
+            self._catch_all.add(mod_index)
+            return
+        for trigger in triggers:
+            slot = len(self._triggers)
+            self._triggers.append((mod_index, trigger))
+            if trigger.phrases is None:
+                self._predicate_only.append(slot)
+            else:
+                for rank, phrase in enumerate(trigger.phrases):
+                    self._phrase_map.setdefault(phrase, []).append((slot, rank))
+
+    def compile(self):
+        self._matcher = AhoCorasick(self._phrase_map.keys())
+
+    def route(self, msg):
+        """
+        Find the modules interested in a message
+        :param msg: the message (BotMessage or compatible dictionary)
+        :return: tuple of (sorted list of module indexes, dictionary of trigger id -> (position, phrase)),
+        when several phrases of a trigger are found the first one in the trigger phrase list is reported,
+        at its first position in the text
+        """
+        mods = set(self._catch_all)
+        matches = {}
+        if not msg.get(BotMessage.KEY_IS_MESSAGE, False):
+            return sorted(mods), matches
+        for slot in self._predicate_only:
+            mod_index, trigger = self._triggers[slot]
+            if trigger.accepts(msg):
+                mods.add(mod_index)
+                matches[trigger.trigger_id] = (0, '')
+        if len(self._phrase_map) == 0:
+            return sorted(mods), matches
+        ranks = {}
+        for pos, phrase in self._matcher.search(msg.get(BotMessage.KEY_STANDARDIZED_LOWER_TEXT)):
+            for slot, rank in self._phrase_map[phrase]:
+                mod_index, trigger = self._triggers[slot]
+                if trigger.trigger_id in ranks and ranks[trigger.trigger_id] <= rank:
+                    continue
+                if trigger.accepts(msg):
+                    mods.add(mod_index)
+                    matches[trigger.trigger_id] = (pos, phrase)
+                    ranks[trigger.trigger_id] = rank
+        return sorted(mods), matches
@@ -41,18 +41,29 @@ class RandomUtils:
 
 
 class UrlUtils:
+    # Pooled HTTP transport (BotHttp), None to open a new connection for every download
+    _transport = None
+
     def __init__(self):
         pass
 
+    @staticmethod
+    def set_transport(transport):
+        UrlUtils._transport = transport
+
     @staticmethod
     def download_to_string(url):
+        transport = UrlUtils._transport
         try:
-            response = urllib.urlopen(url)
-            data = response.read()
-            response.close()
+            if transport is None:
+                response = urllib.urlopen(url)
+                data = response.read()
+                response.close()
+                return data
+            response = transport.get(url)
         except IOError:
             return None
-        return data
+        return response.body if response.ok() else None
 
 
 class HtmlSimpleParser(HTMLParser.HTMLParser):
@@ -1 +1 @@
-__all__ = ['BotConfig', 'BotEngine', 'BotUtils']
+__all__ = ['BotCache', 'BotConfig', 'BotDirectory', 'BotEngine', 'BotGateway', 'BotHistory', 'BotHttp', 'BotMessage', 'BotMetrics', 'BotOutbound', 'BotPrefs', 'BotQueue', 'BotRuntime', 'BotScheduler', 'BotSnapshot', 'BotTrigger', 'BotUtils']
@@ -5,28 +5,59 @@ from BotCore.BotEngine import BotEngine as Bot
 from copy import copy
 
 
+class FinanceTimeFrame(BotConfig.ConfigObject):
+    """
+    Time frame of the day in which the exchange rates are posted
+    """
+    __slots__ = ('id', 'start', 'end', 'disabled')
+
+    @classmethod
+    def from_reader(cls, reader):
+        return cls(id=reader.string('id'), start=reader.time('start'), end=reader.time('end'),
+                   disabled=reader.boolean('disabled'))
+
+
+class FinanceConfig(BotConfig.ConfigObject):
+    """
+    Config of the finance module (finance_mod.json)
+    """
+    __slots__ = ('check_interval', 'min_check_diff', 'channels', 'exchange_rate_frames', 'exchange_rate_commands',
+                 'ask_too_much_messages')
+
+    @classmethod
+    def from_reader(cls, reader):
+        options = reader.section('options')
+        return cls(
+            check_interval=options.number('check_interval', 5),
+            min_check_diff=options.number('min_check_diff', 10),
+            channels=options.string_list('channels'),
+            exchange_rate_frames=tuple(FinanceTimeFrame.from_reader(tf) for tf in
+                                       reader.section('time_frames').object_list('exchange_rates')),
+            exchange_rate_commands=reader.section('commands').string_list('exchange_rates'),
+            ask_too_much_messages=reader.section('messages').section('exchange_rates').string_list('ask_too_much'))
+
+
 class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
     """
     This class provides finance information such as exchange rate ...
     """
     exchange_rates_TIMER = 'FinanceMod.ExchangeRateTimer'
+    EXCHANGE_RATES_TRIGGER = 'FinanceMod.ExchangeRates'
     PREFS_NAME = 'finance_mod'
     MOD_NAME = 'finance_mod'
     MOD_DESC = 'This class provides finance information such as exchange rate ...'
     MAX_RESULTS = 3
     MAX_ATTACHMENTS = 5
+    EXCHANGE_RATES_URL = 'https://www.vietcombank.com.vn/exchangerates/ExrateXLS.aspx'
+    FETCH_TTL = 300  # in seconds
 
-    _check_interval = 5  # in seconds
-    _time_frames = {}
     _prefs = []
-    _channels = []
+    _prefs_lock = None
     _config = None
-    _messages = None
     _bot_info = {}
-    _min_check_diff = 10
 
     def __init__(self):
-        pass
+        self._config = FinanceConfig.load(None)
 
     def get_mod_name(self):
         return self.MOD_NAME
@@ -35,26 +66,34 @@ class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
         return self.MOD_DESC
 
     def on_timer(self, timer_id, bot_core):
-        today = time.strftime('%Y/%m/%d', time.localtime())
-        if 'working_day' not in self._prefs or today != self._prefs['working_day']:
-            self._prefs['working_day'] = today
-            self._prefs['processed_frames'] = {}
-            if 'result' in self._prefs:
-                del self._prefs['result']
-            bot_core.get_prefs().save_prefs(FinanceMod.PREFS_NAME, self._prefs)
+        today = time.strftime('%Y/%m/%d', bot_core.localtime())
+        with self._prefs_lock:
+            if 'working_day' not in self._prefs or today != self._prefs['working_day']:
+                self._prefs['working_day'] = today
+                self._prefs['processed_frames'] = {}
+                if 'result' in self._prefs:
+                    del self._prefs['result']
+                bot_core.get_prefs().save_prefs(FinanceMod.PREFS_NAME, self._prefs)
         if timer_id == FinanceMod.exchange_rates_TIMER:
             self.__on_exchange_rates_timer(bot_core)
 
     def on_registered(self, bot_core):
-        self.__parse_config(bot_core.get_config().get_path('finance_mod_config_file'))
+        self._config = FinanceConfig.load(bot_core.get_config().get_path('finance_mod_config_file'))
+        self._prefs_lock = bot_core.get_prefs().lock_prefs(FinanceMod.PREFS_NAME)
         self._prefs = bot_core.get_prefs().load_prefs(FinanceMod.PREFS_NAME)
         if self._prefs is None:
             self._prefs = {}
         self._bot_info = bot_core.get_bot_info()
-        bot_core.register_timer(self, FinanceMod.exchange_rates_TIMER, self._check_interval)
-        ts = time.strftime('%H:%M:%S', time.localtime())
+        bot_core.register_timer(self, FinanceMod.exchange_rates_TIMER, self._config.check_interval)
+        ts = time.strftime('%H:%M:%S', bot_core.localtime())
         bot_core.get_logger().info('[%s] module initialized at %s' % (FinanceMod.MOD_NAME, ts))
 
+    def get_triggers(self):
+        if len(self._config.exchange_rate_commands) == 0:
+            return []
+        return [BotEngine.BotTrigger(FinanceMod.EXCHANGE_RATES_TRIGGER, phrases=self._config.exchange_rate_commands,
+                                     mentioned=True)]
+
     def on_message(self, bot_core, msg):
         if not msg[Bot.KEY_IS_MESSAGE] or not msg[Bot.KEY_IS_BOT_MENTIONED]:
             return None
@@ -63,84 +102,45 @@ class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
             return None
         subs_dict = {'$(user)': msg[Bot.KEY_FROM_USER_NAME]}
 
-        if 'commands' not in self._config:
+        if Bot.KEY_TRIGGERS not in msg or FinanceMod.EXCHANGE_RATES_TRIGGER not in msg[Bot.KEY_TRIGGERS]:
             return None
-
-        commands = self._config['commands']
-
-        if 'exchange_rates' in commands:
-            xchg_cmds = commands['exchange_rates']
-            return self.__on_exchange_commands(xchg_cmds, msg, channel_id, bot_core, subs_dict)
-
-        return None
-
-    def __parse_config(self, config_file):
-        if config_file is None:
-            return
-        try:
-            f = open(config_file, "rt")
-            data = BotConfig.JsonLoader.json_load_byteified(f)
-            f.close()
-        except IOError:
-            return
-        self._config = data
-        if 'options' in self._config:
-            options = self._config['options']
-            if 'check_interval' in options:
-                self._check_interval = options['check_interval']
-            if 'channels' in options:
-                self._channels = options['channels']
-            if 'min_check_diff' in options:
-                self._min_check_diff = options['min_check_diff']
-        if 'time_frames' in self._config:
-            self._time_frames = self._config['time_frames']
-        if 'messages' in self._config:
-            self._messages = self._config['messages']
+        match = msg[Bot.KEY_TRIGGERS][FinanceMod.EXCHANGE_RATES_TRIGGER]
+        return self.__on_exchange_commands(match, msg, channel_id, bot_core, subs_dict)
 
     def __on_exchange_rates_timer(self, bot_core):
-        if 'exchange_rates' not in self._time_frames or len(self._channels) == 0:
+        if len(self._config.channels) == 0:
             return
-        time_frames = self._time_frames['exchange_rates']
         filters = None
-        for time_frame in time_frames:
-            for ch in self._channels:
+        for time_frame in self._config.exchange_rate_frames:
+            for ch in self._config.channels:
                 channel = bot_core.get_channel_by_name(ch)
                 if channel is not None and Bot.KEY_ID in channel:
                     channel_id = channel[Bot.KEY_ID]
-                    if self.__check_time_frame(channel_id, time_frame):
+                    if self.__check_time_frame(channel_id, time_frame, bot_core):
                         response = self.__process_exchange_rates(bot_core, channel_id, filters)
                         if response is not None:
                             # Mark this time frame as processed
                             bot_core.get_logger().info('[%s] display exchange rates in %s to channel %s'
-                                                       % (self.MOD_NAME, time_frame['id'], channel[Bot.KEY_NAME]))
-                            self._prefs['processed_frames'][channel_id][time_frame['id']] = True
-                            bot_core.get_prefs().save_prefs(FinanceMod.PREFS_NAME, self._prefs)
+                                                       % (self.MOD_NAME, time_frame.id, channel[Bot.KEY_NAME]))
+                            with self._prefs_lock:
+                                self._prefs['processed_frames'][channel_id][time_frame.id] = True
+                                bot_core.get_prefs().save_prefs(FinanceMod.PREFS_NAME, self._prefs)
                             bot_core.queue_response(response)
 
-    def __on_exchange_commands(self, xchg_cmds, msg, channel_id, bot_core, subs_dict):
-        phrase = None
-        for cmd in xchg_cmds:
-            pos = msg[Bot.KEY_STANDARDIZED_LOWER_TEXT].find(cmd)
-            if pos >= 0:
-                if pos > 0:
-                    phrase = msg[Bot.KEY_STANDARDIZED_LOWER_TEXT][:pos]
-                else:
-                    phrase = ''
-                phrase += msg[Bot.KEY_STANDARDIZED_LOWER_TEXT][pos + len(cmd):]
-                break
-        if phrase is None:
-            return None
+    def __on_exchange_commands(self, match, msg, channel_id, bot_core, subs_dict):
+        # The trigger index already located the command in the message
+        pos, cmd = match
+        text = msg[Bot.KEY_STANDARDIZED_LOWER_TEXT]
+        phrase = text[:pos] + text[pos + len(cmd):]
 
         if 'last_check_exchange_rates' in self._prefs:
             last_check = self._prefs['last_check_exchange_rates']
         else:
             last_check = 0
-        now = time.mktime(time.localtime())
-        if last_check + self._min_check_diff > now:
+        now = time.mktime(bot_core.localtime())
+        if last_check + self._config.min_check_diff > now:
             # User asks too much
-            reply_text = None
-            if 'exchange_rates' in self._messages and 'ask_too_much' in self._messages['exchange_rates']:
-                reply_text = BotUtils.RandomUtils.random_item_in_list(self._messages['exchange_rates']['ask_too_much'])
+            reply_text = BotUtils.RandomUtils.random_item_in_list(self._config.ask_too_much_messages)
             if reply_text is None:
                 # Return an empty object to specify that this message has been handled
                 return {}
@@ -171,44 +171,32 @@ class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
             channel_name = channel_id
         bot_core.get_logger().info(
             '[%s] response to exchange rates request to channel %s' % (self.MOD_NAME, channel_name))
-        bot_core.queue_response(response)
+        bot_core.queue_response(response, Bot.PRIORITY_REPLY)
         # Save preferences
-        self._prefs['last_check_exchange_rates'] = now
-        bot_core.get_prefs().save_prefs(FinanceMod.PREFS_NAME, self._prefs)
-
-    def __check_time_frame(self, channel_id, time_frame):
-        if 'id' in time_frame:
-            time_id = time_frame['id']
-        else:
-            return False
-
-        if 'start' in time_frame:
-            start_time = time_frame['start']
-        else:
-            return False
-
-        if 'end' in time_frame:
-            end_time = time_frame['end']
-        else:
-            return False
+        with self._prefs_lock:
+            self._prefs['last_check_exchange_rates'] = now
+            bot_core.get_prefs().save_prefs(FinanceMod.PREFS_NAME, self._prefs)
 
-        if 'disabled' in time_frame and time_frame['disabled']:
+    def __check_time_frame(self, channel_id, time_frame, bot_core):
+        if time_frame.disabled:
             return False
-
-        if 'processed_frames' in self._prefs:
-            # Skip already-processed frame
-            processed = self._prefs['processed_frames']
-            if channel_id in processed:
-                if time_id in processed[channel_id] and processed[channel_id][time_id]:
-                    return False
+        time_id = time_frame.id
+
+        with self._prefs_lock:
+            if 'processed_frames' in self._prefs:
+                # Skip already-processed frame
+                processed = self._prefs['processed_frames']
+                if channel_id in processed:
+                    if time_id in processed[channel_id] and processed[channel_id][time_id]:
+                        return False
+                else:
+                    self._prefs['processed_frames'][channel_id] = {}
             else:
-                self._prefs['processed_frames'][channel_id] = {}
-        else:
-            self._prefs['processed_frames'] = {}
-        now = time.localtime()
+                self._prefs['processed_frames'] = {channel_id: {}}
+        now = bot_core.localtime()
         today = time.strftime('%Y/%m/%d', now)
-        t_start = time.mktime(time.strptime(today + ' ' + start_time, '%Y/%m/%d %H:%M:%S'))
-        t_end = time.mktime(time.strptime(today + ' ' + end_time, '%Y/%m/%d %H:%M:%S'))
+        t_start = time.mktime(time.strptime(today + ' ' + time_frame.start, '%Y/%m/%d %H:%M:%S'))
+        t_end = time.mktime(time.strptime(today + ' ' + time_frame.end, '%Y/%m/%d %H:%M:%S'))
         t_now = time.mktime(now)
         if t_start > t_now or t_end < t_now:
             # Not in this time frame
@@ -216,18 +204,22 @@ class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
         return True
 
     def __process_exchange_rates(self, bot_core, channel_id, filters):
-        today = time.strftime('%Y/%m/%d', time.localtime())
+        today = time.strftime('%Y/%m/%d', bot_core.localtime())
         result = None
-        if 'result' in self._prefs:
-            if self._prefs['result']['date'] == today:
-                result = self._prefs['result']
-            else:
-                del self._prefs['result']
+        with self._prefs_lock:
+            if 'result' in self._prefs:
+                if self._prefs['result']['date'] == today:
+                    result = self._prefs['result']
+                else:
+                    del self._prefs['result']
         if result is None:
-            result = FinanceMod.__query_exchange_rates()
+            # Not holding the prefs lock while querying the server, workspaces of the process share the download
+            result = bot_core.get_fetch_cache().get_or_load(FinanceMod.EXCHANGE_RATES_URL,
+                                                            FinanceMod.__query_exchange_rates, ttl=FinanceMod.FETCH_TTL)
             if result is not None and today == result['date']:
-                self._prefs['result'] = result
-                bot_core.get_prefs().save_prefs(FinanceMod.PREFS_NAME, self._prefs)
+                with self._prefs_lock:
+                    self._prefs['result'] = result
+                    bot_core.get_prefs().save_prefs(FinanceMod.PREFS_NAME, self._prefs)
             else:
                 result = None
         if result is not None:
@@ -272,8 +264,7 @@ class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
         return tbl
 
     @staticmethod
-    def __downlooad_exchange_rates():
-        url = 'https://www.vietcombank.com.vn/exchangerates/ExrateXLS.aspx'
+    def __downlooad_exchange_rates(url):
         result = BotUtils.UrlUtils.download_to_string(url)
         """
         with open('test.htm', 'rb') as f:
@@ -290,8 +281,8 @@ class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
         return root
 
     @staticmethod
-    def __query_exchange_rates():
-        raw_data = FinanceMod.__downlooad_exchange_rates()
+    def __query_exchange_rates(url):
+        raw_data = FinanceMod.__downlooad_exchange_rates(url)
         if raw_data is None:
             return
         children = raw_data['children']
@@ -384,7 +375,7 @@ class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
                 attachments.append(attach)
 
         title = result['title']
-        for ch in self._channels:
+        for ch in self._config.channels:
             channel = bot_core.get_channel_by_name(ch)
             if channel is not None and Bot.KEY_ID in channel:
                 attch_cnt = len(attachments)
@@ -393,7 +384,7 @@ class FinanceMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
                              Bot.KEY_CHANNEL_ID: channel_id,
                              Bot.KEY_ATTACHMENTS: attachments})
                 else:
-                    file_name = time.strftime('exchange_rate_%Y%m%d.txt', time.localtime())
+                    file_name = time.strftime('exchange_rate_%Y%m%d.txt', bot_core.localtime())
                     return ({Bot.KEY_TEXT: filtered_reply if is_filtered else reply_text,
                              Bot.KEY_CHANNEL_ID: channel_id,
                              Bot.KEY_RESPONSE_TYPE: Bot.KEY_UPLOAD_RESPONSE,
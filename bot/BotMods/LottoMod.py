@@ -5,34 +5,62 @@ import time
 from defusedxml.cElementTree import fromstring
 
 
+class XsmbConfig(BotConfig.ConfigObject):
+    """
+    Config of the XSMB lotto item
+    """
+    __slots__ = ('disabled', 'check_start', 'check_end', 'check_interval', 'min_check_diff', 'max_results')
+
+    @classmethod
+    def from_reader(cls, reader):
+        check_time = reader.section('check_time')
+        return cls(
+            disabled=reader.boolean('disabled'),
+            check_start=check_time.time('start'),
+            check_end=check_time.time('end'),
+            check_interval=check_time.number('interval', 0),
+            min_check_diff=reader.number('min_check_diff', 60),
+            max_results=int(reader.number('max_results', 5, 1)))
+
+
+class LottoConfig(BotConfig.ConfigObject):
+    """
+    Config of the lotto module (lotto_mod.json)
+    """
+    __slots__ = ('check_interval', 'min_check_diff', 'channels', 'xsmb', 'result_commands', 'timer_messages',
+                 'on_demand_messages', 'ask_too_much_messages')
+
+    @classmethod
+    def from_reader(cls, reader):
+        options = reader.section('options')
+        lotto_items = reader.section('lotto_items')
+        messages = reader.section('messages')
+        return cls(
+            check_interval=options.number('check_interval', 5),
+            min_check_diff=options.number('min_check_diff', 5),
+            channels=options.string_list('channels'),
+            xsmb=XsmbConfig.from_reader(lotto_items.section('xsmb')) if lotto_items.has('xsmb') else None,
+            result_commands=reader.section('commands').string_list('result'),
+            timer_messages=messages.string_list('timer'),
+            on_demand_messages=messages.string_list('on_demand'),
+            ask_too_much_messages=messages.string_list('ask_too_much'))
+
+
 class XSMB:
     """
     This class provide information of the "XSMB" lotto result
     """
     PREFS_NAME = 'xsmb'
+    FETCH_TTL = 60  # in seconds
 
-    _start_check = None
-    _end_check = None
-    _check_interval = None
-    _min_check_diff = 60
     _last_check = 0
     _results = {}
-    _max_results = 5
 
     def __init__(self, config):
+        """
+        :param config: XsmbConfig object
+        """
         self._config = config
-        if 'check_time' in config:
-            ct = config['check_time']
-            if 'start' in ct:
-                self._start_check = ct['start']
-            if 'end' in ct:
-                self._end_check = ct['end']
-            if 'interval' in ct:
-                self._check_interval = ct['interval']
-        if 'min_check_diff' in config:
-            self._min_check_diff = int(config['min_check_diff'])
-        if 'max_results' in config:
-            self._max_results = config['max_results']
 
     def __filter_result(self, result_list):
         """
@@ -43,10 +71,10 @@ class XSMB:
         if result_list is None:
             return None
         ln = len(result_list)
-        if ln <= self._max_results:
+        if ln <= self._config.max_results:
             return result_list
 
-        need_del = ln - self._max_results
+        need_del = ln - self._config.max_results
         del_keys = []
         for key, _ in sorted(result_list.iteritems(), key=lambda (k, v): (k, v)):
             del_keys.append(key)
@@ -56,6 +84,10 @@ class XSMB:
             result_list.pop(key_to_del, None)
         return result_list
 
+    @staticmethod
+    def __prefs_lock(bot_core):
+        return bot_core.get_prefs().lock_prefs(LottoMod.PREFS_NAME)
+
     def get_results(self, bot_core, prefs):
         """
         Get the currently cached results.
@@ -64,10 +96,11 @@ class XSMB:
         :param prefs: module preferences data
         :return: results, None if errors occurred
         """
-        if self._results is None or len(self._results) == 0:
-            if XSMB.PREFS_NAME in prefs and 'results' in prefs[XSMB.PREFS_NAME]:
-                self._results = prefs[XSMB.PREFS_NAME]['results']
-        now = time.localtime()
+        with XSMB.__prefs_lock(bot_core):
+            if self._results is None or len(self._results) == 0:
+                if XSMB.PREFS_NAME in prefs and 'results' in prefs[XSMB.PREFS_NAME]:
+                    self._results = prefs[XSMB.PREFS_NAME]['results']
+        now = bot_core.localtime()
         today = time.strftime('%Y/%m/%d', now)
 
         # noinspection PyTypeChecker
@@ -75,13 +108,16 @@ class XSMB:
             self.__query_results(bot_core, prefs)
         else:
             if today not in self._results:
-                end_time = time.strftime('%Y/%m/%d ', now) + self._end_check
+                end_time = time.strftime('%Y/%m/%d ', now) + self._config.check_end
                 t_end = time.strptime(end_time, '%Y/%m/%d %H:%M:%S')
                 if now > t_end:
                     self.__query_results(bot_core, prefs)
 
-        # noinspection PyTypeChecker
-        return self.__filter_result(self._results)
+        with XSMB.__prefs_lock(bot_core):
+            # noinspection PyTypeChecker
+            results = self.__filter_result(self._results)
+            # The results may be shared with the prefs, the caller gets its own copy
+            return dict(results) if results is not None else None
 
     def __query_results(self, bot_core, prefs):
         """
@@ -92,25 +128,30 @@ class XSMB:
         """
         url = 'http://xskt.com.vn/rss-feed/mien-bac-xsmb.rss'
         bot_core.get_logger().info('[%s] start downloading result' % LottoMod.MOD_NAME)
-        result_list = self.__filter_result(XSMB.__parse_rss_data(url))
+        # Workspaces of the process share the download, the shared results are copied before filtering
+        year = time.strftime('%Y/', bot_core.localtime())
+        result_list = bot_core.get_fetch_cache().get_or_load(url, lambda key: XSMB.__parse_rss_data(key, year),
+                                                             ttl=XSMB.FETCH_TTL)
+        result_list = self.__filter_result(dict(result_list) if result_list is not None else None)
         bot_core.get_logger().info('[%s] finish downloading result: %s' %
                                    (LottoMod.MOD_NAME, 'None' if result_list is None else str(len(result_list))))
         need_update_prefs = False
 
-        if XSMB.PREFS_NAME not in prefs:
-            need_update_prefs = True
-            prefs[XSMB.PREFS_NAME] = {'results': {}, 'fired_timer': ''}
-
-        if result_list is not None:
-            # noinspection PyTypeChecker
-            for date in result_list:
-                if date not in prefs[XSMB.PREFS_NAME]:
-                    # noinspection PyUnresolvedReferences
-                    prefs[XSMB.PREFS_NAME]['results'][date] = result_list[date]
-                    need_update_prefs = True
-        if need_update_prefs:
-            bot_core.get_prefs().save_prefs(LottoMod.PREFS_NAME, prefs)
-        self._results = result_list
+        with XSMB.__prefs_lock(bot_core):
+            if XSMB.PREFS_NAME not in prefs:
+                need_update_prefs = True
+                prefs[XSMB.PREFS_NAME] = {'results': {}, 'fired_timer': ''}
+
+            if result_list is not None:
+                # noinspection PyTypeChecker
+                for date in result_list:
+                    if date not in prefs[XSMB.PREFS_NAME]:
+                        # noinspection PyUnresolvedReferences
+                        prefs[XSMB.PREFS_NAME]['results'][date] = result_list[date]
+                        need_update_prefs = True
+            if need_update_prefs:
+                bot_core.get_prefs().save_prefs(LottoMod.PREFS_NAME, prefs)
+            self._results = result_list
 
     def __query_today_result(self, bot_core, prefs):
         """
@@ -119,16 +160,17 @@ class XSMB:
         :param prefs: the module preferences data
         :return: today's result or None if errors occurred
         """
-        today = time.strftime('%Y/%m/%d', time.localtime())
+        today = time.strftime('%Y/%m/%d', bot_core.localtime())
         # today = '2017/04/10'
         if today in self._results:
             return self._results[today]
 
-        if XSMB.PREFS_NAME in prefs and 'results' in prefs[XSMB.PREFS_NAME]:
-            self._results = prefs[XSMB.PREFS_NAME]['results']
+        with XSMB.__prefs_lock(bot_core):
+            if XSMB.PREFS_NAME in prefs and 'results' in prefs[XSMB.PREFS_NAME]:
+                self._results = prefs[XSMB.PREFS_NAME]['results']
 
-        if today in self._results:
-            return self._results[today]
+            if today in self._results:
+                return self._results[today]
 
         # Perform the query and then extract information
         self.__query_results(bot_core, prefs)
@@ -138,10 +180,11 @@ class XSMB:
         return None
 
     @staticmethod
-    def __parse_rss_data(url):
+    def __parse_rss_data(url, year):
         """
         Parse the RSS data to get results
         :param url: url to RSS data to parse
+        :param year: year of the results followed by '/', the feed only gives their day and month
         :return: parsed results
         """
         data = BotUtils.UrlUtils.download_to_string(url)
@@ -156,17 +199,18 @@ class XSMB:
                 continue
             for item in child:
                 if item.tag == 'item':
-                    result = XSMB.__parse_rss_item(item)
+                    result = XSMB.__parse_rss_item(item, year)
                     if result is not None:
                         item_id = result['date']
                         result_list[item_id] = result
         return result_list
 
     @staticmethod
-    def __parse_rss_item(item):
+    def __parse_rss_item(item, year):
         """
         Parse a rss item describing a result
         :param item: item to parse
+        :param year: year of the result followed by '/'
         :return: parsed result
         """
         title = None
@@ -187,7 +231,7 @@ class XSMB:
         date = title[len(title_start):len(title_start) + 5]
         if date[2] != '/':
             return None
-        date = time.strftime('%Y/', time.localtime()) + date[3:] + '/' + date[:2]
+        date = year + date[3:] + '/' + date[:2]
         prizes = {}
         for line in desc.split('\n'):
             line = line.replace(' ', '')
@@ -214,24 +258,25 @@ class XSMB:
         :param prefs: module preferences data
         :return: today's result, None if errors occurred
         """
-        today = time.strftime('%Y/%m/%d', time.localtime())
+        today = time.strftime('%Y/%m/%d', bot_core.localtime())
         if (XSMB.PREFS_NAME in prefs and 'fired_timer' in prefs[XSMB.PREFS_NAME]
                 and prefs[XSMB.PREFS_NAME]['fired_timer'] == today):
                 return None
-        now = time.localtime()
-        start_time = time.strftime('%Y/%m/%d ', now) + self._start_check
-        end_time = time.strftime('%Y/%m/%d ', now) + self._end_check
+        now = bot_core.localtime()
+        start_time = time.strftime('%Y/%m/%d ', now) + self._config.check_start
+        end_time = time.strftime('%Y/%m/%d ', now) + self._config.check_end
 
         t_start = time.strptime(start_time, '%Y/%m/%d %H:%M:%S')
         t_end = time.strptime(end_time, '%Y/%m/%d %H:%M:%S')
         if t_start > now or t_end < now:
             return None
-        if time.mktime(time.localtime()) - self._last_check < self._check_interval:
+        if time.mktime(now) - self._last_check < self._config.check_interval:
             return None
         result = self.__query_today_result(bot_core, prefs)
         if result is not None:
-            prefs[XSMB.PREFS_NAME]['fired_timer'] = today
-            bot_core.get_prefs().save_prefs(LottoMod.PREFS_NAME, prefs)
+            with XSMB.__prefs_lock(bot_core):
+                prefs[XSMB.PREFS_NAME]['fired_timer'] = today
+                bot_core.get_prefs().save_prefs(LottoMod.PREFS_NAME, prefs)
 
         return result
 
@@ -242,41 +287,20 @@ class LottoMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
     """
     PREFS_NAME = 'lotto_mod'
     LOTTO_TIMER = 'LottoMod.timer'
+    RESULT_TRIGGER = 'LottoMod.result'
     MOD_NAME = 'lotto_mod'
     MOD_DESC = 'This module update lotto information and also provides user information when asked'
-    _min_check_diff = 5  # in seconds
     _bot_info = {}
-    _check_interval = 5  # in seconds
 
     def __init__(self):
         self._prefs = None
-        self._config = None
+        self._config = LottoConfig.load(None)
         self._lotto_list = []
 
-    def __parse_config(self, config_file):
-        if config_file is None:
-            return
-        try:
-            f = open(config_file, "rt")
-            data = BotConfig.JsonLoader.json_load_byteified(f)
-            f.close()
-        except IOError:
-            return
-        self._config = data
-        if 'options' in self._config:
-            if 'min_check_diff' in self._config['options']:
-                self._min_check_diff = self._config['options']['min_check_diff']
-            if 'check_interval' in self._config['options']:
-                self._check_interval = self._config['options']['check_interval']
-
     def __init_lotto_list(self):
-        if 'lotto_items' not in self._config:
-            return
-        lotto_items = self._config['lotto_items']
-        if 'xsmb' in lotto_items:
-            xsmb = lotto_items['xsmb']
-            if 'disabled' not in xsmb or not xsmb['disabled']:
-                self._lotto_list.append(XSMB(xsmb))
+        self._lotto_list = []
+        if self._config.xsmb is not None and not self._config.xsmb.disabled:
+            self._lotto_list.append(XSMB(self._config.xsmb))
 
     def __get_lotto_results(self, bot_core):
         """
@@ -291,9 +315,9 @@ class LottoMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
                 result_list.append(result)
         if len(result_list) == 0:
             return None
-        if 'messages' not in self._config or 'on_demand' not in self._config['messages']:
+        msg = BotUtils.RandomUtils.random_item_in_list(self._config.on_demand_messages)
+        if msg is None:
             return None
-        msg = BotUtils.RandomUtils.random_item_in_list(self._config['messages']['on_demand'])
         msg += '\n>>>'
         for results in result_list:
             for date, result in sorted(results.iteritems(), reverse=True, key=lambda (k, v): (k, v)):
@@ -311,18 +335,23 @@ class LottoMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
         return self.MOD_DESC
 
     def on_registered(self, bot_core):
-        config_file = bot_core.get_config().get_path('lotto_mod_config_file')
-        self.__parse_config(config_file)
+        self._config = LottoConfig.load(bot_core.get_config().get_path('lotto_mod_config_file'))
         self._prefs = bot_core.get_prefs().load_prefs(LottoMod.PREFS_NAME)
         if self._prefs is None:
             self._prefs = {}
 
         self._bot_info = bot_core.get_bot_info()
         self.__init_lotto_list()
-        bot_core.register_timer(self, LottoMod.LOTTO_TIMER, self._check_interval)
-        ts = time.strftime('%H:%M:%S', time.localtime())
+        bot_core.register_timer(self, LottoMod.LOTTO_TIMER, self._config.check_interval)
+        ts = time.strftime('%H:%M:%S', bot_core.localtime())
         bot_core.get_logger().info('[%s] module initialized at %s' % (LottoMod.MOD_NAME, ts))
 
+    def get_triggers(self):
+        if len(self._config.result_commands) == 0:
+            return []
+        return [BotEngine.BotTrigger(LottoMod.RESULT_TRIGGER, phrases=self._config.result_commands,
+                                     mentioned=True)]
+
     def on_message(self, bot_core, msg):
         if not msg[Bot.KEY_IS_MESSAGE] or not msg[Bot.KEY_IS_BOT_MENTIONED]:
             return None
@@ -331,26 +360,16 @@ class LottoMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
             return None
         subs_dict = {'$(user)': msg[Bot.KEY_FROM_USER_NAME]}
 
-        if 'commands' not in self._config or 'result' not in self._config['commands']:
-            return None
-        cmd_list = self._config['commands']['result']
-        cmd_found = False
-        for cmd in cmd_list:
-            if msg[Bot.KEY_STANDARDIZED_LOWER_TEXT].find(cmd) >= 0:
-                cmd_found = True
-                break
-        if not cmd_found:
+        if Bot.KEY_TRIGGERS not in msg or LottoMod.RESULT_TRIGGER not in msg[Bot.KEY_TRIGGERS]:
             return None
         if 'last_check' in self._prefs:
             last_check = self._prefs['last_check']
         else:
             last_check = 0
-        now = time.mktime(time.localtime())
-        if last_check + self._min_check_diff > now:
+        now = time.mktime(bot_core.localtime())
+        if last_check + self._config.min_check_diff > now:
             # User asks too much
-            reply_text = None
-            if 'messages' in self._config and 'ask_too_much' in self._config['messages']:
-                reply_text = BotUtils.RandomUtils.random_item_in_list(self._config['messages']['ask_too_much'])
+            reply_text = BotUtils.RandomUtils.random_item_in_list(self._config.ask_too_much_messages)
             if reply_text is None:
                 # Return an empty object to specify that this message has been handled
                 return {}
@@ -365,8 +384,9 @@ class LottoMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
         reply_text = Bot.replace_text(reply, subs_dict)
 
         # Save preferences
-        self._prefs['last_check'] = now
-        bot_core.get_prefs().save_prefs(LottoMod.PREFS_NAME, self._prefs)
+        with bot_core.get_prefs().lock_prefs(LottoMod.PREFS_NAME):
+            self._prefs['last_check'] = now
+            bot_core.get_prefs().save_prefs(LottoMod.PREFS_NAME, self._prefs)
 
         # Then return response
         bot_core.get_logger().info('[%s] replying to user %s' % (LottoMod.MOD_NAME, msg[Bot.KEY_FROM_USER_NAME]))
@@ -383,9 +403,9 @@ class LottoMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
             if result is not None:
                 result_list.append(result)
         msg = self.__format_scheduled_message(result_list)
-        if msg is None or 'options' not in self._config or 'channels' not in self._config['options']:
+        if msg is None:
             return
-        for chan in self._config['options']['channels']:
+        for chan in self._config.channels:
             channel = bot_core.get_channel_by_name(chan)
             if channel is None or Bot.KEY_ID not in channel:
                 continue
@@ -410,8 +430,8 @@ class LottoMod(BotEngine.BotBaseMod, BotEngine.BotTimer):
         if result_list is None or len(result_list) == 0:
             return None
         msg = {}
-        if 'messages' in self._config and 'timer' in self._config['messages']:
-            msg['text'] = BotUtils.RandomUtils.random_item_in_list(self._config['messages']['timer'])
+        if len(self._config.timer_messages) > 0:
+            msg['text'] = BotUtils.RandomUtils.random_item_in_list(self._config.timer_messages)
         attachments = []
         for result in result_list:
             attach = {'title': result['title'], 'text': result['date']}
@@ -2,6 +2,20 @@ from BotCore import *
 from BotCore.BotEngine import BotEngine as Bot
 
 
+class UnhandledMsgConfig(BotConfig.ConfigObject):
+    """
+    Config of the unhandled messages module (unhandled_msg_mod.json)
+    """
+    __slots__ = ('replay_percentage', 'mentioned', 'not_mentioned')
+
+    @classmethod
+    def from_reader(cls, reader):
+        return cls(
+            replay_percentage=min(reader.section('options').number('replay_percentage', 0), 100),
+            mentioned=reader.string_list('mentioned'),
+            not_mentioned=reader.string_list('not_mentioned'))
+
+
 class UnhandledMsgMod(BotEngine.BotBaseMod):
     """
     This module handles unhandled messages (messages that are not handled by all other modules)
@@ -9,29 +23,20 @@ class UnhandledMsgMod(BotEngine.BotBaseMod):
     PREFS_NAME = 'unhandled_msg_mod'
     _mod_name = 'unhandled_msg_mod'
     _mod_desc = 'This module handles unhandled messages (messages that are not handled by all other modules)'
-    _rules = {}
+    _config = None
     _bot_info = None
 
+    def __init__(self):
+        self._config = UnhandledMsgConfig.load(None)
+
     def get_mod_name(self):
         return self._mod_name
 
     def get_mod_desc(self):
         return self._mod_desc
 
-    def __parse_config(self, config_file):
-        if config_file is None:
-            return
-        try:
-            f = open(config_file, "rt")
-            data = BotConfig.JsonLoader.json_load_byteified(f)
-            f.close()
-        except IOError:
-            data = None
-        if data is not None:
-            self._rules = data
-
     def on_registered(self, bot_core):
-        self.__parse_config(bot_core.get_config().get_path('unhandled_msg_mod_config_file'))
+        self._config = UnhandledMsgConfig.load(bot_core.get_config().get_path('unhandled_msg_mod_config_file'))
         self._bot_info = bot_core.get_bot_info()
         bot_core.get_logger().info('[%s] module initialized' % self._mod_name)
 
@@ -53,25 +58,21 @@ class UnhandledMsgMod(BotEngine.BotBaseMod):
         channel_id = msg[Bot.KEY_RAW]['channel'].encode('utf-8')
         bot_mentioned = msg[Bot.KEY_IS_BOT_MENTIONED]
 
-        if bot_mentioned and 'options' in self._rules and 'replay_percentage' in self._rules['options']:
-            replay_percentage = int(self._rules['options']['replay_percentage'])
-            if replay_percentage > 100:
-                replay_percentage = 100
-            if BotUtils.RandomUtils.random_int(0, 100) <= replay_percentage:
+        if bot_mentioned and self._config.replay_percentage > 0:
+            if BotUtils.RandomUtils.random_int(0, 100) <= self._config.replay_percentage:
                 response_text = msg['raw']['text'].encode('utf-8').replace(
                     '<@%s>' % self._bot_info['id'], '@%s' % user_name)
-                response = {'text': response_text, 'channel': channel_id}
-                bot_core.queue_response(response)
+                response = {Bot.KEY_TEXT: response_text, Bot.KEY_CHANNEL_ID: channel_id}
+                bot_core.queue_response(response, Bot.PRIORITY_REPLY)
                 return
         response_vars = {'$(user)': user_name}
 
-        rule_name = 'mentioned' if bot_mentioned else 'not_mentioned'
-        if rule_name not in self._rules:
+        msg_list = self._config.mentioned if bot_mentioned else self._config.not_mentioned
+        if len(msg_list) == 0:
             return
-        msg_list = self._rules[rule_name]
         response_text = BotUtils.RandomUtils.random_item_in_list(msg_list)
 
         for var in response_vars:
             response_text = response_text.replace(var, response_vars[var])
         response = {Bot.KEY_TEXT: response_text, Bot.KEY_CHANNEL_ID: channel_id}
-        bot_core.queue_response(response)
+        bot_core.queue_response(response, Bot.PRIORITY_REPLY)
@@ -0,0 +1,218 @@
+from __future__ import print_function
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+# The bot runs in its own working directory, modules are imported after moving there
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from BotCore.BotConfig import BotConfig, ConfigCache, JsonLoader
+from BotCore.BotHttp import OfflineHttp
+from BotCore.BotRuntime import BotRuntime
+from BotCore.BotScheduler import VirtualClock
+from BotRunner import parse_options, init_bot
+
+
+def show_help():
+    print('Usage: BotReplay.py [Options]')
+    print('Replay a capture of RTM events (one JSON event per line) through the bot modules, without Slack')
+    print('Options:')
+    print('       --help: show this screen')
+    print('       --config=<config_file> (default: bot.conf)')
+    print('       --input=<capture_file>')
+    print('       --output=<responses_file> (default: responses.jsonl)')
+    print('       --directory=<directory_file>: JSON object with the "members", "channels" and "groups" lists')
+    print('                   of users.list, channels.list and groups.list, loaded before the replay')
+    print('       --speed=<factor>: replay <factor> times faster than recorded (default: 0, as fast as possible)')
+    print('       --seed=<number>: seed of the random choices of the modules (default: 0)')
+    print('       --fetches=<fetch_file>: JSON object of URL -> response body, served to the module downloads')
+    print('                   instead of the network, other downloads fail')
+    print('       --workdir=<dir>: working directory of the bot (prefs, logs, caches), its prefs are reset')
+    print('                   on each replay, default: a temporary directory removed once done')
+
+
+def read_capture(capture_file):
+    """
+    Read the recorded RTM events
+    :param capture_file: path of the JSONL capture
+    :return: (list of events, number of invalid lines) tuple
+    """
+    events = []
+    invalid = 0
+    with open(capture_file, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                invalid += 1
+                continue
+            if not isinstance(event, dict):
+                invalid += 1
+                continue
+            events.append(event)
+    return events, invalid
+
+
+def directory_events(directory_file):
+    """
+    Turn the lists of a directory file into the RTM events adding them to the directory
+    :param directory_file: path of the JSON directory file
+    :return: list of events, None if the file is not valid
+    """
+    directory = JsonLoader.load_file(directory_file)
+    if not isinstance(directory, dict):
+        return None
+    events = [{'type': 'team_join', 'user': user} for user in directory.get('members') or []]
+    events.extend({'type': 'channel_created', 'channel': channel} for channel in directory.get('channels') or [])
+    events.extend({'type': 'group_joined', 'channel': group} for group in directory.get('groups') or [])
+    return events
+
+
+def read_fetches(fetch_file):
+    """
+    Read the recorded module downloads
+    :param fetch_file: path of the JSON fetch file
+    :return: dictionary of URL -> response body, None if the file is not valid
+    """
+    fetches = JsonLoader.load_file(fetch_file)
+    if not isinstance(fetches, dict):
+        return None
+    bodies = {}
+    for url, body in fetches.iteritems():
+        if not isinstance(body, basestring):
+            return None
+        bodies[url.encode('utf-8')] = body.encode('utf-8') if isinstance(body, unicode) else body
+    return bodies
+
+
+def event_time(event, default):
+    try:
+        return float(event.get('ts', default))
+    except (TypeError, ValueError):
+        return default
+
+
+def replay(config_file, events, seed_events, output, speed, seed=0, fetches=None):
+    """
+    Replay events through a bot running on a virtual clock
+    :param config_file: path of the config file
+    :param events: list of RTM events
+    :param seed_events: list of events loading the directory before the replay
+    :param output: file object receiving the responses, one JSON object per line
+    :param speed: replay speed factor, 0 for as fast as possible
+    :param seed: seed of the random generator, replays of the same capture give the same responses
+    :param fetches: dictionary of URL -> response body of the module downloads, the replay never reaches the network
+    :return: dictionary of counters, None if the bot failed to start
+    """
+    # Prefs left by a previous replay in the same working directory would change the responses
+    shutil.rmtree(os.path.join(os.getcwd(), '.prefs'), ignore_errors=True)
+    random.seed(seed)
+    start = event_time(events[0], time.time()) if len(events) > 0 else time.time()
+    clock = VirtualClock(start)
+    config_cache = ConfigCache(os.path.join(os.getcwd(), '.cache'))
+    runtime = BotRuntime.from_config(BotConfig(config_file, config_cache), config_cache, clock=clock,
+                                     http=OfflineHttp(fetches))
+    # Modules are initialized one after the other so their timers are registered in the same order on every run
+    bot = init_bot(config_file, runtime, parallel_init=False)
+    if bot is None:
+        runtime.stop()
+        return None
+    stats = {'events': 0, 'responses': 0, 'timers': 0}
+
+    def capture(response, priority):
+        stats['responses'] += 1
+        output.write(json.dumps({'ts': clock.time(), 'priority': priority, 'response': response}) + '\n')
+
+    for event in seed_events:
+        bot.replay_event(event)
+    runtime.run_pending()
+    bot.start_replay(capture)
+    wall_start = time.time()
+    for event in events:
+        ts = event_time(event, clock.time())
+        if speed > 0:
+            delay = wall_start + (ts - start) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        stats['timers'] += runtime.advance_to(ts)
+        bot.replay_event(event)
+        runtime.run_pending()
+        stats['events'] += 1
+    stats['elapsed'] = time.time() - wall_start
+    stats['virtual_elapsed'] = clock.time() - start
+    stats['downloads'] = runtime.get_http().get_stats()['requests']
+    bot.stop()
+    runtime.stop()
+    return stats
+
+
+def main():
+    options = parse_options()
+    if 'help' in options or not options.get('input'):
+        show_help()
+        return 0 if 'help' in options else 1
+    config_file = os.path.abspath(options.get('config') or 'bot.conf')
+    capture_file = os.path.abspath(options['input'])
+    output_file = os.path.abspath(options.get('output') or 'responses.jsonl')
+    directory_file = os.path.abspath(options['directory']) if options.get('directory') else None
+    fetch_file = os.path.abspath(options['fetches']) if options.get('fetches') else None
+    try:
+        speed = float(options.get('speed') or 0)
+        seed = int(options.get('seed') or 0)
+    except ValueError:
+        print('Invalid speed or seed', file=sys.stderr)
+        return 1
+    for path in [config_file, capture_file] + [f for f in (directory_file, fetch_file) if f is not None]:
+        if not os.path.exists(path):
+            print('File not found: %s' % path, file=sys.stderr)
+            return 1
+
+    events, invalid = read_capture(capture_file)
+    if invalid > 0:
+        print('%d invalid lines skipped' % invalid, file=sys.stderr)
+    seed_events = []
+    if directory_file is not None:
+        seed_events = directory_events(directory_file)
+        if seed_events is None:
+            print('Invalid directory file: %s' % directory_file, file=sys.stderr)
+            return 1
+    fetches = None
+    if fetch_file is not None:
+        fetches = read_fetches(fetch_file)
+        if fetches is None:
+            print('Invalid fetch file: %s' % fetch_file, file=sys.stderr)
+            return 1
+
+    # The replayed bot keeps its prefs and caches away from the ones of the live bot
+    work_dir = options.get('workdir')
+    temp_dir = None
+    if not work_dir:
+        work_dir = temp_dir = tempfile.mkdtemp(prefix='bot_replay_')
+    elif not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        with open(output_file, 'wb') as output:
+            stats = replay(config_file, events, seed_events, output, speed, seed, fetches)
+    finally:
+        os.chdir(cwd)
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    if stats is None:
+        print('Failed to initialize the bot', file=sys.stderr)
+        return 1
+    print('%(events)d events replayed in %(elapsed).3fs (%(virtual_elapsed).0fs recorded), '
+          '%(timers)d timers fired, %(responses)d responses, %(downloads)d downloads served offline' % stats)
+    if stats['elapsed'] > 0:
+        print('%.1f events/s' % (stats['events'] / stats['elapsed']))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,29 @@
 from __future__ import print_function
+from BotCore.BotConfig import BotConfig, ConfigCache, ConfigError
+from BotCore.BotRuntime import BotRuntime
 from BotCore.BotEngine import BotEngine
+from threading import Thread
 import pkgutil
 import BotMods
+import json
+import re
 import sys
 import os
+import signal
+import time
+# time.strptime imports _strptime on first use, which is not thread-safe:
+# import it before the modules parse their configs in parallel
+import _strptime
 
 PID_FILE = 'cac_cu_bot.pid'
+MANIFEST_FILE = os.path.join('.cache', 'modules.json')
 
 
 def show_help():
     print('Usage: BotRunner.py [Options]')
     print('Options:')
     print('       --help: show this screen')
-    print('       --config=<config_file>')
+    print('       --config=<config_file>[,<config_file>...] (one config file per workspace)')
 
 
 def parse_options():
@@ -37,38 +48,166 @@ def parse_options():
     return options
 
 
-def init_bot(config_file_path):
+def mod_name_from_file(file_name):
     """
-    Initialize the bot object
-    :param config_file_path: path to the config file
-    :return: object pointing to bot engine
+    Guess the module name from the file name, following the naming convention (FinanceMod -> finance_mod)
+    :param file_name: file name of the module, without extension
+    :return: the module name
     """
-    mods = []
+    return re.sub(r'(?<!^)([A-Z])', r'_\1', file_name).lower()
 
-    for _, mod_name, _ in pkgutil.iter_modules(BotMods.__path__):
-        if mod_name.endswith('Mod') and not mod_name.startswith('_'):
-            the_package = __import__('BotMods.' + mod_name)
-            the_module = getattr(the_package, mod_name)
-            the_class = getattr(the_module, mod_name)
-            mods.append(the_class())
 
-    bot = BotEngine(config_file_path)
-    for mod in mods:
+def load_manifest():
+    """
+    Load the module manifest: module names of the module files, as found the last time they have been imported
+    :return: dictionary of file name -> {'name': module name, 'mtime': file modification time}
+    """
+    try:
+        with open(MANIFEST_FILE, 'rb') as f:
+            manifest = json.load(f)
+        if isinstance(manifest, dict):
+            return manifest
+    except (IOError, ValueError):
+        pass
+    return {}
+
+
+def save_manifest(manifest):
+    tmp_path = MANIFEST_FILE + '.tmp'
+    try:
+        if not os.path.exists(os.path.dirname(MANIFEST_FILE)):
+            os.makedirs(os.path.dirname(MANIFEST_FILE))
+        with open(tmp_path, 'wb') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, MANIFEST_FILE)
+    except (IOError, OSError):
+        pass
+
+
+def discover_mods(bot, timings):
+    """
+    Import and instantiate the enabled modules of BotMods.
+    Disabled modules are not imported: their name comes from the manifest, or from the naming convention.
+    :param bot: the bot engine
+    :param timings: dictionary updated with the import time of each module
+    :return: list of module objects, in file name order
+    """
+    manifest = load_manifest()
+    updated = False
+    mods = []
+    for _, file_name, _ in pkgutil.iter_modules(BotMods.__path__):
+        if not file_name.endswith('Mod') or file_name.startswith('_'):
+            continue
+        try:
+            mtime = os.path.getmtime(os.path.join(BotMods.__path__[0], file_name + '.py'))
+        except OSError:
+            mtime = None
+        entry = manifest.get(file_name)
+        if entry is not None and entry.get('mtime') == mtime:
+            mod_name = entry.get('name')
+        else:
+            mod_name = mod_name_from_file(file_name)
+        if bot.get_config().is_module_disabled(mod_name):
+            bot.get_logger().info('Skip DISABLED module "%s"' % mod_name)
+            continue
+
+        t = time.time()
+        the_package = __import__('BotMods.' + file_name)
+        the_module = getattr(the_package, file_name)
+        the_class = getattr(the_module, file_name)
+        mod = the_class()
+        timings[mod] = [time.time() - t, 0]
         mod_name = mod.get_mod_name()
         if mod_name is None or mod_name == '':
             bot.get_logger().warning('module class "%s" has no name!' % type(mod).__name__)
+        if entry is None or entry.get('mtime') != mtime or entry.get('name') != mod_name:
+            manifest[file_name] = {'name': mod_name, 'mtime': mtime}
+            updated = True
         if bot.get_config().is_module_disabled(mod_name):
-            # Skip the disabled module
+            # The name does not follow the convention, it is known from the manifest next time
             bot.get_logger().info('Skip DISABLED module "%s"' % mod_name)
             continue
+        mods.append(mod)
+    if updated:
+        save_manifest(manifest)
+    return mods
+
+
+def init_bot(config_file_path, runtime=None, parallel_init=None):
+    """
+    Initialize the bot object
+    :param config_file_path: path to the config file
+    :param runtime: BotRuntime shared by the workspaces of the process, None for a single workspace
+    :param parallel_init: True to initialize the modules concurrently, None for the [engine] parallel_init option
+    :return: object pointing to bot engine
+    """
+    t_start = time.time()
+    bot = BotEngine(config_file_path, runtime)
+    t_engine = time.time() - t_start
+    timings = {}
+    mods = discover_mods(bot, timings)
 
-        bot.get_logger().info('Module "%s" loaded' % mod_name)
+    # Modules are registered in order (it is the routing order), then initialized concurrently
+    for mod in mods:
+        bot.get_logger().info('Module "%s" loaded' % mod.get_mod_name())
         bot.register_mod(mod)
-        mod.on_registered(bot)
 
+    errors = {}
+
+    def register(the_mod):
+        t = time.time()
+        try:
+            the_mod.on_registered(bot)
+        except Exception as e:
+            errors[the_mod] = (e, sys.exc_info())
+        timings[the_mod][1] = time.time() - t
+
+    if parallel_init is None:
+        parallel_init = bot.get_config().get_bool_option('engine', 'parallel_init', True)
+    if parallel_init and len(mods) > 1:
+        threads = [Thread(target=register, args=(mod,), name='BotInit-%s' % mod.get_mod_name()) for mod in mods]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    else:
+        for mod in mods:
+            register(mod)
+
+    for mod in mods:
+        if mod not in errors:
+            continue
+        err, exc_info = errors[mod]
+        if isinstance(err, ConfigError):
+            # Invalid configs are reported at startup instead of when handling messages
+            bot.get_logger().error('Module "%s": invalid config: %s' % (mod.get_mod_name(), err))
+        else:
+            bot.get_logger().error('Module "%s": initialization failed' % mod.get_mod_name(), exc_info=exc_info)
+        bot.stop()
+        return None
+
+    bot.get_logger().info('Startup: engine %.3fs, modules %.3fs (%s)' % (
+        t_engine, time.time() - t_start - t_engine,
+        ', '.join('%s: import %.3fs, init %.3fs' % (mod.get_mod_name(), timings[mod][0], timings[mod][1])
+                  for mod in mods)))
+    bot.get_logger().info('Config cache: %(hits)d hits, %(misses)d misses' % bot.get_config_cache().get_stats())
     return bot
 
 
+def stop_bots(bots, runtime=None):
+    """
+    Stop the bot objects, then their shared runtime
+    :param bots: list of bot engines
+    :param runtime: BotRuntime shared by the bots, None if each bot has its own
+    :return: None
+    """
+    for bot in bots:
+        if bot.is_running():
+            bot.stop()
+    if runtime is not None:
+        runtime.stop()
+
+
 def main():
     """
     The program entry point
@@ -79,17 +218,14 @@ def main():
         show_help()
         return 0
 
-    if 'config' in options:
-        config_file_path = options['config']
-    else:
-        config_file_path = None
-
-    if config_file_path is None or config_file_path == '':
-        config_file_path = 'bot.conf'
+    config_file_paths = [path for path in options.get('config', '').split(',') if path != '']
+    if len(config_file_paths) == 0:
+        config_file_paths = ['bot.conf']
 
-    if not os.path.exists(config_file_path):
-        print("Config file not found!")
-        return 1
+    for config_file_path in config_file_paths:
+        if not os.path.exists(config_file_path):
+            print("Config file not found: %s" % config_file_path)
+            return 1
 
     try:
         with open(PID_FILE, "wb") as f:
@@ -99,13 +235,37 @@ def main():
         print("Failed to write PID file", file=sys.stderr)
         return 1
 
-    bot = init_bot(config_file_path)
-    if bot is None:
-        print("Failed to initialized bot object")
-        return 1
+    # Several workspaces share one runtime (worker pools, scheduler, fetch caches)
+    runtime = None
+    if len(config_file_paths) > 1:
+        config_cache = ConfigCache(os.path.join(os.getcwd(), '.cache'))
+        runtime = BotRuntime.from_config(BotConfig(config_file_paths[0], config_cache), config_cache)
+
+    bots = []
+    for config_file_path in config_file_paths:
+        bot = init_bot(config_file_path, runtime)
+        if bot is None:
+            print("Failed to initialized bot object: %s" % config_file_path)
+            stop_bots(bots, runtime)
+            return 1
+        bots.append(bot)
+
+    def on_stop_signal(signum, frame):
+        bots[0].get_logger().info('Signal %d received, stopping' % signum)
+        stop_bots(bots, runtime)
+
+    signal.signal(signal.SIGTERM, on_stop_signal)
+    signal.signal(signal.SIGINT, on_stop_signal)
+
+    for bot in bots:
+        if not bot.run():
+            stop_bots(bots, runtime)
+            return 1
 
-    bot.run()
-    return 1
+    # Signals are only handled by the main thread, keep it alive until the bots stop
+    while any(bot.is_running() for bot in bots):
+        time.sleep(1)
+    return 0
 
 if __name__ == "__main__":
     main()
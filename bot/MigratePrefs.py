@@ -0,0 +1,66 @@
+from __future__ import print_function
+from BotCore.BotPrefs import JsonPrefsBackend, SqlitePrefsBackend
+from BotRunner import parse_options
+import os
+import sys
+
+
+def show_help():
+    print('Usage: MigratePrefs.py [Options]')
+    print('Import the JSON prefs files (*.pref) into the SQLite prefs database')
+    print('Options:')
+    print('       --help: show this screen')
+    print('       --prefs-dir=<prefs_dir> (default: .prefs)')
+    print('       --db=<database_file_name> (default: %s, in the prefs directory)' % SqlitePrefsBackend.FILE_NAME)
+    print('       --force: replace the namespaces already in the database')
+
+
+def migrate(prefs_dir, db_file_name, force=False):
+    """
+    Import the JSON prefs files into the SQLite database
+    :param prefs_dir: directory of the prefs files
+    :param db_file_name: database file name
+    :param force: True to replace the namespaces already in the database
+    :return: number of files that could not be imported
+    """
+    json_backend = JsonPrefsBackend(prefs_dir)
+    db_backend = SqlitePrefsBackend(prefs_dir, db_file_name)
+    errors = 0
+    items = []
+    for file_name in sorted(os.listdir(prefs_dir)):
+        pref_name, ext = os.path.splitext(file_name)
+        if ext != JsonPrefsBackend.EXTENSION:
+            continue
+        prefs = json_backend.load(pref_name)
+        if not isinstance(prefs, dict):
+            print('%s: not a valid prefs file, skipped' % file_name, file=sys.stderr)
+            errors += 1
+            continue
+        if not force and db_backend.has_namespace(pref_name):
+            print('%s: already in the database, skipped' % pref_name)
+            continue
+        items.append((pref_name, prefs, None))
+        print('%s: %d keys' % (pref_name, len(prefs)))
+    # All the namespaces are imported in one transaction
+    for (pref_name, _, _), result in zip(items, db_backend.store_many(items)):
+        if not result:
+            print('%s: import failed' % pref_name, file=sys.stderr)
+            errors += 1
+    db_backend.close()
+    return errors
+
+
+def main():
+    options = parse_options()
+    if 'help' in options:
+        show_help()
+        return 0
+    prefs_dir = options.get('prefs-dir') or '.prefs'
+    if not os.path.isdir(prefs_dir):
+        print('Prefs directory not found!', file=sys.stderr)
+        return 1
+    errors = migrate(prefs_dir, options.get('db') or SqlitePrefsBackend.FILE_NAME, 'force' in options)
+    return 1 if errors > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
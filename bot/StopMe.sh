@@ -1,5 +1,12 @@
 #!/bin/bash
 PID_FILE=cac_cu_bot.pid
 if [ -f $PID_FILE ]; then
-	kill -9 $(cat $PID_FILE)
+	PID=$(cat $PID_FILE)
+	# Let the bot flush its prefs, kill it if it does not stop in time
+	kill -TERM $PID 2>/dev/null
+	for i in $(seq 1 15); do
+		kill -0 $PID 2>/dev/null || break
+		sleep 1
+	done
+	kill -9 $PID 2>/dev/null
 fi
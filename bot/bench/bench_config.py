@@ -0,0 +1,138 @@
+"""
+Measure the startup cost of loading bot.conf and the JSON config files it points to.
+Compares parsing on every start with a cold and a warm compiled config cache, then times whole
+BotRunner.init_bot starts (engine and modules, with the stand-in Slack client of bench_pipeline) with an
+empty .cache directory and with the .cache left by the previous start (compiled configs, module manifest,
+snapshot). Modules are imported once per process, so only the first start pays for the imports.
+Usage: python bench/bench_config.py [--config=<config_file>] [--rounds=<count>] [--starts=<count>]
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from BotCore.BotConfig import BotConfig, ConfigCache, JsonLoader
+from BotCore.BotRuntime import BotRuntime
+import BotCore.BotEngine
+import BotRunner
+from bench_pipeline import FakeSlackClient, FakeWebApi, make_directory
+
+JSON_PATHS = ['user_config_file', 'idle_mod_config_file', 'unhandled_msg_mod_config_file',
+              'lotto_mod_config_file', 'finance_mod_config_file']
+
+
+def load_all(config_file, cache):
+    JsonLoader.set_cache(cache)
+    config = BotConfig(config_file, cache)
+    for name in JSON_PATHS:
+        JsonLoader.load_file(config.get_path(name))
+
+
+def start_bot(config_file, members, channels):
+    """
+    Initialize a bot in the working directory and stop it
+    :return: init_bot duration (in seconds), None if the bot failed to start
+    """
+    config_cache = ConfigCache(os.path.join(os.getcwd(), '.cache'))
+    runtime = BotRuntime(config_cache=config_cache, http=FakeWebApi(members, channels))
+    start = timeit.default_timer()
+    bot = BotRunner.init_bot(config_file, runtime)
+    elapsed = timeit.default_timer() - start
+    if bot is not None:
+        bot.stop()
+    runtime.stop()
+    JsonLoader.set_cache(None)
+    return elapsed if bot is not None else None
+
+
+def bench_init_bot(config_file, starts):
+    """
+    Time init_bot starts with a cold and a warm .cache directory
+    :return: list of (scenario, list of durations) tuples, None if the bot failed to start
+    """
+    config_file = os.path.abspath(config_file)
+    members, channels = make_directory(config_file, 200, 0)
+    BotCore.BotEngine.SlackClient = FakeSlackClient
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='bot_bench_')
+    os.chdir(work_dir)
+    try:
+        first = start_bot(config_file, members, channels)
+        if first is None:
+            return None
+        cold = []
+        warm = []
+        for _ in range(starts):
+            shutil.rmtree(os.path.join(work_dir, '.cache'), ignore_errors=True)
+            cold.append(start_bot(config_file, members, channels))
+            warm.append(start_bot(config_file, members, channels))
+        if None in cold or None in warm:
+            return None
+        return [('first start', [first]), ('cold .cache', cold), ('warm .cache', warm)]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def parse_args(args=None):
+    """
+    Parse the command line, exits on --help and on invalid options
+    :param args: list of arguments, None for sys.argv
+    :return: argparse.Namespace object
+    """
+    parser = argparse.ArgumentParser(description='Measure the startup cost of loading the bot configs.')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conf',
+                                                         'bot.conf'),
+                        help='bot config file (default: conf/bot.conf)')
+    parser.add_argument('--rounds', type=int, default=200,
+                        help='config loads timed per scenario (default: %(default)s)')
+    parser.add_argument('--starts', type=int, default=10,
+                        help='init_bot starts timed per scenario (default: %(default)s)')
+    return parser.parse_args(args)
+
+
+def main():
+    options = parse_args()
+    config_file = options.config
+    rounds = max(1, options.rounds)
+    starts = max(1, options.starts)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        def cold():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            load_all(config_file, ConfigCache(cache_dir))
+
+        def warm():
+            load_all(config_file, ConfigCache(cache_dir))
+
+        scenarios = [
+            ('no cache', lambda: load_all(config_file, None)),
+            ('cold cache', cold),
+            ('warm cache', warm),
+        ]
+        print('%-12s %12s' % ('scenario', 'ms/start'))
+        for name, func in scenarios:
+            elapsed = min(timeit.repeat(func, number=rounds, repeat=3))
+            print('%-12s %12.3f' % (name, elapsed * 1e3 / rounds))
+    finally:
+        JsonLoader.set_cache(None)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    results = bench_init_bot(config_file, starts)
+    if results is None:
+        print('init_bot failed')
+        return 1
+    print()
+    print('%-12s %12s %12s' % ('init_bot', 'min ms', 'median ms'))
+    for name, durations in results:
+        durations = sorted(durations)
+        print('%-12s %12.3f %12.3f' % (name, durations[0] * 1e3, durations[len(durations) // 2] * 1e3))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# coding=utf-8
+"""
+Measure the per-event cost of message pre-processing.
+Compares the former eager dictionary building with the lazy BotMessage object.
+Usage: python bench/bench_message.py [--events=<count>]
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from BotCore.BotMessage import BotMessage, MentionTokens
+
+BOT_NAME = 'cac_cu'
+BOT_ID = 'U0BOT0001'
+
+EVENTS = [
+    {'type': 'message', 'channel': u'C01', 'user': u'U01', 'ts': u'1.0',
+     'text': u'Hôm nay trời đẹp quá mọi người ơi, đi cà phê không'},
+    {'type': 'message', 'channel': u'C01', 'user': u'U02', 'ts': u'2.0',
+     'text': u'<@U0BOT0001> tỉ giá usd hôm nay thế nào'},
+    {'type': 'user_typing', 'channel': u'C01', 'user': u'U03'},
+    {'type': 'message', 'channel': u'C02', 'user': u'U04', 'ts': u'3.0',
+     'text': u'ok'},
+]
+
+
+def legacy_preprocess(msg):
+    # Former BotEngine.__preprocess_msg, channel/member lookups left out
+    the_msg = {'raw': msg}
+    if 'type' in msg and msg['type'] == 'message' and 'subtype' not in msg and 'channel' in msg:
+        the_msg['is_message'] = True
+        the_msg['channel_id'] = msg['channel'].encode('utf-8')
+        bot_mentioned = False
+        if 'user' in msg:
+            the_msg['from_user_id'] = msg['user'].encode('utf-8')
+        if 'text' in msg:
+            the_msg['raw_words'] = [s.encode('utf-8') for s in msg['text'].split()]
+            the_msg['std_text'] = ' '.join(the_msg['raw_words'])
+            the_msg['raw_lower_words'] = [s.encode('utf-8').lower() for s in msg['text'].split()]
+            the_msg['std_lower_text'] = ' '.join(the_msg['raw_lower_words'])
+            for word in the_msg['raw_lower_words']:
+                if word == '<@' + BOT_NAME + '>' or word == BOT_NAME:
+                    bot_mentioned = True
+                    break
+            if not bot_mentioned:
+                for word in the_msg['raw_words']:
+                    if word == '<@' + BOT_ID + '>':
+                        bot_mentioned = True
+                        break
+        the_msg['is_bot_mentioned'] = bot_mentioned
+    else:
+        the_msg['is_message'] = False
+    return the_msg
+
+
+TOKENS = MentionTokens(BOT_NAME, BOT_ID)
+
+
+def lazy_preprocess(msg):
+    if msg.get('type') != 'message' or 'subtype' in msg or 'channel' not in msg:
+        return BotMessage(msg)
+    user_id = msg['user'].encode('utf-8') if 'user' in msg else None
+    return BotMessage(msg, msg['channel'].encode('utf-8'), None, user_id, None, TOKENS)
+
+
+def run_pipeline(preprocess, read_keys):
+    for event in EVENTS:
+        msg = preprocess(event)
+        for key in read_keys:
+            msg.get(key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the per-event cost of message pre-processing.')
+    parser.add_argument('--events', type=int, default=20000,
+                        help='events pre-processed per scenario (default: %(default)s)')
+    count = parser.parse_args().events
+    rounds = max(count // len(EVENTS), 1)
+    scenarios = [
+        ('is_message only', ['is_message']),
+        ('mention routing', ['is_message', 'is_bot_mentioned']),
+        ('command parsing', ['is_message', 'is_bot_mentioned', 'std_lower_text']),
+    ]
+    print('%-20s %14s %14s' % ('scenario', 'legacy us/evt', 'lazy us/evt'))
+    for name, keys in scenarios:
+        results = []
+        for preprocess in (legacy_preprocess, lazy_preprocess):
+            elapsed = min(timeit.repeat(lambda: run_pipeline(preprocess, keys), number=rounds, repeat=3))
+            results.append(elapsed * 1e6 / (rounds * len(EVENTS)))
+        print('%-20s %14.2f %14.2f' % (name, results[0], results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+"""
+Measure the message pipeline with a stand-in Slack client: generated events (bot mentions, module commands and
+ambient chatter) are read by BotEngine.on_check_messages, preprocessed, routed and dispatched to the modules,
+then the responses go through the send path against a fake Web API.
+Reports the throughput and p50/p99 latency of each stage, saves them as JSON and compares them with a baseline,
+the exit status is 3 when a stage is slower than the baseline (2 is left to invalid options).
+Usage: python bench/bench_pipeline.py [--config=<config_file>] [--events=<count>] [--batch=<size>]
+                                      [--mix=<mentions>:<commands>:<chatter>] [--users=<count>] [--channels=<count>]
+                                      [--seed=<number>] [--output=<json_file>]
+                                      [--baseline=<json_file>] [--tolerance=<percent>]
+"""
+from __future__ import print_function
+import argparse
+import ConfigParser
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+from collections import deque
+from threading import Condition, Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from BotCore.BotConfig import BotConfig, ConfigCache
+from BotCore.BotEngine import BotEngine
+from BotCore.BotHttp import HttpResponse
+from BotCore.BotRuntime import BotRuntime
+import BotCore.BotEngine
+import BotRunner
+
+CHATTER_WORDS = [u'h\xf4m', u'nay', u'tr\u1eddi', u'\u0111\u1eb9p', u'qu\xe1', u'\u0103n', u'tr\u01b0a',
+                 u'ch\u01b0a', u'deploy', u'xong', u'r\u1ed3i', u'build', u'l\u1ed7i', u'meeting', u'l\xfac',
+                 u'm\u1ea5y', u'gi\u1edd', u'cafe', u'kh\xf4ng', u'ok']
+
+
+class FakeSlackClient(object):
+    """
+    Stand-in SlackClient: RTM reads return the queued event batches
+    """
+    batches = deque()
+
+    class Server(object):
+        websocket = None
+
+    def __init__(self, token=None):
+        self.token = token
+        self.server = FakeSlackClient.Server()
+
+    def rtm_connect(self, **kwargs):
+        return True
+
+    def rtm_read(self):
+        try:
+            return FakeSlackClient.batches.popleft()
+        except IndexError:
+            return []
+
+
+class FakeWebApi(object):
+    """
+    Stand-in HTTP transport of the runtime serving a synthetic directory to the Web API calls.
+    Module downloads get a 404 so the benchmark never touches the network.
+    """
+
+    def __init__(self, members, channels):
+        self._results = {
+            'users.list': {'ok': True, 'members': members},
+            'channels.list': {'ok': True, 'channels': channels},
+            'groups.list': {'ok': True, 'groups': []},
+        }
+        self._channels = dict((channel['id'], channel) for channel in channels)
+        self._calls = {}
+        self._lock = Lock()
+
+    def post_form(self, url, fields, headers=None, timeout=None, idempotent=False):
+        method = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self._calls[method] = self._calls.get(method, 0) + 1
+        result = self._results.get(method)
+        if result is None and method.endswith('.info'):
+            channel = self._channels.get(fields.get('channel'))
+            result = {'ok': True, 'channel': channel} if channel is not None else {'ok': False,
+                                                                                  'error': 'channel_not_found'}
+        if result is None:
+            result = {'ok': True, 'ts': '%.6f' % time.time()}
+        return HttpResponse(200, {}, json.dumps(result))
+
+    def get(self, url, headers=None, timeout=None):
+        return HttpResponse(404, {}, '')
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._calls)
+
+    def close(self):
+        pass
+
+
+class StageTimer(object):
+    """
+    Collect the durations of the calls of the wrapped functions, per stage
+    """
+
+    def __init__(self):
+        self._samples = {}
+        self._lock = Lock()
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = timeit.default_timer() - start
+                with self._lock:
+                    self._samples.setdefault(stage, []).append(elapsed)
+        return timed
+
+    @staticmethod
+    def __percentile(samples, percent):
+        return samples[int(round(percent / 100.0 * (len(samples) - 1)))]
+
+    def report(self):
+        """
+        :return: dictionary of stage: {count, total_s, per_s, p50_ms, p99_ms, max_ms}
+        """
+        report = {}
+        with self._lock:
+            for stage, samples in self._samples.iteritems():
+                samples = sorted(samples)
+                total = sum(samples)
+                report[stage] = {
+                    'count': len(samples),
+                    'total_s': total,
+                    'per_s': len(samples) / total if total > 0 else 0,
+                    'p50_ms': StageTimer.__percentile(samples, 50) * 1e3,
+                    'p99_ms': StageTimer.__percentile(samples, 99) * 1e3,
+                    'max_ms': samples[-1] * 1e3,
+                }
+        return report
+
+
+def make_directory(config_file, user_count, extra_channels):
+    """
+    Build the synthetic workspace: the bot, user_count users, the enabled channels of the config and
+    extra_channels channels the bot ignores
+    :return: (members, channels) tuple of Web API lists
+    """
+    members = [{'id': 'UBOT', 'name': BotEngine.BOT_NAME}]
+    members.extend({'id': 'U%04d' % i, 'name': 'user%d' % i} for i in range(user_count))
+    parser = ConfigParser.ConfigParser()
+    parser.read(config_file)
+    names = []
+    if parser.has_section('enabled_channels'):
+        names = [name for name, value in parser.items('enabled_channels') if value.lower() == 'true']
+    names.extend('bench%d' % i for i in range(extra_channels))
+    channels = [{'id': 'C%04d' % i, 'name': name} for i, name in enumerate(names)]
+    return members, channels
+
+
+def make_events(count, mix, members, channels, commands, rnd):
+    """
+    Generate RTM message events
+    :param mix: (mentions, commands, chatter) weights
+    :param commands: command phrases of the modules
+    :return: list of events
+    """
+    users = [member['id'] for member in members if member['id'] != 'UBOT']
+    kinds = ['mention'] * mix[0] + ['command'] * mix[1] + ['chatter'] * mix[2]
+    ts = time.time()
+    events = []
+    for i in range(count):
+        kind = rnd.choice(kinds)
+        words = u' '.join(rnd.choice(CHATTER_WORDS) for _ in range(rnd.randint(2, 12)))
+        if kind == 'mention':
+            text = u'<@UBOT> ' + words
+        elif kind == 'command' and len(commands) > 0:
+            text = u'<@UBOT> %s %s' % (rnd.choice(commands), words)
+        else:
+            text = words
+        events.append({'type': 'message', 'channel': rnd.choice(channels)['id'], 'user': rnd.choice(users),
+                       'text': text, 'ts': '%.6f' % (ts + i * 0.001)})
+    return events
+
+
+def module_commands(bot):
+    commands = []
+    for mod in bot._mod_list:
+        for trigger in mod.get_triggers() or []:
+            for phrase in trigger.phrases or []:
+                commands.append(phrase.decode('utf-8') if isinstance(phrase, str) else phrase)
+    return commands
+
+
+def run(config_file, events_count, batch, mix, user_count, extra_channels, seed):
+    """
+    Run the benchmark
+    :return: results dictionary
+    """
+    rnd = random.Random(seed)
+    random.seed(seed)
+    members, channels = make_directory(config_file, user_count, extra_channels)
+    config_cache = ConfigCache(os.path.join(os.getcwd(), '.cache'))
+    api = FakeWebApi(members, channels)
+    bot_config = BotConfig(config_file, config_cache)
+    runtime = BotRuntime(bot_config.get_int_option('engine', 'worker_threads', BotRuntime.WORKER_THREADS),
+                         bot_config.get_int_option('engine', 'handler_threads', BotRuntime.HANDLER_THREADS),
+                         config_cache=config_cache, http=api)
+    BotCore.BotEngine.SlackClient = FakeSlackClient
+    bot = BotRunner.init_bot(config_file, runtime)
+    if bot is None:
+        runtime.stop()
+        return None
+    try:
+        results = measure(bot, members, channels, events_count, batch, mix, rnd)
+    finally:
+        bot.stop()
+        runtime.stop()
+    results['params'] = {'events': events_count, 'batch': batch, 'mix': list(mix), 'users': user_count,
+                         'channels': len(channels), 'seed': seed}
+    results['python'] = sys.version.split()[0]
+    results['api_calls'] = api.get_stats()
+    return results
+
+
+def measure(bot, members, channels, events_count, batch, mix, rnd):
+    """
+    Feed the generated events to an initialized bot, then send its responses
+    :return: results dictionary
+    """
+    responses = []
+    timer = StageTimer()
+    pending = {'routed': 0, 'done': 0}
+    cond = Condition()
+
+    route = bot._BotEngine__route_msg
+    dispatch = bot._BotEngine__dispatch_msg
+
+    def routed(the_msg):
+        mods = route(the_msg)
+        if len(mods) > 0:
+            with cond:
+                pending['routed'] += 1
+        return mods
+
+    def dispatched(the_msg, mods):
+        try:
+            dispatch(the_msg, mods)
+        finally:
+            with cond:
+                pending['done'] += 1
+                cond.notify_all()
+
+    # Private stages are wrapped on the instance, the engine calls them through its attributes
+    bot._BotEngine__preprocess_msg = timer.wrap('preprocess', bot._BotEngine__preprocess_msg)
+    bot._BotEngine__route_msg = timer.wrap('route', routed)
+    bot._BotEngine__dispatch_msg = timer.wrap('dispatch', dispatched)
+    for mod in bot._mod_list:
+        mod.on_message = timer.wrap('on_message:%s' % mod.get_mod_name(), mod.on_message)
+    bot.start_replay(lambda response, priority: responses.append(response))
+
+    events = make_events(events_count, mix, members, channels, module_commands(bot), rnd)
+    for i in range(0, len(events), batch):
+        FakeSlackClient.batches.append(events[i:i + batch])
+    batches = len(FakeSlackClient.batches)
+
+    check = timer.wrap('on_check_messages', bot.on_check_messages)
+    start = timeit.default_timer()
+    for _ in range(batches):
+        check(False)
+    with cond:
+        while pending['done'] < pending['routed']:
+            cond.wait(1)
+    elapsed = timeit.default_timer() - start
+
+    send = timer.wrap('send', bot._BotEngine__response)
+    for response in responses:
+        send(response)
+
+    return {
+        'end_to_end': {'events': len(events), 'elapsed_s': elapsed,
+                       'per_s': len(events) / elapsed if elapsed > 0 else 0,
+                       'dispatched': pending['done'], 'responses': len(responses)},
+        'stages': timer.report(),
+    }
+
+
+def print_results(results, baseline, tolerance):
+    """
+    Print the stage table, compared with the baseline if any
+    :return: list of the stages slower than the baseline by more than tolerance percent
+    """
+    e2e = results['end_to_end']
+    print('end-to-end: %d events in %.3fs, %.0f events/s, %d dispatched, %d responses' % (
+        e2e['events'], e2e['elapsed_s'], e2e['per_s'], e2e['dispatched'], e2e['responses']))
+    regressions = []
+    print('%-28s %8s %12s %10s %10s %10s' % ('stage', 'count', 'ops/s', 'p50 ms', 'p99 ms', 'vs base'))
+    for stage, values in sorted(results['stages'].iteritems()):
+        delta = ''
+        base = (baseline or {}).get('stages', {}).get(stage)
+        if base is not None and base['p50_ms'] > 0:
+            change = (values['p50_ms'] - base['p50_ms']) * 100.0 / base['p50_ms']
+            delta = '%+.1f%%' % change
+            if change > tolerance:
+                regressions.append(stage)
+                delta += ' !'
+        print('%-28s %8d %12.0f %10.3f %10.3f %10s' % (stage, values['count'], values['per_s'], values['p50_ms'],
+                                                       values['p99_ms'], delta))
+    return regressions
+
+
+def parse_mix(value):
+    try:
+        mix = tuple(int(weight) for weight in value.split(':'))
+    except ValueError:
+        mix = ()
+    if len(mix) != 3 or min(mix) < 0 or sum(mix) <= 0:
+        raise argparse.ArgumentTypeError('invalid mix: %s' % value)
+    return mix
+
+
+def parse_args(args=None):
+    """
+    Parse the command line, exits on --help and on invalid options
+    :param args: list of arguments, None for sys.argv
+    :return: argparse.Namespace object
+    """
+    parser = argparse.ArgumentParser(description='Measure the message pipeline with a stand-in Slack client.')
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'conf',
+                                                         'bot.conf'),
+                        help='bot config file (default: conf/bot.conf)')
+    parser.add_argument('--events', type=int, default=5000, help='number of generated events (default: %(default)s)')
+    parser.add_argument('--batch', type=int, default=20,
+                        help='events read by each on_check_messages call (default: %(default)s)')
+    parser.add_argument('--mix', type=parse_mix, default='20:30:50', metavar='MENTIONS:COMMANDS:CHATTER',
+                        help='weights of the event kinds (default: %(default)s)')
+    parser.add_argument('--users', type=int, default=200, help='number of users (default: %(default)s)')
+    parser.add_argument('--channels', type=int, default=2,
+                        help='channels the bot ignores, added to the enabled ones (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated events (default: %(default)s)')
+    parser.add_argument('--output', help='JSON file receiving the results')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help='p50 slowdown reported as a regression, in percent (default: %(default)s)')
+    return parser.parse_args(args)
+
+
+def main():
+    options = parse_args()
+    config_file = os.path.abspath(options.config)
+    baseline = None
+    if options.baseline is not None:
+        with open(options.baseline, 'rb') as f:
+            baseline = json.load(f)
+
+    # The engine writes its prefs and caches in the working directory
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='bot_bench_')
+    os.chdir(work_dir)
+    try:
+        results = run(config_file, options.events, max(1, options.batch), options.mix, options.users,
+                      options.channels, options.seed)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if results is None:
+        print('Failed to initialize the bot', file=sys.stderr)
+        return 1
+    regressions = print_results(results, baseline, options.tolerance)
+    if options.output is not None:
+        with open(options.output, 'wb') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if len(regressions) > 0:
+        print('Slower than the baseline: %s' % ', '.join(regressions))
+        return 3
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())